@@ -0,0 +1,112 @@
+"""
+Сравнение последовательных запросов OursEnricher к CRM с параллельными
+запросами окна PrefetchBuffer через пул соединений.
+
+Вместо MariaDB используется in-process заглушка с искусственной задержкой:
+
+    python -m benchmarks.crm_pool --items 5000 --uniq 2000 --latency 0.002 --pool-size 8
+"""
+import argparse
+import random
+from time import sleep, perf_counter
+from typing import Optional
+
+from src.handlers import AbstractHandler, OursEnricher, PrefetchBuffer
+from src.utils.db_pool import ConnectionPool
+
+
+class FakeCursor:
+    def __init__(self, connection: 'FakeConnection'):
+        self.connection = connection
+        self.row = None
+
+    def execute(self, query: str, inn: str):
+        sleep(self.connection.latency)
+        self.connection.queries += 1
+        self.row = (1,) if inn in self.connection.known_inns else None
+
+    def fetchone(self):
+        return self.row
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class FakeConnection:
+    """ Заглушка pymysql-соединения: каждый запрос стоит `latency` секунд """
+
+    def __init__(self, known_inns: set, latency: float):
+        self.known_inns = known_inns
+        self.latency = latency
+        self.queries = 0
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor(self)
+
+    def ping(self, reconnect: bool = False):
+        pass
+
+    def close(self):
+        pass
+
+
+class Collector(AbstractHandler):
+    def __init__(self):
+        self.items = []
+
+    def handle(self, item: dict) -> Optional[str]:
+        self.items.append((item['inn'], item['our']))
+        return super().handle(item)
+
+
+def run(items: list, pool: ConnectionPool, window: int = 0) -> (list, float):
+    enricher = OursEnricher(pool)
+    collector = Collector()
+    if window:
+        head = PrefetchBuffer(enricher, window)
+        head.set_next(enricher).set_next(collector)
+    else:
+        head = enricher
+        head.set_next(collector)
+
+    start = perf_counter()
+    for item in items:
+        head.handle(dict(item))
+    head.flush()
+    elapsed = perf_counter() - start
+    head.close()
+    pool.close()
+    return collector.items, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=5000)
+    parser.add_argument('--uniq', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.002)
+    parser.add_argument('--pool-size', type=int, default=8)
+    parser.add_argument('--window', type=int, default=500)
+    args = parser.parse_args()
+
+    random.seed(0)
+    inns = [f'{7700000000 + i}' for i in range(args.uniq)]
+    known_inns = set(random.sample(inns, args.uniq // 3))
+    items = [{'inn': random.choice(inns)} for _ in range(args.items)]
+
+    def connect(**db):
+        return FakeConnection(known_inns, args.latency)
+
+    serial, serial_time = run(items, ConnectionPool(1, connect=connect))
+    pooled, pooled_time = run(items, ConnectionPool(args.pool_size, connect=connect), args.window)
+
+    assert serial == pooled, 'Pooled lookups changed results or order'
+    print(f'serial: {serial_time:.3f}s')
+    print(f'pool of {args.pool_size}, window {args.window}: {pooled_time:.3f}s '
+          f'(x{serial_time / pooled_time:.1f})')
+
+
+if __name__ == '__main__':
+    main()
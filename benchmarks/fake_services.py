@@ -0,0 +1,342 @@
+"""
+Локальные заглушки внешних сервисов с настраиваемой задержкой и счётчиками
+обращений:
+
+* FakeHTTPServer — страницы и zip-выгрузки opendata РКН и API Pipedrive
+  (PIPEDRIVE_URL, RKN_URL);
+* FakeCRMServer — минимальный сервер протокола MySQL, которого хватает
+  pymysql: рукопожатие, COM_QUERY, COM_PING, COM_QUIT (CRM_DB_HOST/PORT).
+"""
+import json
+import re
+import socketserver
+import struct
+import threading
+import zlib
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from typing import Dict, Optional, Set
+from urllib.parse import urlparse, parse_qs
+
+OPENDATA_PAGE = (
+    '<html><body><table><tr>\r\n'
+    '\t\t<td>Гиперссылка (URL) на набор</td>\r\n'
+    '\t\t<td><a target="_blank" href="{href}">{href}</a></td>\r\n'
+    '</tr></table></body></html>'
+)
+
+
+class FakeHTTPServer:
+    """
+    :param datasets: путь страницы набора (`/opendata/7705846236-LicComm/`) -> содержимое zip
+    :param org_inns: ИНН организаций, которые «есть» в Pipedrive
+    :param latency: задержка ответа API Pipedrive, секунды
+    """
+
+    def __init__(self, datasets: Dict[str, bytes], org_inns: Set[str], latency: float = 0.):
+        self.datasets = datasets
+        self.org_ids = {inn: 1000 + index for index, inn in enumerate(sorted(org_inns))}
+        self.latency = latency
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.next_id = 1
+        # Созданные сделки для deals/search и deals/<id>: id -> (title, org_id, stage_id, add_time)
+        self.deals = {}
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def start(self) -> 'FakeHTTPServer':
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, name: str) -> int:
+        with self.lock:
+            self.calls[name] += 1
+            self.next_id += 1
+            return self.next_id
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Иначе заголовки и тело уходят разными пакетами и клиент ждёт delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def send(self, status: int, body: bytes, content_type: str = 'application/json'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_json(self, data: dict, status: int = 200):
+                self.send(status, json.dumps(data).encode())
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+
+                if url.path in fake.datasets:
+                    fake.count('rkn_page')
+                    href = url.path.rstrip('/') + '/data.zip'
+                    return self.send(200, OPENDATA_PAGE.format(href=href).encode(), 'text/html; charset=utf-8')
+
+                if url.path.endswith('/data.zip') and url.path[:-len('data.zip')] in fake.datasets:
+                    fake.count('rkn_zip')
+                    return self.send(200, fake.datasets[url.path[:-len('data.zip')]], 'application/zip')
+
+                sleep(fake.latency)
+                if url.path == '/v1/itemSearch/field':
+                    fake.count('pipedrive_item_search')
+                    org_id = fake.org_ids.get(query.get('term', [''])[0])
+                    return self.send_json({'success': True, 'data': [{'id': org_id}] if org_id else []})
+
+                if url.path == '/v1/deals/search':
+                    fake.count('pipedrive_deal_search')
+                    title, org_id = query.get('term', [''])[0], query.get('organization_id', [''])[0]
+                    with fake.lock:
+                        items = [{'item': {'id': deal_id, 'title': title, 'stage': {'id': int(stage_id)}}}
+                                 for deal_id, deal in fake.deals.items()
+                                 for deal_title, deal_org_id, stage_id, _ in [deal]
+                                 if deal_title == title and (not org_id or deal_org_id == org_id)]
+                    return self.send_json({'success': True, 'data': {'items': items}})
+
+                match = re.fullmatch(r'/v1/deals/(\d+)', url.path)
+                if match and int(match.group(1)) in fake.deals:
+                    fake.count('pipedrive_deal')
+                    title, org_id, stage_id, add_time = fake.deals[int(match.group(1))]
+                    return self.send_json({'success': True, 'data': {
+                        'id': int(match.group(1)), 'title': title, 'stage_id': int(stage_id), 'add_time': add_time}})
+
+                match = re.fullmatch(r'/v1/organizations/(\d+)', url.path)
+                if match:
+                    fake.count('pipedrive_organization')
+                    return self.send_json({'success': True, 'data': {'id': int(match.group(1)), 'name': 'org'}})
+
+                self.send_json({'success': False, 'error': 'not found'}, 404)
+
+            def do_POST(self):
+                body = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+                sleep(fake.latency)
+                url = urlparse(self.path)
+                if url.path in ('/v1/deals', '/v1/activities'):
+                    new_id = fake.count('pipedrive_' + url.path.rsplit('/', 1)[-1])
+                    if url.path == '/v1/deals':
+                        with fake.lock:
+                            title, org_id, stage_id = (body.get(field, [''])[0]
+                                                       for field in ('title', 'org_id', 'stage_id'))
+                            add_time = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+                            fake.deals[new_id] = (title, org_id, stage_id, add_time)
+                    return self.send_json({'success': True, 'data': {'id': new_id}}, 201)
+
+                self.send_json({'success': False, 'error': 'not found'}, 404)
+
+        return Handler
+
+
+# --- MySQL ---
+
+CLIENT_LONG_PASSWORD = 1
+CLIENT_CONNECT_WITH_DB = 8
+CLIENT_PROTOCOL_41 = 0x200
+CLIENT_TRANSACTIONS = 0x2000
+CLIENT_SECURE_CONNECTION = 0x8000
+CLIENT_PLUGIN_AUTH = 0x80000
+SERVER_CAPABILITIES = (CLIENT_LONG_PASSWORD | CLIENT_CONNECT_WITH_DB | CLIENT_PROTOCOL_41 | CLIENT_TRANSACTIONS
+                       | CLIENT_SECURE_CONNECTION | CLIENT_PLUGIN_AUTH)
+
+COM_QUIT = 0x01
+COM_INIT_DB = 0x02
+COM_QUERY = 0x03
+COM_PING = 0x0e
+
+TYPE_LONGLONG = 0x08
+TYPE_VAR_STRING = 0xfd
+
+QUERY_RE = re.compile(
+    r"SELECT\s+(?P<columns>.+?)\s+FROM\s+Organisation(?:\s+WHERE\s+inn\s*=\s*'(?P<inn>[^']*)')?",
+    re.IGNORECASE,
+)
+
+
+def split_columns(columns: str) -> list:
+    """ Колонки SELECT по запятым верхнего уровня: у CONCAT_WS(...) свои запятые """
+    parts, depth, start = [], 0, 0
+    for index, char in enumerate(columns):
+        depth += {'(': 1, ')': -1}.get(char, 0)
+        if char == ',' and not depth:
+            parts.append(columns[start:index].strip())
+            start = index + 1
+    return parts + [columns[start:].strip()]
+
+
+def lenenc_int(value: int) -> bytes:
+    if value < 251:
+        return bytes([value])
+    if value < 2 ** 16:
+        return b'\xfc' + struct.pack('<H', value)
+    if value < 2 ** 24:
+        return b'\xfd' + struct.pack('<I', value)[:3]
+    return b'\xfe' + struct.pack('<Q', value)
+
+
+def lenenc_str(value: bytes) -> bytes:
+    return lenenc_int(len(value)) + value
+
+
+class FakeCRMServer:
+    """
+    Заглушка БД CRM: таблица Organisation с колонками id, inn, smsPhone.
+    Каждый запрос SELECT стоит `latency` секунд.
+    """
+
+    def __init__(self, inns: Set[str], latency: float = 0.):
+        self.rows = {inn: (index + 1, f'+7900{index:07d}') for index, inn in enumerate(sorted(inns))}
+        self.latency = latency
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self) -> 'FakeCRMServer':
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, name: str):
+        with self.lock:
+            self.calls[name] += 1
+
+    def select(self, sql: str) -> Optional[tuple]:
+        """ (имена колонок, строки) или None для запросов без результата """
+        match = QUERY_RE.match(sql.strip())
+        if not match:
+            return None
+
+        columns = split_columns(match.group('columns'))
+        if match.group('inn') is None:
+            # crm_version: COUNT(*), MAX(id), BIT_XOR(CRC32(CONCAT_WS('|', inn, <поле>)))
+            field = re.search(r'inn,\s*(\w+)\)', columns[-1]).group(1)
+            checksum = 0
+            for inn, (id_, phone) in self.rows.items():
+                value = {'id': id_, 'inn': inn, 'smsPhone': phone}[field]
+                checksum ^= zlib.crc32(f'{inn}|{value}'.encode())
+            return columns, [(len(self.rows), len(self.rows), checksum)]
+
+        row = self.rows.get(match.group('inn'))
+        if row is None:
+            return columns, []
+        values = {'id': row[0], 'inn': match.group('inn'), 'smsPhone': row[1]}
+        return columns, [tuple(values.get(column) for column in columns)]
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def setup(self):
+                self.seq = 0
+
+            def send_packet(self, payload: bytes):
+                self.request.sendall(struct.pack('<I', len(payload))[:3] + bytes([self.seq]) + payload)
+                self.seq = (self.seq + 1) % 256
+
+            def read_packet(self) -> Optional[bytes]:
+                header = self.read_exact(4)
+                if header is None:
+                    return None
+                length = struct.unpack('<I', header[:3] + b'\0')[0]
+                self.seq = (header[3] + 1) % 256
+                return self.read_exact(length)
+
+            def read_exact(self, size: int) -> Optional[bytes]:
+                data = b''
+                while len(data) < size:
+                    chunk = self.request.recv(size - len(data))
+                    if not chunk:
+                        return None
+                    data += chunk
+                return data
+
+            def send_ok(self):
+                self.send_packet(b'\x00\x00\x00' + struct.pack('<HH', 0, 0))
+
+            def send_eof(self):
+                self.send_packet(b'\xfe' + struct.pack('<HH', 0, 0))
+
+            def send_result(self, columns: list, rows: list):
+                self.send_packet(lenenc_int(len(columns)))
+                for column in columns:
+                    is_number = column.upper().startswith(('COUNT', 'MAX', 'BIT_XOR')) or column == 'id'
+                    self.send_packet(
+                        lenenc_str(b'def') + lenenc_str(b'crm') + lenenc_str(b'Organisation')
+                        + lenenc_str(b'Organisation') + lenenc_str(column.encode())
+                        + lenenc_str(column.encode()) + b'\x0c'
+                        + struct.pack('<HIBHB', 33, 255, TYPE_LONGLONG if is_number else TYPE_VAR_STRING, 0, 0)
+                        + b'\0\0'
+                    )
+                self.send_eof()
+                for row in rows:
+                    self.send_packet(b''.join(
+                        b'\xfb' if value is None else lenenc_str(str(value).encode()) for value in row
+                    ))
+                self.send_eof()
+
+            def handle(self):
+                fake.count('connections')
+                salt = b'12345678' + b'901234567890'
+                self.send_packet(
+                    b'\x0a' + b'5.7.0-fake\0' + struct.pack('<I', 1) + salt[:8] + b'\0'
+                    + struct.pack('<HBHHB', SERVER_CAPABILITIES & 0xffff, 33, 0, SERVER_CAPABILITIES >> 16, 21)
+                    + b'\0' * 10 + salt[8:] + b'\0' + b'mysql_native_password\0'
+                )
+                if self.read_packet() is None:
+                    return
+                # Пароль не проверяем
+                self.send_ok()
+
+                while True:
+                    self.seq = 0
+                    packet = self.read_packet()
+                    if not packet or packet[0] == COM_QUIT:
+                        return
+
+                    command, body = packet[0], packet[1:]
+                    if command == COM_QUERY:
+                        sql = body.decode('utf-8')
+                        result = fake.select(sql)
+                        if result is None:
+                            self.send_ok()
+                            continue
+                        fake.count('queries')
+                        sleep(fake.latency)
+                        self.send_result(*result)
+                    elif command in (COM_PING, COM_INIT_DB):
+                        fake.count('pings' if command == COM_PING else 'init_db')
+                        self.send_ok()
+                    else:
+                        self.send_packet(b'\xff' + struct.pack('<H', 1047) + b'#08S01Unknown command')
+
+        return Handler
+
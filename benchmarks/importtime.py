@@ -0,0 +1,71 @@
+"""
+Бюджет времени импорта по `python -X importtime`.
+
+Для каждой точки входа проверяет суммарное время импорта и то, что тяжёлые
+зависимости не подтягиваются туда, где не нужны (CLI и отчёты не грузят
+lxml, pymysql, requests_cache; `--help` не грузит и requests).
+
+    python -m benchmarks.importtime
+    python -m benchmarks.importtime --scale 2   # медленная машина
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# модуль -> (бюджет, мс; модули, которых не должно быть среди импортированных)
+BUDGETS = {
+    'src.cli': (80, ['lxml', 'pymysql', 'requests', 'requests_cache', 'requests_futures', 'tqdm']),
+    'src.reports': (200, ['lxml', 'pymysql', 'requests', 'requests_cache']),
+    'src.conveers': (600, []),
+}
+LINE_RE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+
+def import_times(module: str) -> Dict[str, int]:
+    """ Модуль -> суммарное время его импорта, мкс """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=REPO_ROOT, env=dict(os.environ, PYTHONPATH=str(REPO_ROOT)),
+        capture_output=True, text=True, check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        match = LINE_RE.match(line)
+        if match:
+            times[match.group(4)] = int(match.group(2))
+    return times
+
+
+def check(module: str, budget_ms: float, forbidden: List[str], runs: int) -> bool:
+    # Берём лучший из нескольких прогонов: первый часто медленнее из-за холодного кеша ФС
+    samples = [import_times(module) for _ in range(runs)]
+    best = min(samples, key=lambda times: times[module])
+    total_ms = best[module] / 1000
+
+    loaded = [name for name in forbidden if name in best]
+    ok = total_ms <= budget_ms and not loaded
+    print(f'{module:16} {total_ms:8.1f} ms / {budget_ms:.0f} ms{"" if ok else "  FAIL"}')
+    if loaded:
+        print(f'{"":16} unexpected imports: {", ".join(loaded)}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=float, default=1., help='multiply every budget')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    results = [check(module, budget * args.scale, forbidden, args.runs)
+               for module, (budget, forbidden) in BUDGETS.items()]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == '__main__':
+    main()
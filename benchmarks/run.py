@@ -0,0 +1,209 @@
+"""
+Воспроизводимый end-to-end бенчмарк.
+
+Генерирует синтетические выгрузки РКН, поднимает заглушки РКН/Pipedrive
+(HTTP) и CRM (протокол MySQL) с заданной задержкой и по очереди запускает
+команды CLI во временном каталоге. Для каждой команды пишет время,
+пропускную способность, пиковый RSS и число обращений к внешним сервисам.
+
+    python -m benchmarks.run --records 50000 --output bench.json
+    python -m benchmarks.run --records 50000 --compare bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter, time
+from typing import List, Optional
+
+from benchmarks.fake_services import FakeHTTPServer, FakeCRMServer
+from benchmarks.synthetic import generate_registry, licenses_zip, resolutions_zip, crm_clients_csv
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+LICENSES_PAGE = '/opendata/7705846236-LicComm/'
+RESOLUTIONS_PAGE = '/opendata/7705846236-ResolutionRadioCHF/'
+
+PROLONGATION = ['--start', '2021-01-01', '--end', '2022-12-31', '--ours', 'True']
+COMMISSIONING = ['--start', '2019-01-01', '--end', '2022-12-31']
+RESOLUTIONS = ['--start', '2021-01-01', '--end', '2021-12-31']
+
+# (имя, аргументы CLI, набор-источник для подсчёта пропускной способности)
+COMMANDS = [
+    ('prolongation_licenses_fetch', ['prolongation-licenses', '-p', 'fetch', *PROLONGATION], 'licenses'),
+    ('prolongation_licenses_csv', ['prolongation-licenses', '-p', 'generate_csv', *PROLONGATION], None),
+    ('prolongation_licenses_push', ['prolongation-licenses', '-p', 'push', *PROLONGATION], None),
+    ('commissioning_licenses_fetch', ['commissioning-licenses', '-p', 'fetch', *COMMISSIONING], 'licenses'),
+    ('commissioning_licenses_csv', ['commissioning-licenses', '-p', 'generate_csv', *COMMISSIONING], None),
+    ('commissioning_licenses_push', ['commissioning-licenses', '-p', 'push', *COMMISSIONING], None),
+    ('prolongation_resolutions_fetch', ['prolongation-resolutions', '-p', 'fetch', *RESOLUTIONS], 'resolutions'),
+    ('prolongation_resolutions_csv', ['prolongation-resolutions', '-p', 'generate_csv', *RESOLUTIONS], None),
+    ('prolongation_resolutions_push', ['prolongation-resolutions', '-p', 'push', *RESOLUTIONS], None),
+    ('special_licenses_fetch', ['special-licenses', '-p', 'fetch'], 'licenses'),
+    ('special_licenses_csv', ['special-licenses', '-p', 'generate_csv'], None),
+]
+
+
+def run_command(name: str, args: List[str], workdir: Path, env: dict) -> dict:
+    """ Запускает команду CLI в отдельном процессе, RSS берётся из rusage именно этого процесса """
+    log_path = workdir / 'logs' / f'{name}.log'
+    log_path.parent.mkdir(exist_ok=True)
+
+    start = perf_counter()
+    with open(log_path, 'wb') as log:
+        process = subprocess.Popen([sys.executable, '-m', 'src.cli', *args], cwd=workdir, env=env,
+                                   stdout=log, stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(process.pid, 0)
+    wall = perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    if process.returncode:
+        print(f'{name} failed with code {process.returncode}, see {log_path}:')
+        print(log_path.read_text(errors='replace')[-2000:])
+
+    return {
+        'returncode': process.returncode,
+        'wall_s': round(wall, 3),
+        # ru_maxrss в Linux — килобайты
+        'peak_rss_mb': round(rusage.ru_maxrss / 1024, 1),
+        'cpu_s': round(rusage.ru_utime + rusage.ru_stime, 3),
+    }
+
+
+def count_output(workdir: Path, since: float) -> Optional[int]:
+    """ Строки в отчётах, записанных после `since` """
+    reports = [path for path in (workdir / 'reports').glob('*.csv') if path.stat().st_mtime >= since]
+    if not reports:
+        return None
+    with open(max(reports, key=lambda path: path.stat().st_mtime), 'rb') as f:
+        return max(0, sum(1 for _ in f) - 1)
+
+
+def run_benchmark(args) -> dict:
+    print(f'Generate registry: {args.records} licenses, dirty {args.dirty:.0%}')
+    registry = generate_registry(args.records, dirty=args.dirty, seed=args.seed)
+    source_sizes = {'licenses': len(registry.licenses), 'resolutions': len(registry.resolutions)}
+    pipedrive_inns = {org.inn for index, org in enumerate(registry.organisations) if index % 3}
+
+    http = FakeHTTPServer(
+        {LICENSES_PAGE: licenses_zip(registry), RESOLUTIONS_PAGE: resolutions_zip(registry)},
+        pipedrive_inns, latency=args.pipedrive_latency / 1000,
+    ).start()
+    crm = FakeCRMServer(registry.crm_inns, latency=args.crm_latency / 1000).start()
+
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory(prefix='rkn_bench_') as tmp:
+            workdir = Path(args.workdir or tmp)
+            (workdir / 'crmdbsync').mkdir(parents=True, exist_ok=True)
+            (workdir / 'crmdbsync' / 'all_clients.csv').write_bytes(crm_clients_csv(registry))
+
+            env = dict(
+                os.environ,
+                PYTHONPATH=str(REPO_ROOT),
+                RKN_URL=http.url,
+                PIPEDRIVE_URL=http.url,
+                CRM_DB_HOST='127.0.0.1',
+                CRM_DB_PORT=str(crm.port),
+            )
+
+            for name, cli_args, source in COMMANDS:
+                if args.only and not any(part in name for part in args.only):
+                    continue
+
+                http.calls.clear()
+                crm.calls.clear()
+                started_at = time()
+                print(f'Run {name} ...', end=' ', flush=True)
+                result = run_command(name, cli_args + args.extra, workdir, env)
+
+                items = source_sizes[source] if source else None
+                if name.endswith('_csv'):
+                    items = count_output(workdir, started_at)
+                if name.endswith('_push'):
+                    items = http.calls['pipedrive_deals']
+                result['items'] = items
+                result['items_per_s'] = round(items / result['wall_s'], 1) if items else None
+                result['calls'] = {**http.calls, **{f'crm_{key}': value for key, value in crm.calls.items()}}
+
+                print(f'{result["wall_s"]}s, {result["peak_rss_mb"]} MB')
+                results[name] = result
+    finally:
+        http.stop()
+        crm.stop()
+
+    return {
+        'params': {
+            'records': args.records,
+            'dirty': args.dirty,
+            'seed': args.seed,
+            'crm_latency_ms': args.crm_latency,
+            'pipedrive_latency_ms': args.pipedrive_latency,
+            'extra': args.extra,
+        },
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'results': results,
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> bool:
+    """ Печатает сравнение с базовой линией, возвращает False при регрессии """
+    ok = True
+    if report['params'] != baseline['params']:
+        print(f'Warning: params differ from baseline {baseline["params"]}')
+
+    print(f'{"command":32} {"wall, s":>16} {"rss, MB":>16} {"external calls":>20}')
+    for name, result in report['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            print(f'{name:32} (no baseline)')
+            continue
+
+        calls = sum(result['calls'].values())
+        base_calls = sum(base['calls'].values())
+        wall_ratio = result['wall_s'] / base['wall_s'] if base['wall_s'] else 1
+        regressed = wall_ratio > 1 + tolerance or calls > base_calls or result['returncode']
+        ok = ok and not regressed
+        print(
+            f'{name:32} {base["wall_s"]:>7} -> {result["wall_s"]:<7}'
+            f' {base["peak_rss_mb"]:>7} -> {result["peak_rss_mb"]:<7}'
+            f' {base_calls:>9} -> {calls:<9}{"  REGRESSION" if regressed else ""}'
+        )
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=20000, help='licenses in synthetic dump')
+    parser.add_argument('--dirty', type=float, default=0.01, help='share of dirty records')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--crm-latency', type=float, default=1., help='ms per CRM query')
+    parser.add_argument('--pipedrive-latency', type=float, default=5., help='ms per Pipedrive request')
+    parser.add_argument('--only', action='append', help='run only commands containing this substring')
+    parser.add_argument('--extra', action='append', default=[], help='extra CLI argument for every command, e.g. --extra=--staged')
+    parser.add_argument('--workdir', help='keep stores, reports and logs here instead of a temp dir')
+    parser.add_argument('--output', help='write results JSON here')
+    parser.add_argument('--compare', help='baseline JSON to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed wall time growth vs baseline')
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    failed = [name for name, result in report['results'].items() if result['returncode']]
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+        print(f'Results written to {args.output}')
+
+    ok = not failed
+    if args.compare:
+        ok = compare(report, json.loads(Path(args.compare).read_text()), args.tolerance) and ok
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""
+Синтетические выгрузки РКН (LicComm, ResolutionRadioCHF) и выгрузка клиентов
+CRM заданного размера и «грязности».
+
+Грязные записи повторяют то, что встречается в настоящих данных: ИНН с
+КПП и мусором, даты вида 3018-03-03, пустые поля.
+"""
+import random
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from io import BytesIO
+from typing import List, Set
+from xml.sax.saxutils import escape
+from zipfile import ZipFile, ZIP_DEFLATED
+
+LICENSES_NS = 'http://rsoc.ru/opendata/7705846236-LicComm'
+RESOLUTIONS_NS = 'http://rsoc.ru/opendata/7705846236-ResolutionRadioCHF'
+
+SERVICE_NAMES = [
+    'Услуги связи по передаче данных, за исключением услуг связи по передаче данных для целей передачи '
+    'голосовой информации',
+    'Телематические услуги связи',
+    'Услуги местной телефонной связи, за исключением услуг местной телефонной связи с использованием '
+    'таксофонов и средств коллективного доступа',
+    'Услуги связи для целей кабельного вещания',
+    'Услуги связи для целей эфирного вещания',
+    'Услуги телеграфной связи',
+    'Услуги подвижной радиотелефонной связи',
+    'Услуги связи по предоставлению каналов связи',
+]
+TERRITORIES = ['г. Москва', 'Московская область', 'Санкт-Петербург', 'Республика Татарстан', 'Российская Федерация']
+OWNERSHIPS = ['ООО', 'АО', 'ПАО', 'Индивидуальный предприниматель']
+STATUSES = ['действующая', 'действующая', 'действующая', 'недействующая']
+RADIO_SERVICES = ['фиксированная', 'подвижная сухопутная', 'радиовещательная']
+DIRTY_INN_PATTERNS = ['{inn}/{kpp}', 'ИНН {inn}', '{inn};', '{inn}; ; ; ;', '-', '773500895(4)']
+DIRTY_DATES = ['3018-03-03', '2109-02-26', '']
+
+
+@dataclass
+class Organisation:
+    name: str
+    inn: str
+    ownership: str
+
+
+@dataclass
+class SyntheticRegistry:
+    organisations: List[Organisation]
+    licenses: List[dict]
+    resolutions: List[dict]
+    crm_inns: Set[str] = field(default_factory=set)
+
+
+def random_date(rnd: random.Random, start: date, days: int) -> str:
+    return (start + timedelta(days=rnd.randrange(days))).isoformat()
+
+
+def dirty_inn(rnd: random.Random, inn: str) -> str:
+    return rnd.choice(DIRTY_INN_PATTERNS).format(inn=inn, kpp=inn[:4] + '01001')
+
+
+def generate_registry(records: int, dirty: float = 0.01, orgs: int = None, ours: float = 0.4,
+                      seed: int = 0) -> SyntheticRegistry:
+    """
+    :param records: число лицензий (разрешений РИЧ генерируется вчетверо меньше)
+    :param dirty: доля записей с грязными ИНН и датами
+    :param orgs: число организаций, по умолчанию records // 5
+    :param ours: доля организаций, которые есть в CRM
+    """
+    rnd = random.Random(seed)
+    orgs = orgs or max(1, records // 5)
+
+    organisations = []
+    for index in range(orgs):
+        ownership = rnd.choice(OWNERSHIPS)
+        organisations.append(Organisation(
+            name=f'{ownership} "Связь-{index}"',
+            inn=str(7700000000 + index * 7),
+            ownership=ownership,
+        ))
+
+    licenses = []
+    for index in range(records):
+        org = rnd.choice(organisations)
+        is_dirty = rnd.random() < dirty
+        date_start = random_date(rnd, date(2010, 1, 1), 365 * 10)
+        licenses.append({
+            'name': org.name,
+            'ownership': org.ownership,
+            'name_short': org.name,
+            'addr_legal': f'{rnd.choice(TERRITORIES)}, ул. Тестовая, д. {index % 300}',
+            'inn': dirty_inn(rnd, org.inn) if is_dirty else org.inn,
+            'ogrn': str(1027700000000 + index),
+            'licence_num': f'Л{index:06d}',
+            'lic_status_name': rnd.choice(STATUSES),
+            'date_start': date_start,
+            'date_service_start': random_date(rnd, date(2015, 1, 1), 365 * 8) if rnd.random() > 0.1 else date_start,
+            'date_end': rnd.choice(DIRTY_DATES) if is_dirty else random_date(rnd, date(2019, 1, 1), 365 * 6),
+            'date_order': random_date(rnd, date(2010, 1, 1), 365 * 12),
+            'service_name': rnd.choice(SERVICE_NAMES),
+            'territory': rnd.choice(TERRITORIES),
+            'num_order': f'{index % 900}-рчс',
+        })
+
+    resolutions = []
+    for index in range(max(1, records // 4)):
+        org = rnd.choice(organisations)
+        is_dirty = rnd.random() < dirty
+        resolutions.append({
+            'owner_name': org.name,
+            'radio_service': rnd.choice(RADIO_SERVICES),
+            'territory': rnd.choice(TERRITORIES),
+            'reason_num': f'{index:05d}-рчс',
+            'valid_from': random_date(rnd, date(2015, 1, 1), 365 * 5),
+            'valid_to': rnd.choice(DIRTY_DATES) if is_dirty else random_date(rnd, date(2020, 6, 1), 365 * 2),
+        })
+
+    crm_inns = {org.inn for org in organisations if rnd.random() < ours}
+    return SyntheticRegistry(organisations, licenses, resolutions, crm_inns)
+
+
+def records_to_xml(records: List[dict], namespace: str) -> bytes:
+    lines = ['<?xml version="1.0" encoding="utf-8"?>', f'<register xmlns="{namespace}">']
+    for record in records:
+        lines.append('<record>')
+        for key, value in record.items():
+            if value == '':
+                continue
+            lines.append(f'<{key}>{escape(value)}</{key}>')
+        lines.append('</record>')
+    lines.append('</register>')
+    return '\n'.join(lines).encode('utf-8')
+
+
+def zip_bytes(filename: str, data: bytes) -> bytes:
+    with BytesIO() as buffer:
+        with ZipFile(buffer, 'w', ZIP_DEFLATED) as zip_file:
+            zip_file.writestr(filename, data)
+        return buffer.getvalue()
+
+
+def licenses_zip(registry: SyntheticRegistry) -> bytes:
+    return zip_bytes('data-LicComm.xml', records_to_xml(registry.licenses, LICENSES_NS))
+
+
+def resolutions_zip(registry: SyntheticRegistry) -> bytes:
+    return zip_bytes('data-ResolutionRadioCHF.xml', records_to_xml(registry.resolutions, RESOLUTIONS_NS))
+
+
+def crm_clients_csv(registry: SyntheticRegistry) -> bytes:
+    """ Выгрузка клиентов CRM в формате crmdbsync/all_clients.csv (ИНН в 8-й колонке) """
+    header = ['id', 'name', 'type', 'manager', 'phone', 'email', 'address', 'inn', 'kpp']
+    lines = ['"' + '";"'.join(header) + '"']
+    for index, org in enumerate(o for o in registry.organisations if o.inn in registry.crm_inns):
+        row = [str(index), org.name.replace('"', ''), org.ownership, 'manager', '+70000000000',
+               'info@example.com', 'Москва', org.inn, org.inn[:4] + '01001']
+        lines.append('"' + '";"'.join(row) + '"')
+    return ('\n'.join(lines) + '\n').encode('cp1251')
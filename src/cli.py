@@ -1,16 +1,20 @@
+"""
+Модули с тяжёлыми зависимостями (lxml, pymysql, requests) импортируются
+внутри команд и только для выбранного процесса: `--help` и `generate_csv`
+не тратят время на загрузку того, что им не нужно.
+"""
 import click
 
-from src.conveers import prolongation_resolutions_fetch, prolongation_licenses_fetch, commissioning_licenses_fetch, \
-    special_licenses_fetch
-from src.reports import prolongation_licenses_csv, \
-    commissioning_licenses_csv, commissioning_licenses_push, special_licenses_csv, prolongation_licenses_push
-
-from src.reports import prolongation_resolutions_push, prolongation_resolutions_csv
-
 
 @click.group()
-def cli():
-    pass
+@click.option('--progress', type=click.Choice(['auto', 'tty', 'plain', 'json']), envvar='RKN_PROGRESS',
+              default='auto', help='fetch progress: tqdm bar, plain lines for cron or JSON lines for a scheduler')
+@click.option('--progress-interval', type=float, envvar='RKN_PROGRESS_INTERVAL',
+              help='seconds between progress reports, default: 0.5 for tty, 10 otherwise')
+def cli(progress, progress_interval):
+    from src.utils.progress import ProgressReporter
+    ProgressReporter.mode = progress
+    ProgressReporter.interval = progress_interval
 
 
 @cli.command()
@@ -18,12 +22,23 @@ def cli():
 @click.option('--end', type=click.DateTime(), help='to date')
 @click.option('-p', '--process',
               type=click.Choice(['fetch', 'generate_csv', 'push']))
-def prolongation_resolutions(start, end, process):
+@click.option('--tasks-start', type=click.DateTime(), help='follow-up tasks after push: from date')
+@click.option('--tasks-end', type=click.DateTime(), help='follow-up tasks after push: to date')
+@click.option('--resume', is_flag=True, help='fetch: continue from the last checkpoint')
+@click.option('--staged', is_flag=True, help='fetch: run parser, filters, enrichers and writer as parallel stages')
+@click.option('--queue', 'queued', is_flag=True,
+              help='fetch: enrichment, push: deals go through the shared work queue served by `worker`')
+def prolongation_resolutions(start, end, process, tasks_start, tasks_end, resume, staged, queued):
     if process == 'fetch':
-        prolongation_resolutions_fetch(start, end)
+        from src.conveers import prolongation_resolutions_fetch
+        prolongation_resolutions_fetch(start, end, resume, staged, queued)
     if process == 'push':
-        prolongation_resolutions_push(start, end)
+        from src.reports import prolongation_resolutions_push, schedule_follow_up_tasks
+        deal_ids = prolongation_resolutions_push(start, end, queued)
+        if tasks_start and tasks_end:
+            schedule_follow_up_tasks('prolongation_resolutions', deal_ids, tasks_start, tasks_end)
     if process == 'generate_csv':
+        from src.reports import prolongation_resolutions_csv
         prolongation_resolutions_csv(start, end)
 
 
@@ -33,12 +48,28 @@ def prolongation_resolutions(start, end, process):
 @click.option('--ours', type=click.BOOL, help='ours or not')
 @click.option('-p', '--process',
               type=click.Choice(['fetch', 'generate_csv', 'push']))
-def prolongation_licenses(start, end, ours, process):
+@click.option('--tasks-start', type=click.DateTime(), help='follow-up tasks after push: from date')
+@click.option('--tasks-end', type=click.DateTime(), help='follow-up tasks after push: to date')
+@click.option('--resume', is_flag=True, help='fetch: continue from the last checkpoint')
+@click.option('--staged', is_flag=True, help='fetch: run parser, filters, enrichers and writer as parallel stages')
+@click.option('--queue', 'queued', is_flag=True,
+              help='fetch: enrichment, push: deals go through the shared work queue served by `worker`')
+@click.option('--partitioned', is_flag=True,
+              help='fetch: store all dates split by month; generate_csv/push: build the window from them')
+def prolongation_licenses(start, end, ours, process, tasks_start, tasks_end, resume, staged, partitioned, queued):
     if process == 'fetch':
-        prolongation_licenses_fetch(start, end, ours)
+        from src.conveers import prolongation_licenses_fetch
+        prolongation_licenses_fetch(start, end, ours, resume, staged, partitioned, queued)
+    if partitioned and process in ('generate_csv', 'push'):
+        from src.reports import prolongation_licenses_window
+        prolongation_licenses_window(start, end, ours)
     if process == 'push':
-        prolongation_licenses_push(start, end, ours)
+        from src.reports import prolongation_licenses_push, schedule_follow_up_tasks
+        deal_ids = prolongation_licenses_push(start, end, ours, queued)
+        if tasks_start and tasks_end:
+            schedule_follow_up_tasks(f'prolongation_licenses_{start}-{end}_{ours}', deal_ids, tasks_start, tasks_end)
     if process == 'generate_csv':
+        from src.reports import prolongation_licenses_csv
         prolongation_licenses_csv(start, end, ours)
 
 
@@ -48,24 +79,190 @@ def prolongation_licenses(start, end, ours, process):
 @click.option('-p', '--process',
               type=click.Choice(['fetch', 'generate_csv', 'push']))
 @click.option('--ours', type=click.BOOL, help='ours or not', default=True)
-def commissioning_licenses(start, end, process, ours):
+@click.option('--tasks-start', type=click.DateTime(), help='follow-up tasks after push: from date')
+@click.option('--tasks-end', type=click.DateTime(), help='follow-up tasks after push: to date')
+@click.option('--resume', is_flag=True, help='fetch: continue from the last checkpoint')
+@click.option('--staged', is_flag=True, help='fetch: run parser, filters, enrichers and writer as parallel stages')
+@click.option('--queue', 'queued', is_flag=True,
+              help='fetch: enrichment, push: deals go through the shared work queue served by `worker`')
+@click.option('--partitioned', is_flag=True,
+              help='fetch: store all dates split by month; generate_csv/push: build the window from them')
+def commissioning_licenses(start, end, process, ours, tasks_start, tasks_end, resume, staged, partitioned,
+                           queued):
     if process == 'fetch':
-        commissioning_licenses_fetch(start, end, ours)
+        from src.conveers import commissioning_licenses_fetch
+        commissioning_licenses_fetch(start, end, ours, resume, staged, partitioned, queued)
+    if partitioned and process in ('generate_csv', 'push'):
+        from src.reports import commissioning_licenses_window
+        commissioning_licenses_window(start, end, ours)
     if process == 'push':
-        commissioning_licenses_push(start, end)
+        from src.reports import commissioning_licenses_push, schedule_follow_up_tasks
+        deal_ids = commissioning_licenses_push(start, end, ours, queued)
+        if tasks_start and tasks_end:
+            schedule_follow_up_tasks(f'commissioning_licenses_{start}-{end}_{ours}', deal_ids, tasks_start, tasks_end)
     if process == 'generate_csv':
+        from src.reports import commissioning_licenses_csv
         commissioning_licenses_csv(start, end, ours)
 
 
 @cli.command()
 @click.option('-p', '--process',
               type=click.Choice(['fetch', 'generate_csv']))
-def special_licenses(process):
+@click.option('--resume', is_flag=True, help='fetch: continue from the last checkpoint')
+@click.option('--staged', is_flag=True, help='fetch: run parser, filters, enrichers and writer as parallel stages')
+@click.option('--queue', 'queued', is_flag=True,
+              help='fetch: enrichment goes through the shared work queue served by `worker`')
+def special_licenses(process, resume, staged, queued):
     if process == 'fetch':
-        special_licenses_fetch()
+        from src.conveers import special_licenses_fetch
+        special_licenses_fetch(resume, staged, queued)
     if process == 'generate_csv':
+        from src.reports import special_licenses_csv
         special_licenses_csv()
 
 
+@cli.command()
+@click.option('-p', '--process', type=click.Choice(['fetch']))
+@click.option('--resume', is_flag=True, help='fetch: continue from the last checkpoint')
+@click.option('--staged', is_flag=True, help='fetch: run parser, filters, enrichers and writer as parallel stages')
+@click.option('--queue', 'queued', is_flag=True,
+              help='fetch: enrichment goes through the shared work queue served by `worker`')
+def registry(process, resume, staged, queued):
+    """ Whole licence registry by INN with CRM flag, served by `serve` """
+    if process == 'fetch':
+        from src.conveers import registry_fetch
+        registry_fetch(resume, staged, queued)
+
+
+@cli.command()
+@click.option('-p', '--process', type=click.Choice(['ingest', 'as_of', 'changes', 'info']))
+@click.option('--date', help='ingest: dump date, default today; as_of: state date (YYYY-MM-DD)')
+@click.option('--from', 'date_from', help='changes: from date (YYYY-MM-DD)')
+@click.option('--to', 'date_to', help='changes: to date (YYYY-MM-DD)')
+@click.option('--key', multiple=True, help='as_of/changes: only these licence_num')
+def archive(process, date, date_from, date_to, key):
+    """ History of licence dumps: compressed base plus daily deltas by licence_num """
+    if process == 'ingest':
+        from src.conveers import archive_ingest
+        archive_ingest(date)
+    if process == 'as_of':
+        from src.reports import archive_as_of
+        archive_as_of(date, key)
+    if process == 'changes':
+        from src.reports import archive_changes
+        archive_changes(date_from, date_to, key)
+    if process == 'info':
+        from src.reports import archive_info
+        archive_info()
+
+
+@cli.command()
+@click.argument('datasets', nargs=-1)
+@click.option('--date', help='snapshot date (YYYY-MM-DD), default today')
+@click.option('--workers', type=int, help='parser processes, default: one per dataset up to CPU count')
+@click.option('--list', 'list_', is_flag=True, help='list known datasets and their latest snapshots')
+def ingest(datasets, date, workers, list_):
+    """ Download and parse RKN open DATASETS (default: all) into typed snapshots, concurrently """
+    from src.datasets import ingest as ingest_datasets, DATASETS, DatasetSnapshot
+    if list_:
+        for name, dataset in DATASETS.items():
+            try:
+                latest = DatasetSnapshot(name).date
+            except FileNotFoundError:
+                latest = '-'
+            click.echo(f'{name:24} {dataset.data_url:45} {len(dataset.fields):3} fields  latest {latest}')
+        return
+    unknown = [name for name in datasets if name not in DATASETS]
+    if unknown:
+        raise click.UsageError(f'unknown datasets: {", ".join(unknown)}; known: {", ".join(DATASETS)}')
+    results = ingest_datasets(datasets, date, workers)
+    if any('error' in result for result in results):
+        raise SystemExit(1)
+
+
+@cli.command()
+@click.argument('stores', nargs=-1, required=True)
+@click.option('--date', help='fetch date of the stores (YYYY-MM-DD), default: latest of each')
+@click.option('--compression', type=click.Choice(['gzip', 'zstd', 'none']), default='gzip',
+              help='zstd needs the zstandard package')
+@click.option('--level', type=int, help='compression level, default: 6 for gzip, 3 for zstd')
+@click.option('--split-rows', type=int, help='split each report into parts of this many rows, header in every part')
+@click.option('--workers', type=int, help='export processes, default: one per store up to CPU count')
+@click.option('--output-dir', default='reports/')
+def export(stores, date, compression, level, split_rows, workers, output_dir):
+    """ Compressed TSV reports of fetched STORES, one process per store, with a JSON manifest """
+    from src.reports import export_reports
+    results = export_reports(list(stores), date, output_dir, compression, level, split_rows, workers)
+    if any('error' in result for result in results):
+        raise SystemExit(1)
+
+
+@cli.command()
+@click.option('--kind', 'kinds', multiple=True,
+              help='only these job kinds (crm_ours, pipedrive_orgs, push_deal, ...); repeat for several')
+@click.option('--until-empty', is_flag=True, help='exit when no jobs are left instead of waiting for new ones')
+@click.option('--status', is_flag=True, help='print job counts by kind and status and exit')
+@click.option('--retry-failed', is_flag=True, help='put failed jobs back to the queue and exit')
+def worker(kinds, until_empty, status, retry_failed):
+    """ Serve the shared work queue (RKN_QUEUE): enrichment and push jobs of `--queue` runs """
+    from src.workers import Worker, queue_status
+    from src.utils.work_queue import WorkQueue
+    queue = WorkQueue()
+    if status:
+        return queue_status(queue)
+    if retry_failed:
+        return click.echo(f'{queue.retry_failed()} jobs back to the queue')
+    worker_ = Worker(queue, kinds)
+    try:
+        worker_.run(until_empty=until_empty)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker_.close()
+        click.echo(f'Worker {worker_.owner}: {worker_.done} done, {worker_.failed} failed', err=True)
+
+
+@cli.command()
+@click.option('--store', default='registry', help='fetched store to serve')
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', type=int, default=8080)
+@click.option('--reload-interval', type=float, default=60., help='seconds between checks for a newer snapshot')
+def serve(store, host, port, reload_interval):
+    """ Read-only HTTP/JSON lookups over the latest snapshot of STORE, hot-swapped on new fetches """
+    from src.service import RegistryService
+    RegistryService(store, host, port, reload_interval).serve_forever()
+
+
+@cli.command()
+@click.argument('store')
+@click.option('--date', help='fetch date of the store (YYYY-MM-DD), default: latest')
+@click.option('--inn')
+@click.option('--territory', multiple=True, help='exact value, case-insensitive; repeat for OR')
+@click.option('--service', 'service_name', multiple=True, help='exact value, case-insensitive; repeat for OR')
+@click.option('--ours/--not-ours', default=None)
+@click.option('--expires-from', type=click.DateTime(), help='earliest date_end/valid_to from')
+@click.option('--expires-to', type=click.DateTime(), help='earliest date_end/valid_to to')
+@click.option('--limit', type=int, default=50)
+@click.option('--offset', type=int, default=0)
+def query(store, date, inn, territory, service_name, ours, expires_from, expires_to, limit, offset):
+    """ Filtered page of a fetched STORE (e.g. special_licenses) as JSON lines """
+    from src.reports import query_store
+    query_store(store, date, limit, offset, inn=inn, territory=territory, service_name=service_name, our=ours,
+                expires_from=expires_from, expires_to=expires_to)
+
+
+@cli.command()
+@click.argument('stores', nargs=-1, required=True)
+@click.option('--on', type=click.Choice(['inn', 'pipedrive_org_id']), default='inn')
+@click.option('--date', help='fetch date of the stores (YYYY-MM-DD), default: latest of each')
+@click.option('--output', help='report path, default: reports/join_<on>_<stores>.csv')
+def join(stores, on, date, output):
+    """ TSV report of organisations present in all STORES (two or more fetched stores) """
+    if len(stores) < 2:
+        raise click.UsageError('join needs at least two stores')
+    from src.reports import join_stores
+    join_stores(list(stores), on, date, output)
+
+
 if __name__ == '__main__':
     cli()
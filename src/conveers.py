@@ -1,24 +1,43 @@
+import os
 import re
 from datetime import datetime
 from io import BytesIO
-from typing import Generator
+from typing import Generator, Callable, List, Optional, Tuple
 from urllib.parse import urljoin
 from zipfile import ZipFile
 
-import requests
 import requests_cache
 from lxml import etree as et
 from tqdm import tqdm
 
 from src.handlers import StartsWithFilter, ParseDatesConverter, DumbHandler, DateRangeFilter, CounterHandler, \
     InnEnricher, DropEmptyFilter, OursEnricher, BoolFilter, PipedriveOrganisationsEnricher, PutToStore, ValuesFilter, \
-    NotEqualFieldsFilter, OursFieldEnricher, OursEnricherFromCSV
-
-requests_cache.install_cache(expire_after=60 * 60 * 24)
+    NotEqualFieldsFilter, OursFieldEnricher, OursEnricherFromCSV, PrefetchBuffer, Handler, ENRICHMENT_CACHE_SIZE, \
+    PartitionedStore, pushdown_predicates
+from src.datasets import Dataset, DATASETS
+from src.pipeline import StagedRunner, FilterPlanner
+from src.utils.cache import EnrichmentCache
+from src.utils.checkpoint import Checkpoint
+from src.utils.db_pool import ConnectionPool, crm_version
+from src.utils.progress import ProgressReporter
+
+# (поле, предикат над сырым текстом поля), см. AbstractHandler.pushdown
+Predicate = Tuple[str, Callable[[Optional[str]], bool]]
+
+# Сколько соединений с CRM параллельно обслуживают окно PrefetchBuffer
+CRM_POOL_SIZE = 4
+# Раз во сколько записей источника сохранять чекпоинт
+CHECKPOINT_INTERVAL = 20000
+# Ответы Pipedrive в сохранённом кеше живут сутки
+PIPEDRIVE_CACHE_TTL = 60 * 60 * 24
+# Страницы и выгрузки РКН в HTTP-кеше живут сутки
+RKN_HTTP_CACHE_TTL = 60 * 60 * 24
 
 
 class RKNXMLSource():
-    domain = 'https://rkn.gov.ru'
+    """ Набор открытых данных РКН из реестра DATASETS: страница набора -> zip -> записи XML """
+    dataset: Dataset = None
+    domain = os.environ.get('RKN_URL', 'https://rkn.gov.ru')
     headers = {
         "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
         "Accept-Encoding": "gzip, deflate, br",
@@ -30,8 +49,32 @@ class RKNXMLSource():
         "Upgrade-Insecure-Requests": "1",
         "User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:85.0) Gecko/20100101 Firefox/85.0"
     }
+    _session = None
+
+    def __init__(self, dataset: Dataset = None, session: requests_cache.CachedSession = None):
+        if dataset is not None:
+            self.dataset = dataset
+        self._session = session
+
+    @property
+    def data_url(self) -> str:
+        return self.dataset.data_url
+
+    @property
+    def node_tag(self) -> str:
+        return self.dataset.namespace
 
-    def get_licenses_from_source(self) -> Generator[dict, None, None]:
+    @property
+    def session(self) -> requests_cache.CachedSession:
+        """
+        HTTP-кеш только для запросов к РКН и только при загрузке: глобально
+        requests не патчится, остальные команды его не трогают
+        """
+        if self._session is None:
+            self._session = requests_cache.CachedSession('http_cache', expire_after=RKN_HTTP_CACHE_TTL)
+        return self._session
+
+    def get_licenses_from_source(self, skip: int = 0, predicates: List[Predicate] = ()) -> Generator[dict, None, None]:
         """
         Данные очень грязные. Вот пример того, что в ИНН прилетает из xml:
         {'5001037073/500101001', '5007011040/500701001', '7725166581/772501001', '5007006650?', ';7726184054',
@@ -45,23 +88,26 @@ class RKNXMLSource():
         '0411061779/041101001', '3906080890/390601001', '+7717020194', '5009026330; ; ; ; ; ;', '773404090(9)',
         '771003595(6)', '773402222(6)', '5190406703/519001001', '7708114431;'}
         Такие данные занимают менее 1% от всех (по полю ИНН).
+        :param skip: сколько первых записей пропустить (продолжение с чекпоинта)
+        :param predicates: (поле, предикат над сырым текстом) — записи, не прошедшие
+            их, отбрасываются до сборки словаря и не учитываются в `skip`
         :return:
         """
         abs_path = self.get_xml_link()
         print(f'xml link found {abs_path}')
 
-        zip_file_resp = requests.get(abs_path, headers=self.headers)
+        zip_file_resp = self.session.get(abs_path, headers=self.headers)
         print(f'From cache: {zip_file_resp.from_cache}')
         filedata = self.unpack_zip(zip_file_resp.content)
         del zip_file_resp
 
         with BytesIO(filedata) as xmlfile:
-            yield from self.load_xml(xmlfile, node_tag=self.node_tag)
+            yield from self.load_xml(xmlfile, node_tag=self.node_tag, skip=skip, predicates=predicates)
 
     def get_xml_link(self) -> str:
         get_url = urljoin(self.domain, self.data_url)
         print(f'Request {get_url}')
-        resp = requests.get(get_url, headers=self.headers)
+        resp = self.session.get(get_url, headers=self.headers)
         print(f'From cache: {resp.from_cache}')
         match = re.search(r'<td>Гиперссылка \(URL\) на набор</td>\r\n\t+<td\s*><a target="_blank" href="(.+?)">',
                           resp.text)
@@ -80,28 +126,105 @@ class RKNXMLSource():
 
                 return filedata
 
-    def load_xml(self, path, node_tag: str):
+    @staticmethod
+    def child_text(elem, tag: str) -> Optional[str]:
+        """ Текст дочернего элемента с тегом `tag`; из повторов — последний, как в словаре записи """
+        # iterchildren сравнивает теги в lxml, findtext каждый раз разбирает путь
+        text = None
+        for child_elem in elem.iterchildren(tag):
+            text = child_elem.text
+        return text
+
+    def load_xml(self, path, node_tag: str, skip: int = 0, predicates: List[Predicate] = ()):
         print('load xml')
-        for event, elem in et.iterparse(path, encoding="utf-8", recover=True):
-            if elem.tag == f'{node_tag}record':
-                license = {child_elem.tag.replace(node_tag, ""): child_elem.text
-                           for child_elem in elem.getchildren()}
-                yield license
+        prefix_len = len(node_tag)
+        # Поля ищем по полному имени тега, без сборки всей записи
+        predicates = [(f'{node_tag}{field}', predicate) for field, predicate in predicates]
+        total = rejected = 0
 
-                elem.clear()
+        for event, elem in et.iterparse(path, tag=f'{node_tag}record', encoding="utf-8", recover=True):
+            total += 1
+            if not all(predicate(self.child_text(elem, tag)) for tag, predicate in predicates):
+                rejected += 1
+            elif skip:
+                skip -= 1
+            else:
+                yield {child_elem.tag[prefix_len:]: child_elem.text for child_elem in elem}
 
+            elem.clear()
+            # Обработанные записи не копятся в корне документа
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
 
-class RKNResolutionRadioCHF(RKNXMLSource):
-    data_url = '/opendata/7705846236-ResolutionRadioCHF/'
-    node_tag = "{http://rsoc.ru/opendata/7705846236-ResolutionRadioCHF}"
+        if predicates:
+            print(f'load xml: {total} records, {rejected} rejected by pushed-down filters')
 
 
-class RKNLicenses(RKNXMLSource):
-    data_url = '/opendata/7705846236-LicComm/'
-    node_tag = "{http://rsoc.ru/opendata/7705846236-LicComm}"
+class RKNResolutionRadioCHF(RKNXMLSource):
+    dataset = DATASETS['resolutions_radio_chf']
 
 
-def prolongation_resolutions_fetch(start_date: datetime, end_date: datetime):
+class RKNLicenses(RKNXMLSource):
+    dataset = DATASETS['licenses']
+
+
+def crm_cache(name: str, crm_pool: ConnectionPool, field: str = 'inn') -> EnrichmentCache:
+    """ Сохраняемый между запусками кеш, сбрасывается при изменении поля `field` в CRM """
+    return EnrichmentCache(name, maxsize=ENRICHMENT_CACHE_SIZE, persist=True, version=crm_version(crm_pool, field))
+
+
+def pipedrive_cache(name: str) -> EnrichmentCache:
+    return EnrichmentCache(name, maxsize=ENRICHMENT_CACHE_SIZE, ttl=PIPEDRIVE_CACHE_TTL, persist=True)
+
+
+def run_pipeline(source: RKNXMLSource, head: Handler, name: str, postfix: Callable[[], dict], resume: bool = False,
+                 staged: bool = False, queued: bool = False):
+    """
+    Прогоняет записи источника через цепочку, в конце дообрабатывает буферы и
+    закрывает ресурсы. Каждые CHECKPOINT_INTERVAL записей сохраняет чекпоинт,
+    с которого прогон можно продолжить при `resume`.
+    При `staged` парсинг, фильтры, обогащение и запись идут параллельно (StagedRunner).
+    При `queued` запросы обогатителей сначала выполняют воркеры общей очереди (src/workers.py).
+    """
+    checkpoint = Checkpoint(name, CHECKPOINT_INTERVAL)
+    if resume:
+        offset = checkpoint.restore(head)
+    else:
+        checkpoint.remove()
+        offset = 0
+
+    if queued:
+        from src.workers import resolve_enrichment
+        # После restore: чекпоинт подменяет содержимое кешей, а очередь их дополняет
+        resolve_enrichment(lambda: source.get_licenses_from_source(predicates=pushdown_predicates(head)), head,
+                           f'{name}:{datetime.now():%Y-%m-%d}')
+
+    # Смещение чекпоинта считается по записям, прошедшим фильтры из источника
+    items = source.get_licenses_from_source(skip=offset, predicates=pushdown_predicates(head))
+    # Фильтры, которые проверяются в источнике, планировщик не двигает: predicates выше остаются верны
+    head, items = FilterPlanner(source.dataset.name).plan(head, items)
+    if staged:
+        StagedRunner(head, checkpoint=checkpoint).run(items, offset, postfix, name)
+        checkpoint.remove()
+        return
+
+    try:
+        # Счётчики снимает фоновый поток ProgressReporter, цикл только сдвигает count
+        with ProgressReporter(name, postfix, initial=offset) as progress:
+            for offset, item in enumerate(items, start=offset + 1):
+                head.handle(item)
+                progress.count = offset
+                if offset % checkpoint.interval == 0:
+                    checkpoint.save(head, offset)
+            # До остановки репортёра: в финальную строку попадает и то, что лежало в буферах
+            head.flush()
+        checkpoint.remove()
+    finally:
+        head.close()
+
+
+def prolongation_resolutions_fetch(start_date: datetime, end_date: datetime, resume: bool = False,
+                                   staged: bool = False, queued: bool = False):
     source = RKNResolutionRadioCHF()
     date_field = 'valid_to'
 
@@ -111,9 +234,10 @@ def prolongation_resolutions_fetch(start_date: datetime, end_date: datetime):
     range_filter = DateRangeFilter(date_field, start_date, end_date)
     inn_enricher = InnEnricher()
     drop_inn_empty = DropEmptyFilter('inn')
-    ours_enricher = OursEnricher()
+    crm_pool = ConnectionPool(CRM_POOL_SIZE)
+    ours_enricher = OursEnricher(crm_pool, crm_cache('crm_ours', crm_pool))
     ours_filter = BoolFilter('our', True)
-    pipedrive_org_enricher = PipedriveOrganisationsEnricher()
+    pipedrive_org_enricher = PipedriveOrganisationsEnricher(pipedrive_cache('pipedrive_orgs'))
     put_to_store = PutToStore('prolongation_resolutions')
     counter = CounterHandler()
 
@@ -123,6 +247,7 @@ def prolongation_resolutions_fetch(start_date: datetime, end_date: datetime):
             .set_next(range_filter)
             .set_next(inn_enricher)
             .set_next(drop_inn_empty)
+            .set_next(PrefetchBuffer(ours_enricher))
             .set_next(ours_enricher)
             .set_next(ours_filter)
             .set_next(pipedrive_org_enricher)
@@ -131,13 +256,20 @@ def prolongation_resolutions_fetch(start_date: datetime, end_date: datetime):
             .set_next(counter)
     )
 
-    with tqdm(source.get_licenses_from_source()) as t:
-        for item in t:
-            filter_year.handle(item)
-            t.set_postfix(counter=counter, stored=len(put_to_store.store))
+    with crm_pool:
+        run_pipeline(
+            source, filter_year, put_to_store.filename,
+            lambda: dict(counter=counter.counters, stored=len(put_to_store)),
+            resume=resume, staged=staged, queued=queued
+        )
 
 
-def prolongation_licenses_fetch(start_date: datetime, end_date: datetime, ours: True):
+def prolongation_licenses_fetch(start_date: datetime, end_date: datetime, ours: True, resume: bool = False,
+                                staged: bool = False, partitioned: bool = False, queued: bool = False):
+    """
+    При `partitioned` окно дат не применяется: все записи раскладываются по
+    месяцам `date_end` (PartitionedStore), окно выбирается при generate_csv/push.
+    """
     source = RKNLicenses()
     date_field = 'date_end'
     exclude_service_name = [
@@ -161,12 +293,16 @@ def prolongation_licenses_fetch(start_date: datetime, end_date: datetime, ours:
     exclude_service_name_filter = ValuesFilter('service_name', exclude_service_name)
     exclude_name_filter = ValuesFilter('name', exclude_name, substring_filter=True)
     exclude_not_active = ValuesFilter('lic_status_name', ['недействующая'])
-    range_filter = DateRangeFilter(date_field, start_date, end_date)
     # ours_enricher = OursEnricher()
     ours_enricher = OursEnricherFromCSV()
     ours_filter = BoolFilter('our', ours)
-    pipedrive_org_enricher = PipedriveOrganisationsEnricher()
-    put_to_store = PutToStore(f'prolongation_licenses_{start_date}-{end_date}_{ours}')
+    pipedrive_org_enricher = PipedriveOrganisationsEnricher(pipedrive_cache('pipedrive_orgs'))
+    if partitioned:
+        range_filter = DateRangeFilter(date_field, None, None)
+        put_to_store = PartitionedStore(f'prolongation_licenses_partitioned_{ours}', date_field)
+    else:
+        range_filter = DateRangeFilter(date_field, start_date, end_date)
+        put_to_store = PutToStore(f'prolongation_licenses_{start_date}-{end_date}_{ours}')
     counter = CounterHandler()
 
     (
@@ -186,17 +322,21 @@ def prolongation_licenses_fetch(start_date: datetime, end_date: datetime, ours:
             .set_next(counter)
     )
 
-    with tqdm(source.get_licenses_from_source()) as t:
-        for item in t:
-            filter_year.handle(item)
-            t.set_postfix(
-                counter=counter,
-                stored=len(put_to_store.store),
-                not_ours='{:.2f}%'.format(ours_filter.false_percent)
-            )
+    run_pipeline(
+        source, filter_year, put_to_store.filename,
+        lambda: dict(
+            counter=counter.counters,
+            stored=len(put_to_store),
+            not_ours='{:.2f}%'.format(ours_filter.false_percent)
+        ),
+        resume=resume, staged=staged, queued=queued
+    )
 
 
-def commissioning_licenses_fetch(start_date: datetime, end_date: datetime, ours: bool = True):
+def commissioning_licenses_fetch(start_date: datetime, end_date: datetime, ours: bool = True,
+                                 resume: bool = False, staged: bool = False, partitioned: bool = False,
+                                 queued: bool = False):
+    """ `partitioned` — как в prolongation_licenses_fetch, по месяцам `date_service_start` """
     source = RKNLicenses()
     date_field = 'date_service_start'
     exclude_service_name = [
@@ -219,12 +359,17 @@ def commissioning_licenses_fetch(start_date: datetime, end_date: datetime, ours:
     parse_date_start = ParseDatesConverter('date_start')
     exclude_service_name_filter = ValuesFilter('service_name', exclude_service_name)
     exclude_name_filter = ValuesFilter('name', exclude_name, substring_filter=True)
-    range_filter = DateRangeFilter(date_field, start_date, end_date)
     equal_dates_filter = NotEqualFieldsFilter(date_field, 'date_start')
-    ours_enricher = OursEnricher()
+    crm_pool = ConnectionPool(CRM_POOL_SIZE)
+    ours_enricher = OursEnricher(crm_pool, crm_cache('crm_ours', crm_pool))
     ours_filter = BoolFilter('our', ours)
-    pipedrive_org_enricher = PipedriveOrganisationsEnricher()
-    put_to_store = PutToStore(f'commissioning_licenses_{start_date}-{end_date}_{ours}')
+    pipedrive_org_enricher = PipedriveOrganisationsEnricher(pipedrive_cache('pipedrive_orgs'))
+    if partitioned:
+        range_filter = DateRangeFilter(date_field, None, None)
+        put_to_store = PartitionedStore(f'commissioning_licenses_partitioned_{ours}', date_field)
+    else:
+        range_filter = DateRangeFilter(date_field, start_date, end_date)
+        put_to_store = PutToStore(f'commissioning_licenses_{start_date}-{end_date}_{ours}')
     counter = CounterHandler()
 
     (
@@ -235,6 +380,7 @@ def commissioning_licenses_fetch(start_date: datetime, end_date: datetime, ours:
             .set_next(exclude_name_filter)
             .set_next(range_filter)
             .set_next(equal_dates_filter)
+            .set_next(PrefetchBuffer(ours_enricher))
             .set_next(ours_enricher)
             .set_next(ours_filter)
             .set_next(pipedrive_org_enricher)
@@ -243,13 +389,15 @@ def commissioning_licenses_fetch(start_date: datetime, end_date: datetime, ours:
             .set_next(counter)
     )
 
-    with tqdm(source.get_licenses_from_source()) as t:
-        for item in t:
-            filter_year.handle(item)
-            t.set_postfix(counter=counter, stored=len(put_to_store.store))
+    with crm_pool:
+        run_pipeline(
+            source, filter_year, put_to_store.filename,
+            lambda: dict(counter=counter.counters, stored=len(put_to_store)),
+            resume=resume, staged=staged, queued=queued
+        )
 
 
-def special_licenses_fetch():
+def special_licenses_fetch(resume: bool = False, staged: bool = False, queued: bool = False):
     source = RKNLicenses()
     date_field = 'date_end'
     exclude_service_name = [
@@ -270,9 +418,11 @@ def special_licenses_fetch():
     parse_date = ParseDatesConverter(date_field)
     exclude_service_name_filter = ValuesFilter('service_name', exclude_service_name)
     empty_inn_filter = DropEmptyFilter('inn')
-    ours_enricher = OursEnricher()
+    # Оба обогатителя ходят в CRM через один пул
+    crm_pool = ConnectionPool(CRM_POOL_SIZE)
+    ours_enricher = OursEnricher(crm_pool, crm_cache('crm_ours', crm_pool))
     ours_filter = BoolFilter('our', True)
-    crm_tel_enricher = OursFieldEnricher('smsPhone', 'tel')
+    crm_tel_enricher = OursFieldEnricher('smsPhone', 'tel', crm_pool, crm_cache('crm_smsPhone', crm_pool, 'smsPhone'))
     put_to_store = PutToStore('special_licenses')
     counter = CounterHandler()
 
@@ -282,18 +432,62 @@ def special_licenses_fetch():
             .set_next(exclude_service_name_filter)
             .set_next(empty_inn_filter)
             # .set_next(DumbHandler())
+            .set_next(PrefetchBuffer(ours_enricher))
             .set_next(ours_enricher)
             .set_next(ours_filter)
+            .set_next(PrefetchBuffer(crm_tel_enricher))
             .set_next(crm_tel_enricher)
             .set_next(put_to_store)
             .set_next(counter)
     )
 
-    with tqdm(source.get_licenses_from_source()) as t:
-        for item in t:
-            filter_year.handle(item)
-            t.set_postfix(
-                counter=counter,
-                stored=len(put_to_store.store),
+    with crm_pool:
+        run_pipeline(
+            source, filter_year, put_to_store.filename,
+            lambda: dict(
+                counter=counter.counters,
+                stored=len(put_to_store),
                 miss_cache_crm_tel='{:.2f}%'.format(crm_tel_enricher.miss_cache_percent)
-            )
+            ),
+            resume=resume, staged=staged, queued=queued
+        )
+
+
+def registry_fetch(resume: bool = False, staged: bool = False, queued: bool = False):
+    """
+    Весь реестр лицензий, слитый по ИНН, с признаком «наш» — снимок для
+    сервиса (src/service.py). Без фильтров по датам и видам услуг.
+    """
+    source = RKNLicenses()
+    drop_inn_empty = DropEmptyFilter('inn')
+    crm_pool = ConnectionPool(CRM_POOL_SIZE)
+    ours_enricher = OursEnricher(crm_pool, crm_cache('crm_ours', crm_pool))
+    put_to_store = PutToStore('registry')
+    counter = CounterHandler()
+
+    (
+        drop_inn_empty
+            .set_next(PrefetchBuffer(ours_enricher))
+            .set_next(ours_enricher)
+            .set_next(put_to_store)
+            .set_next(counter)
+    )
+
+    with crm_pool:
+        run_pipeline(
+            source, drop_inn_empty, put_to_store.filename,
+            lambda: dict(counter=counter.counters, stored=len(put_to_store)),
+            resume=resume, staged=staged, queued=queued
+        )
+
+
+def archive_ingest(date: str = None):
+    """ Кладёт сегодняшнюю (или за `date`) выгрузку лицензий в историю DumpArchive как есть, без фильтров """
+    from src.utils.archive import DumpArchive
+
+    archive = DumpArchive('licenses')
+    date = date or datetime.now().strftime('%Y-%m-%d')
+    entry = archive.ingest(tqdm(RKNLicenses().get_licenses_from_source()), date)
+    print(f'Archive {archive.name} {date}: {entry["records"]} records, {entry["changes"]} changes, '
+          f'{"base + delta" if entry["base"] and entry["delta"] else "base" if entry["base"] else "delta"}, '
+          f'{archive.disk_usage / 2 ** 20:.1f} MB on disk')
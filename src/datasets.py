@@ -0,0 +1,241 @@
+"""
+Реестр наборов открытых данных РКН: страница набора, пространство имён XML
+и схема полей с типами. Новый набор — новая строка в DATASETS, без
+наследника RKNXMLSource.
+
+`ingest` обновляет несколько наборов сразу: скачивание идёт в потоках
+(DOWNLOAD_THREADS), разбор каждого набора — в отдельном процессе, который
+начинается, как только скачан его архив. Поэтому обновление всех наборов
+занимает примерно столько, сколько самый большой из них.
+
+Результат — типизированный снимок `cached_data/datasets/<набор>/<дата>.pickle.gz`
+(пачки записей, поля по схеме) и рядом `<дата>.json` со статистикой разбора.
+"""
+import gzip
+import json
+import multiprocessing
+import os
+import pickle
+import sys
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from datetime import datetime
+from io import BytesIO
+from pathlib import Path
+from time import perf_counter
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+# Сколько наборов скачивается одновременно
+DOWNLOAD_THREADS = 4
+# Записей в одной пачке снимка
+SNAPSHOT_BATCH = 1000
+
+
+def parse_str(text: str) -> Optional[str]:
+    return text.strip() or None
+
+
+def parse_int(text: str) -> Optional[int]:
+    return int(text.strip())
+
+
+def parse_date(text: str) -> Optional[datetime]:
+    return datetime.strptime(text.strip(), '%Y-%m-%d')
+
+
+FIELD_TYPES: Dict[str, Callable[[str], object]] = {
+    'str': parse_str,
+    'int': parse_int,
+    'date': parse_date,
+}
+
+
+@dataclass
+class Dataset:
+    """
+    :param data_url: страница набора на сайте РКН, с неё берётся ссылка на архив
+    :param namespace: пространство имён тегов XML (`{...}`)
+    :param fields: поле -> тип из FIELD_TYPES
+    """
+    name: str
+    data_url: str
+    namespace: str
+    fields: Dict[str, str] = field(default_factory=dict)
+    description: str = ''
+
+    def convert(self, raw: dict, invalid: Dict[str, int], unknown: set) -> dict:
+        """
+        Запись по схеме: значения приводятся к типам, пустые и битые — None
+        (битые считаются в `invalid`), поля не из схемы собираются в `unknown`.
+        """
+        record = {}
+        for name, type_ in self.fields.items():
+            text = raw.get(name)
+            if text is None:
+                record[name] = None
+                continue
+            try:
+                record[name] = FIELD_TYPES[type_](text) if text.strip() else None
+            except ValueError:
+                invalid[name] = invalid.get(name, 0) + 1
+                record[name] = None
+        unknown.update(raw.keys() - self.fields.keys())
+        return record
+
+
+DATASETS: Dict[str, Dataset] = {dataset.name: dataset for dataset in [
+    Dataset(
+        'licenses', '/opendata/7705846236-LicComm/', '{http://rsoc.ru/opendata/7705846236-LicComm}',
+        {
+            'name': 'str', 'ownership': 'str', 'name_short': 'str', 'addr_legal': 'str', 'inn': 'str',
+            'ogrn': 'str', 'licence_num': 'str', 'lic_status_name': 'str', 'date_start': 'date',
+            'date_service_start': 'date', 'date_end': 'date', 'date_order': 'date', 'service_name': 'str',
+            'territory': 'str', 'num_order': 'str',
+        },
+        'Реестр лицензий в области связи',
+    ),
+    Dataset(
+        'resolutions_radio_chf', '/opendata/7705846236-ResolutionRadioCHF/',
+        '{http://rsoc.ru/opendata/7705846236-ResolutionRadioCHF}',
+        {
+            'owner_name': 'str', 'radio_service': 'str', 'territory': 'str', 'reason_num': 'str',
+            'valid_from': 'date', 'valid_to': 'date',
+        },
+        'Разрешения на использование радиочастот',
+    ),
+]}
+
+
+class DatasetSnapshot:
+    storage_dir = 'cached_data/datasets/'
+
+    def __init__(self, dataset_name: str, date: str = None):
+        self.dataset = DATASETS[dataset_name]
+        self.path = Path(self.storage_dir) / dataset_name
+        self.date = date or self.latest_date()
+
+    def latest_date(self) -> str:
+        dates = [path.name[:-len('.pickle.gz')] for path in self.path.glob('*.pickle.gz')]
+        if not dates:
+            raise FileNotFoundError(f'No snapshot of {self.dataset.name}, run ingest first')
+        return max(dates)
+
+    @property
+    def data_path(self) -> Path:
+        return self.path / f'{self.date}.pickle.gz'
+
+    @property
+    def meta_path(self) -> Path:
+        return self.path / f'{self.date}.json'
+
+    def meta(self) -> dict:
+        return json.loads(self.meta_path.read_text())
+
+    def records(self) -> Iterator[dict]:
+        with gzip.open(self.data_path, 'rb') as f:
+            while True:
+                try:
+                    yield from pickle.load(f)
+                except EOFError:
+                    return
+
+
+def download_dataset(dataset_name: str, session, path: Path) -> dict:
+    """ Находит на странице набора ссылку на архив и скачивает его в `path` (поток) """
+    from src.conveers import RKNXMLSource
+
+    start = perf_counter()
+    source = RKNXMLSource(DATASETS[dataset_name], session=session)
+    link = source.get_xml_link()
+    resp = source.session.get(link, headers=source.headers)
+    resp.raise_for_status()
+    path.write_bytes(resp.content)
+    return {'link': link, 'from_cache': resp.from_cache, 'zip_bytes': len(resp.content),
+            'download_s': round(perf_counter() - start, 2)}
+
+
+def parse_dataset(dataset_name: str, zip_path: str, snapshot_path: str) -> dict:
+    """ Разбирает скачанный архив в типизированный снимок (отдельный процесс), возвращает статистику """
+    from src.conveers import RKNXMLSource
+
+    start = perf_counter()
+    dataset = DATASETS[dataset_name]
+    source = RKNXMLSource(dataset)
+    filedata = source.unpack_zip(Path(zip_path).read_bytes())
+
+    invalid, unknown, records = {}, set(), 0
+    tmp_path = f'{snapshot_path}.tmp'
+    with gzip.open(tmp_path, 'wb', compresslevel=1) as f, BytesIO(filedata) as xmlfile:
+        batch = []
+        for raw in source.load_xml(xmlfile, node_tag=dataset.namespace):
+            batch.append(dataset.convert(raw, invalid, unknown))
+            if len(batch) >= SNAPSHOT_BATCH:
+                pickle.dump(batch, f, protocol=pickle.HIGHEST_PROTOCOL)
+                records += len(batch)
+                batch = []
+        if batch:
+            pickle.dump(batch, f, protocol=pickle.HIGHEST_PROTOCOL)
+            records += len(batch)
+    os.replace(tmp_path, snapshot_path)
+    return {'records': records, 'invalid': invalid, 'unknown_fields': sorted(unknown),
+            'parse_s': round(perf_counter() - start, 2)}
+
+
+def ingest(dataset_names: Iterable[str] = (), date: str = None, workers: int = None) -> List[dict]:
+    """
+    Скачивает и разбирает наборы `dataset_names` (по умолчанию все) в снимки на дату `date`.
+    Ошибка одного набора не останавливает остальные, она попадает в его статистику.
+    """
+    from src.conveers import RKNXMLSource
+
+    names = list(dataset_names) or list(DATASETS)
+    unknown = [name for name in names if name not in DATASETS]
+    if unknown:
+        raise ValueError(f'Unknown datasets: {", ".join(unknown)}; known: {", ".join(DATASETS)}')
+    date = date or datetime.now().strftime('%Y-%m-%d')
+    # Один HTTP-кеш на все потоки: SQLite-бэкенд requests_cache потокобезопасен
+    session = RKNXMLSource().session
+
+    start = perf_counter()
+    results = {name: {'dataset': name, 'date': date} for name in names}
+    with ThreadPoolExecutor(min(DOWNLOAD_THREADS, len(names))) as downloads, \
+            ProcessPoolExecutor(workers or min(len(names), os.cpu_count() or 1),
+                                # fork при работающих потоках скачивания может унести в процесс захваченные ими блокировки
+                                mp_context=multiprocessing.get_context('spawn')) as parsers:
+        paths = {name: DatasetSnapshot(name, date) for name in names}
+        for snapshot in paths.values():
+            snapshot.path.mkdir(parents=True, exist_ok=True)
+
+        downloading = {downloads.submit(download_dataset, name, session, paths[name].path / f'{date}.zip'): name
+                       for name in names}
+        parsing = {}
+        # Разбор набора стартует сразу после его скачивания, не дожидаясь остальных
+        for future in as_completed(downloading):
+            name = downloading[future]
+            try:
+                results[name].update(future.result())
+            except Exception as e:
+                results[name]['error'] = repr(e)
+                continue
+            zip_path = str(paths[name].path / f'{date}.zip')
+            parsing[parsers.submit(parse_dataset, name, zip_path, str(paths[name].data_path))] = name
+
+        for future in as_completed(parsing):
+            name = parsing[future]
+            try:
+                results[name].update(future.result())
+            except Exception as e:
+                results[name]['error'] = repr(e)
+            (paths[name].path / f'{date}.zip').unlink(missing_ok=True)
+            if 'error' not in results[name]:
+                paths[name].meta_path.write_text(json.dumps(results[name], ensure_ascii=False, indent=1))
+
+    for result in results.values():
+        status = result.get('error') or (f'{result["records"]} records, invalid {result["invalid"] or "-"}, '
+                                         f'download {result["download_s"]}s, parse {result["parse_s"]}s')
+        print(f'{result["dataset"]}: {status}', file=sys.stderr)
+        if result.get('unknown_fields'):
+            print(f'{result["dataset"]}: fields not in schema: {", ".join(result["unknown_fields"])}',
+                  file=sys.stderr)
+    print(f'Ingested {len(names)} datasets in {perf_counter() - start:.1f}s', file=sys.stderr)
+    return list(results.values())
@@ -3,19 +3,32 @@ from __future__ import annotations
 import os
 import re
 import shelve
+import zlib
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, asdict
 from datetime import datetime
 from functools import wraps
 from pathlib import Path
 from pprint import pprint
 from time import time
-from typing import Optional, Any, Union
+from typing import Optional, Any, Union, List, Tuple, Callable, Dict, TYPE_CHECKING
 
-import pymysql
 from tqdm import tqdm
 
-from src.utils.pipedrive_client import get_pipedrive_orgs_for_inn, get_pipedrive_org
+from src.utils.cache import EnrichmentCache, MISSING
+from src.utils.group_by import GroupByAccumulator, Combiner, SetUnion
+from src.utils.lookup_index import HashTable, SortedKeySet
+from src.utils.store_index import StoreIndex
+from src.utils.pipedrive_client import get_pipedrive_orgs_for_inn, get_pipedrive_org, search_pipedrive_orgs_for_inn, \
+    org_id_from_search, request_pipedrive_org, org_from_response
+
+if TYPE_CHECKING:
+    from src.utils.db_pool import ConnectionPool
+
+# Размер кеша обогатителя по умолчанию (записей)
+ENRICHMENT_CACHE_SIZE = 500000
+# Сколько ИНН PutToStore держит в памяти, прежде чем сбросить группы на диск
+GROUP_BY_MAX_GROUPS = 200000
 
 
 def _log(message):
@@ -61,6 +74,16 @@ class Handler(ABC):
     def handle(self, item: dict) -> Optional[str]:
         pass
 
+    @abstractmethod
+    def flush(self):
+        """ Дообработать всё, что обработчик накопил в буферах """
+        pass
+
+    @abstractmethod
+    def close(self):
+        """ Освободить ресурсы (соединения, файлы) """
+        pass
+
 
 class AbstractHandler(Handler):
     """
@@ -69,6 +92,18 @@ class AbstractHandler(Handler):
     """
 
     _next_handler: Handler = None
+    # Обработчик ждёт сеть/БД и умеет `prefetch(items)` для пачки записей
+    io_bound = False
+    # Обработчик пишет результат в хранилище
+    is_writer = False
+    # Чистый фильтр: решает только `accepts`, без побочных эффектов и изменения записи.
+    # Такие фильтры, идущие подряд, можно переставлять (FilterPlanner)
+    is_filter = False
+    # Чистый преобразователь: меняет только саму запись в `convert`
+    is_converter = False
+    # Поле записи, по значениям которого обогатитель отвечает через `lookup(keys)`;
+    # такие запросы могут выполнять воркеры общей очереди (src/workers.py)
+    queue_key: Optional[str] = None
 
     def set_next(self, handler: Handler) -> Handler:
         self._next_handler = handler
@@ -79,24 +114,96 @@ class AbstractHandler(Handler):
 
     @abstractmethod
     def handle(self, item: dict) -> Optional[str]:
-        if self._next_handler:
+        if self._next_handler is not None:
             return self._next_handler.handle(item)
 
         return None
 
+    def flush(self):
+        if self._next_handler is not None:
+            self._next_handler.flush()
+
+    def close(self):
+        if self._next_handler is not None:
+            self._next_handler.close()
+
+    def get_state(self) -> Any:
+        """ Состояние для чекпоинта; None — сохранять нечего """
+        return None
+
+    def set_state(self, state: Any):
+        pass
+
+    def pushdown(self) -> Optional[Tuple[str, Callable[[Optional[str]], bool]]]:
+        """
+        (поле, предикат над сырым текстом поля), если фильтр можно проверить в
+        источнике до сборки записи; None — нельзя
+        """
+        return None
+
+    def accepts(self, item: dict) -> bool:
+        """ Пропускает ли фильтр запись (для is_filter) """
+        return True
+
+    def convert(self, item: dict):
+        """ Изменение записи без передачи дальше (для is_converter) """
+        pass
+
+    def describe(self) -> str:
+        """ Имя обработчика с параметрами: для логов и ключа сохранённого плана """
+        return type(self).__name__
+
+
+def chain_handlers(head: Handler) -> List[Handler]:
+    """ Обработчики цепочки по порядку, начиная с `head` """
+    handlers = []
+    handler = head
+    while handler is not None:
+        handlers.append(handler)
+        handler = handler._next_handler
+    return handlers
+
+
+def pushdown_predicates(head: Handler) -> List[Tuple[str, Callable[[Optional[str]], bool]]]:
+    """
+    Предикаты фильтров из начала цепочки. Дальше первого обработчика без
+    `pushdown` не идём: он может менять поля, и сырой текст уже не совпадёт
+    с тем, что увидит фильтр. Сами фильтры остаются в цепочке.
+    """
+    predicates = []
+    for handler in chain_handlers(head):
+        predicate = handler.pushdown()
+        if predicate is None:
+            break
+        predicates.append(predicate)
+    return predicates
+
 
 class StartsWithFilter(AbstractHandler):
+    is_filter = True
+
     def __init__(self, filter_field: str, filter_string: str):
         self.filter_string = filter_string
         self.filter_field = filter_field
 
+    def accepts_value(self, value: Optional[str]) -> bool:
+        return bool(value) and value.startswith(self.filter_string)
+
+    def pushdown(self) -> Tuple[str, Callable[[Optional[str]], bool]]:
+        return self.filter_field, self.accepts_value
+
+    def accepts(self, item: dict) -> bool:
+        return self.accepts_value(item.get(self.filter_field))
+
+    def describe(self) -> str:
+        return f'StartsWithFilter({self.filter_field}, {self.filter_string!r})'
+
     def handle(self, item: dict) -> Optional[str]:
         if self.filter_field not in item.keys():
             print('not valid: empty')
             return
 
-        if (not item[self.filter_field]
-                or not item[self.filter_field].startswith(self.filter_string)):
+        if not self.accepts(item):
             # print(f'not valid starts {item[self.filter_field]}')
             return
 
@@ -104,30 +211,47 @@ class StartsWithFilter(AbstractHandler):
 
 
 class ParseDatesConverter(AbstractHandler):
+    is_converter = True
+
     def __init__(self, date_field: str):
         self.date_field = date_field
 
-    def handle(self, item: dict) -> Optional[str]:
+    def convert(self, item: dict):
         item[self.date_field] = datetime.strptime(item[self.date_field], '%Y-%m-%d')
+
+    def handle(self, item: dict) -> Optional[str]:
+        self.convert(item)
         return super().handle(item)
 
 
 class DateRangeFilter(AbstractHandler):
-    def __init__(self, date_field: str, start: datetime, end: datetime):
+    """ Границы `start`/`end` включительно, None — без ограничения с этой стороны """
+
+    is_filter = True
+
+    def __init__(self, date_field: str, start: Optional[datetime], end: Optional[datetime]):
         self.start = start
         self.end = end
         self.date_field = date_field
 
+    def accepts(self, item: dict) -> bool:
+        date = item[self.date_field]
+        return (isinstance(date, datetime)
+                and (self.start is None or self.start <= date)
+                and (self.end is None or date <= self.end))
+
+    def describe(self) -> str:
+        start, end = (f'{d:%Y-%m-%d}' if d else None for d in (self.start, self.end))
+        return f'DateRangeFilter({self.date_field}, {start}, {end})'
+
     # @simple_time_tracker(_log)
     def handle(self, item: dict) -> Optional[str]:
         # TODO: may be raise exception?
-        date = item[self.date_field]
-        if not isinstance(date, datetime):
+        if not isinstance(item[self.date_field], datetime):
             print('===> not datetime')
             return
 
-        in_range = (self.start <= date <= self.end)
-        if not in_range:
+        if not self.accepts(item):
             # print(f'==> not in range {self.start} <= {date} <= {self.end}')
             return
 
@@ -135,16 +259,25 @@ class DateRangeFilter(AbstractHandler):
 
 
 class InnEnricher(AbstractHandler):
-    """ Обогащает данные полем 'inn' по имени организации из РКН """
+    """
+    Обогащает данные полем 'inn' по имени организации из РКН. Словарь
+    собирается в файл (HashTable) один раз на выгрузку лицензий, следующие
+    прогоны и процессы открывают его без разбора XML.
+    """
+    index_name = 'inn_by_name'
 
     def __init__(self):
-        self.inn_dictionary = self.generate_dictionary()
-        print(f"Prepared dictionary with {len(self.inn_dictionary)} inn's")
-
-    def generate_dictionary(self) -> dict:
         from src.conveers import RKNLicenses
 
         source = RKNLicenses()
+        # Ссылка на архив меняется с каждой новой выгрузкой
+        stamp = f'{zlib.crc32(source.get_xml_link().encode()):08x}'
+        self.inn_dictionary = HashTable.open_or_build(
+            self.index_name, stamp, lambda: self.generate_dictionary(source).items())
+        print(f"Prepared dictionary with {len(self.inn_dictionary)} inn's")
+
+    @staticmethod
+    def generate_dictionary(source) -> dict:
         return {
             l['name']: l['inn']
             for l in tqdm(source.get_licenses_from_source())
@@ -155,58 +288,97 @@ class InnEnricher(AbstractHandler):
         item['inn'] = self.inn_dictionary.get(item['owner_name'])
         return super().handle(item)
 
+    def close(self):
+        self.inn_dictionary.close()
+        super().close()
+
 
 class MissCacheMixin:
-    miss_cache_counter = 0
-    cache_counter = 0
+    """ Кеш обогатителя (EnrichmentCache), его статистика и состояние для чекпоинта """
+    cache: EnrichmentCache
 
     @property
     def miss_cache_percent(self) -> float:
-        if not self.cache_counter:
-            return 0
-        return 100 * self.miss_cache_counter / self.cache_counter
+        return self.cache.miss_percent
+
+    def get_state(self) -> Any:
+        return self.cache.get_state()
+
+    def set_state(self, state: Any):
+        self.cache.set_state(state)
 
 
-class OursEnricher(AbstractHandler, MissCacheMixin):
+def default_crm_pool() -> ConnectionPool:
+    # pymysql нужен только обогатителям CRM, отчёты и push его не грузят
+    from src.utils.db_pool import ConnectionPool
+    return ConnectionPool()
+
+
+class OursEnricher(MissCacheMixin, AbstractHandler):
     """ Обогащает данные булевым полем обозначающем наличие в базе CRM """
+    io_bound = True
+    queue_key = 'inn'
 
-    def __init__(self):
-        self.cache = {}
-        self.con = pymysql.connect(
-            host='crm-db', port=3306,
-            user='root', password='root',
-            database='crm'
-            # cursorclass=pymysql.cursors.DictCursor
-        )
+    def __init__(self, pool: ConnectionPool = None, cache: EnrichmentCache = None):
+        # Свой пул закрываем сами, общий — тот, кто его создал
+        self.own_pool = pool is None
+        self.pool = pool or default_crm_pool()
+        self.cache = cache if cache is not None else EnrichmentCache('crm_ours', maxsize=ENRICHMENT_CACHE_SIZE)
+
+    @staticmethod
+    def query(con, inn: str) -> bool:
+        with con.cursor() as cur:
+            cur.execute("SELECT id FROM Organisation WHERE inn = %s", (inn,))
+            return cur.fetchone() is not None
+
+    def lookup(self, inns: List[str]) -> List[bool]:
+        """ Ответы CRM по списку ИНН, параллельно и без кеша (им пользуются и воркеры очереди) """
+        return self.pool.map(self.query, inns)
+
+    def prefetch(self, items: List[dict]):
+        """ Параллельно запрашивает из CRM все ИНН окна, которых нет в кеше """
+        inns = self.cache.missing(item['inn'] for item in items)
+        with self.cache.timed(len(inns)):
+            results = self.lookup(inns)
+        self.cache.update(zip(inns, results))
 
     # @simple_time_tracker(_log)
     def handle(self, item: dict) -> Optional[str]:
         inn = item["inn"]
-        self.cache_counter += 1
-        is_exist = self.cache.get(inn)
+        is_exist = self.cache.get(inn, MISSING)
 
-        if is_exist is None:
-            self.miss_cache_counter += 1
-            with self.con.cursor() as cur:
-                cur.execute("SELECT id FROM Organisation WHERE inn = %s", inn)
-
-                is_exist = cur.fetchone() is not None
-                self.cache[inn] = is_exist
+        if is_exist is MISSING:
+            with self.cache.timed():
+                with self.pool.connection() as con:
+                    is_exist = self.query(con, inn)
+            self.cache[inn] = is_exist
 
         item['our'] = is_exist
         return super().handle(item)
 
-    def __del__(self):
-        print('Close mysql connection')
-        self.con.close()
+    def close(self):
+        self.cache.close()
+        if self.own_pool:
+            self.pool.close()
+        super().close()
 
 
 class OursEnricherFromCSV(AbstractHandler):
+    """
+    Обогащает данные полем 'our' по выгрузке клиентов CRM. ИНН выгрузки
+    собираются в файл (SortedKeySet) один раз на версию CSV.
+    """
     file_path = 'crmdbsync/all_clients.csv'
-    inns = set()
     inn_index = 7
+    index_name = 'crm_csv_inns'
 
     def __init__(self):
+        stat = os.stat(self.file_path)
+        self.inns = SortedKeySet.open_or_build(
+            self.index_name, f'{stat.st_mtime_ns}_{stat.st_size}', self.read_inns)
+        print(f'Find {len(self.inns)} uniq organisations')
+
+    def read_inns(self) -> List[str]:
         print(f'Open file {self.file_path}')
         with open(self.file_path, 'r', encoding='cp1251') as f:
             orgs = f.readlines()
@@ -221,10 +393,7 @@ class OursEnricherFromCSV(AbstractHandler):
         orgs = [org.split('";"') for org in orgs]
 
         inns = [org[self.inn_index] for org in orgs]
-        inns = [re.sub('[^0-9]', '', inn) for inn in inns]
-
-        self.inns = set(inns)
-        print(f'Find {len(self.inns)} uniq organisations')
+        return [re.sub('[^0-9]', '', inn) for inn in inns]
 
     def handle(self, item: dict) -> Optional[str]:
         inn = item["inn"]
@@ -234,86 +403,175 @@ class OursEnricherFromCSV(AbstractHandler):
         item['our'] = is_exist
         return super().handle(item)
 
+    def close(self):
+        self.inns.close()
+        super().close()
+
+
+class OursFieldEnricher(MissCacheMixin, AbstractHandler):
+    io_bound = True
+    queue_key = 'inn'
 
-class OursFieldEnricher(AbstractHandler, MissCacheMixin):
-    def __init__(self, enrich_field: str, put_field: str):
+    def __init__(self, enrich_field: str, put_field: str, pool: ConnectionPool = None,
+                 cache: EnrichmentCache = None):
         self.search_field = enrich_field
         self.put_field = put_field
-        self.cache = {}
-        self.con = pymysql.connect(
-            host='crm-db', port=3306,
-            user='root', password='root',
-            database='crm'
-            # cursorclass=pymysql.cursors.DictCursor
-        )
+        self.own_pool = pool is None
+        self.pool = pool or default_crm_pool()
+        self.cache = cache if cache is not None else EnrichmentCache(
+            f'crm_{enrich_field}', maxsize=ENRICHMENT_CACHE_SIZE)
+
+    def query(self, con, inn: str) -> Any:
+        with con.cursor() as cur:
+            cur.execute(f"SELECT {self.search_field} FROM Organisation WHERE inn = %s", (inn,))
+            # print(cur.description)
+            return cur.fetchone()[0]
+
+    def lookup(self, inns: List[str]) -> List[Any]:
+        return self.pool.map(self.query, inns)
+
+    def prefetch(self, items: List[dict]):
+        inns = self.cache.missing(item['inn'] for item in items)
+        with self.cache.timed(len(inns)):
+            results = self.lookup(inns)
+        self.cache.update(zip(inns, results))
 
     def handle(self, item: dict) -> Optional[str]:
         inn = item["inn"]
-        self.cache_counter += 1
-        exist = self.cache.get(inn)
-
-        if exist is None:
-            self.miss_cache_counter += 1
-            with self.con.cursor() as cur:
-                cur.execute(f"SELECT {self.search_field} FROM Organisation WHERE inn = %s", inn)
+        exist = self.cache.get(inn, MISSING)
 
-                exist = cur.fetchone()[0]
-                # print(cur.description)
-                # print('Exist db:', exist)
-                self.cache[inn] = exist
+        if exist is MISSING:
+            with self.cache.timed():
+                with self.pool.connection() as con:
+                    exist = self.query(con, inn)
+            # print('Exist db:', exist)
+            self.cache[inn] = exist
 
         item[self.put_field] = exist
         return super().handle(item)
 
-    def __del__(self):
-        print('Close mysql connection')
-        self.con.close()
+    def close(self):
+        self.cache.close()
+        if self.own_pool:
+            self.pool.close()
+        super().close()
+
+
+class PrefetchBuffer(AbstractHandler):
+    """
+    Копит окно записей и перед передачей дальше вызывает `prefetch` у
+    обогатителя, чтобы его запросы для всего окна ушли параллельно.
+    Записи передаются дальше в исходном порядке.
+    """
+
+    def __init__(self, enricher: Handler, window: int = 500):
+        self.enricher = enricher
+        self.window = window
+        self.buffer = []
+
+    def handle(self, item: dict) -> Optional[str]:
+        self.buffer.append(item)
+        if len(self.buffer) >= self.window:
+            self.release()
+
+    def release(self):
+        buffer, self.buffer = self.buffer, []
+        self.enricher.prefetch(buffer)
+        for item in buffer:
+            super().handle(item)
+
+    def flush(self):
+        self.release()
+        super().flush()
+
 
+class PipedriveOrganisationsEnricher(MissCacheMixin, AbstractHandler):
+    io_bound = True
+    queue_key = 'inn'
 
-class PipedriveOrganisationsEnricher(AbstractHandler):
-    cache = {}
+    def __init__(self, cache: EnrichmentCache = None):
+        self.cache = cache if cache is not None else EnrichmentCache('pipedrive_orgs', maxsize=ENRICHMENT_CACHE_SIZE)
+
+    @staticmethod
+    def lookup(inns: List[str]) -> List[Optional[int]]:
+        """ Запросы по всем ИНН пачки уходят разом, ответы собираются по порядку """
+        futures = [search_pipedrive_orgs_for_inn(inn) for inn in inns]
+        return [org_id_from_search(future.result()) for future in futures]
+
+    def prefetch(self, items: List[dict]):
+        inns = self.cache.missing(item['inn'] for item in items)
+        with self.cache.timed(len(inns)):
+            self.cache.update(zip(inns, self.lookup(inns)))
 
     # @simple_time_tracker(_log)
     def handle(self, item: dict) -> Optional[str]:
         inn = item['inn']
-        in_cache = inn in self.cache.keys()
-        if not in_cache:
-            org_id = get_pipedrive_orgs_for_inn(inn)
+        org_id = self.cache.get(inn, MISSING)
+        if org_id is MISSING:
+            with self.cache.timed():
+                org_id = get_pipedrive_orgs_for_inn(inn)
             self.cache[inn] = org_id
-        else:
-            org_id = self.cache[inn]
 
         item['pipedrive_org_id'] = org_id
         return super().handle(item)
 
+    def close(self):
+        self.cache.close()
+        super().close()
 
-class PipedriveOrganisationsFieldEnricher(AbstractHandler):
-    cache = {}
 
-    def __init__(self, enrich_field: str, put_field: str):
+class PipedriveOrganisationsFieldEnricher(MissCacheMixin, AbstractHandler):
+    io_bound = True
+
+    def __init__(self, enrich_field: str, put_field: str, cache: EnrichmentCache = None):
         self.search_field = enrich_field
         self.put_field = put_field
+        self.cache = cache if cache is not None else EnrichmentCache(
+            'pipedrive_org_data', maxsize=ENRICHMENT_CACHE_SIZE)
+
+    def prefetch(self, items: List[dict]):
+        org_ids = self.cache.missing(
+            item['pipedrive_org_id'] for item in items if item['pipedrive_org_id']
+        )
+        with self.cache.timed(len(org_ids)):
+            futures = [(org_id, request_pipedrive_org(org_id)) for org_id in org_ids]
+            for org_id, future in futures:
+                self.cache[org_id] = org_from_response(future.result())
 
     def handle(self, item: dict) -> Optional[str]:
         org_id = item['pipedrive_org_id']
         if org_id:
-            in_cache = org_id in self.cache
-            if not in_cache:
-                org_data = get_pipedrive_org(org_id)
+            org_data = self.cache.get(org_id, MISSING)
+            if org_data is MISSING:
+                with self.cache.timed():
+                    org_data = get_pipedrive_org(org_id)
                 self.cache[org_id] = org_data
-            else:
-                org_data = self.cache[org_id]
 
             item[self.put_field] = org_data[self.search_field]
         return super().handle(item)
 
+    def close(self):
+        self.cache.close()
+        super().close()
+
 
 class DropEmptyFilter(AbstractHandler):
+    is_filter = True
+
     def __init__(self, field: str):
         self.field = field
 
+    def pushdown(self) -> Tuple[str, Callable[[Optional[str]], bool]]:
+        return self.field, bool
+
+    def accepts(self, item: dict) -> bool:
+        return not (item.get(self.field) is None or item[self.field] == '')
+
+    def describe(self) -> str:
+        return f'DropEmptyFilter({self.field})'
+
     def handle(self, item: dict) -> Optional[str]:
-        if item.get(self.field) is None or item[self.field] == '':
+        if not self.accepts(item):
             return
         return super().handle(item)
 
@@ -338,80 +596,276 @@ class BoolFilter(AbstractHandler):
             return
         return super().handle(item)
 
+    def get_state(self) -> Any:
+        return self.total_counter, self.false_counter
+
+    def set_state(self, state: Any):
+        self.total_counter, self.false_counter = state
+
 
 class ValuesFilter(AbstractHandler):
+    is_filter = True
+
     def __init__(self, field: str, exclude_values: list, substring_filter=False):
         self.field = field
         self.exclude_values = exclude_values
         self.substring_filter = substring_filter
 
+    def accepts(self, item: dict) -> bool:
+        value = item[self.field]
+        if self.substring_filter:
+            # Пустое поле ничего не содержит: после перестановки фильтров сюда могут дойти и такие записи
+            return value is None or not any(excl_val in value for excl_val in self.exclude_values)
+        return value not in self.exclude_values
+
+    def describe(self) -> str:
+        kind = 'substring' if self.substring_filter else 'exact'
+        values_crc = zlib.crc32('\n'.join(map(str, self.exclude_values)).encode())
+        return f'ValuesFilter({self.field}, {kind}, {len(self.exclude_values)} values {values_crc:08x})'
+
     # @simple_time_tracker(_log)
     def handle(self, item: dict) -> Optional[str]:
-        if self.substring_filter:
-            for excl_val in self.exclude_values:
-                if excl_val in item[self.field]:
-                    return
-        else:
-            if item[self.field] in self.exclude_values:
-                return
+        if not self.accepts(item):
+            return
         return super().handle(item)
 
 
 class NotEqualFieldsFilter(AbstractHandler):
+    is_filter = True
+
     def __init__(self, *fields):
         self.fields = fields
 
-    def handle(self, item: dict) -> Optional[str]:
+    def accepts(self, item: dict) -> bool:
         uniq_vals = {item[x] for x in self.fields}
-        if len(uniq_vals) < len(self.fields):
+        return len(uniq_vals) == len(self.fields)
+
+    def describe(self) -> str:
+        return f'NotEqualFieldsFilter({", ".join(self.fields)})'
+
+    def handle(self, item: dict) -> Optional[str]:
+        if not self.accepts(item):
             return
         return super().handle(item)
 
 
 class PutToStore(AbstractHandler):
+    """
+    Пишет записи в shelve по ИНН, сливая записи с одним ИНН в одну.
+
+    Слияние идёт в памяти (GroupByAccumulator, по полю — свой комбинатор,
+    по умолчанию merge_values), каждый ИНН пишется в хранилище один раз при
+    `close`. На чекпоинте (`flush`) группы из памяти сбрасываются на диск
+    отсортированным прогоном, состояние хранит список прогонов.
+
+    Прогоны (run_pipeline, StagedRunner) делают flush перед close, а при
+    падении — нет. Поэтому close с записями после последнего flush хранилище
+    не трогает: прогоны остаются на диске до `--resume`. Законченное
+    хранилище close отмечает (StoreIndex.mark_done): сервис поиска
+    (src/service.py) подгружает только отмеченные версии.
+    """
     storage_dir = 'cached_data/'
+    is_writer = True
     date = datetime.now().strftime('%Y-%m-%d')
 
-    def __init__(self, filename: str):
+    def __init__(self, filename: str, combiners: Dict[str, Combiner] = None,
+                 max_groups: int = GROUP_BY_MAX_GROUPS):
         self.filename = filename
+        self.combiners = combiners
+        self.max_groups = max_groups
+        self.store: shelve.Shelf = self.open_store()
+        self.groups = self.create_accumulator()
+        self.pending = False
+
+    def open_store(self) -> shelve.Shelf:
         path = self.create_store_path()
-        self.store: shelve.Shelf = shelve.open(path, flag='c', writeback=True)
+        return shelve.open(path, flag='c')
 
     def create_store_path(self) -> str:
         Path(self.storage_dir).mkdir(parents=True, exist_ok=True)
         return os.path.join(self.storage_dir, f'{self.filename}_{self.date}')
 
+    def create_accumulator(self) -> GroupByAccumulator:
+        return GroupByAccumulator(f'{self.create_store_path()}.groups', self.combiners, self.max_groups)
+
     @staticmethod
     def merge_values(stored_item_val: Any, item_val: Any) -> Union[set, Any]:
         """ В этом методе происходит сжатие значений из разных записей с одним ИНН в одну запись """
-        if stored_item_val != item_val and item_val is not None:
-            if not isinstance(stored_item_val, set):
-                stored_item_val = {stored_item_val}
-            stored_item_val.add(item_val)
-        return stored_item_val
-
-    def merge_records(self, item: dict, key: str):
-        """ В этом методе происходит сжатие записей с одним ИНН в одну запись """
-        stored_item = self.store[key]
-        for k in stored_item.keys():
-            if k in item.keys():
-                stored_item[k] = self.merge_values(stored_item[k], item[k])
-        self.store[key] = stored_item
+        return SetUnion().merge(stored_item_val, item_val)
 
     def handle(self, item: dict) -> Optional[str]:
-        key = item['inn']
+        # Копия: следующие обработчики получают запись такой, какой она пришла
+        self.groups.add(item['inn'], dict(item))
+        self.pending = True
+        return super().handle(item)
 
-        is_exist = key in self.store.keys()
-        if not is_exist:
-            self.store[key] = item
-            return super().handle(item)
+    def write_groups(self):
+        """ Пишет накопленные группы в хранилище, сливая с уже лежащими там записями """
+        for key, group in self.groups.groups():
+            if key in self.store:
+                group = self.groups.combine(self.store[key], group)
+            self.store[key] = group
+        self.store.sync()
+        self.groups.clear()
+
+    def flush(self):
+        self.groups.spill()
+        self.pending = False
+        super().flush()
+
+    def close(self):
+        # Повторный close безопасен: после первого групп не остаётся, а close у shelve идемпотентен
+        if self.pending:
+            print(f'Store {self.filename}: closed without flush, groups are kept for resume')
+        elif len(self.groups):
+            self.write_groups()
+        self.store.close()
+        if not self.pending:
+            StoreIndex.mark_done(self.create_store_path())
+        super().close()
+
+    def get_state(self) -> Any:
+        return self.date, self.groups.get_state()
+
+    def set_state(self, state: Any):
+        """ При возобновлении продолжаем писать в хранилище того дня, когда начали, и берём его прогоны """
+        # До прогонов состояние было просто датой
+        date, runs = state if isinstance(state, tuple) else (state, None)
+        if date != self.date:
+            self.store.close()
+            self.date = date
+            self.store = self.open_store()
+            self.groups = self.create_accumulator()
+        self.groups.set_state(runs)
+        self.pending = False
+
+    def __len__(self) -> int:
+        """ Записей в хранилище плюс ещё не записанные группы (оценка сверху до close) """
+        return len(self.store) + len(self.groups)
+
+    def __enter__(self) -> PutToStore:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None and len(self.groups):
+            self.write_groups()
+        self.store.close()
+        if exc_type is None:
+            StoreIndex.mark_done(self.create_store_path())
+
+
+class PartitionedStore(AbstractHandler):
+    """
+    Писатель для прогона без среза по датам: записи без слияния по ИНН
+    раскладываются по месяцам поля `date_field`, по хранилищу на месяц.
+    Любое окно дат потом собирается из нужных месяцев (`materialize`) без
+    повторной загрузки и обогащения.
+
+    Записи хранятся как ИНН -> [(порядковый номер, запись)], номер нужен,
+    чтобы при сборке окна слить записи в том же порядке, что и при обычном
+    прогоне с DateRangeFilter.
+    """
+    storage_dir = 'cached_data/'
+    is_writer = True
+    date = datetime.now().strftime('%Y-%m-%d')
+    month_format = '%Y-%m'
 
-        self.merge_records(item, key)
+    def __init__(self, filename: str, date_field: str, date: str = None):
+        self.filename = filename
+        self.date_field = date_field
+        self.date = date or self.date
+        self.partitions = {}
+        self.seq = 0
+
+    @classmethod
+    def latest(cls, filename: str, date_field: str) -> PartitionedStore:
+        """ Хранилище последней загрузки, а не сегодняшней: окно можно собрать и через несколько дней """
+        prefix = f'{filename}_'
+        dates = [path.name[len(prefix):] for path in Path(cls.storage_dir).glob(f'{prefix}*') if path.is_dir()]
+        if not dates:
+            raise FileNotFoundError(f'No partitioned fetch for {filename}, run fetch with --partitioned first')
+        return cls(filename, date_field, max(dates))
+
+    def create_store_dir(self) -> Path:
+        path = Path(self.storage_dir) / f'{self.filename}_{self.date}'
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def partition(self, month: str) -> shelve.Shelf:
+        shelf = self.partitions.get(month)
+        if shelf is None:
+            path = self.create_store_dir() / month
+            shelf = self.partitions[month] = shelve.open(str(path), flag='c', writeback=True)
+        return shelf
+
+    def months(self) -> List[str]:
+        """ Месяцы, для которых есть хранилища (у dbm на одно хранилище бывает несколько файлов) """
+        names = {path.name[:7] for path in self.create_store_dir().iterdir()}
+        return sorted(name for name in names if re.fullmatch(r'\d{4}-\d{2}', name))
+
+    def handle(self, item: dict) -> Optional[str]:
+        self.seq += 1
+        shelf = self.partition(item[self.date_field].strftime(self.month_format))
+        records = shelf.get(item['inn'])
+        if records is None:
+            shelf[item['inn']] = [(self.seq, item)]
+        else:
+            # writeback: изменённый список попадёт на диск при sync
+            records.append((self.seq, item))
         return super().handle(item)
 
-    def __del__(self):
-        # self.store.sync()
-        self.store.close()
+    def materialize(self, start: Optional[datetime], end: Optional[datetime], target: Handler) -> int:
+        """
+        Прогоняет записи окна [start, end] через DateRangeFilter в `target`
+        (обычно PutToStore, который и сливает их по ИНН). Читает только
+        месяцы, попадающие в окно. Возвращает число прочитанных записей.
+        """
+        first = start.strftime(self.month_format) if start else ''
+        last = end.strftime(self.month_format) if end else '9999-99'
+        months = [month for month in self.months() if first <= month <= last]
+
+        records = []
+        for month in months:
+            # Без writeback: target меняет записи при слиянии, в партиции они должны остаться как были
+            with shelve.open(str(self.create_store_dir() / month), flag='r') as shelf:
+                for inn_records in shelf.values():
+                    records.extend(inn_records)
+        records.sort(key=lambda record: record[0])
+        print(f'Partitions {self.filename}_{self.date}: {len(months)} months, {len(records)} records')
+
+        range_filter = DateRangeFilter(self.date_field, start, end)
+        range_filter.set_next(target)
+        for _, item in tqdm(records):
+            range_filter.handle(item)
+        range_filter.flush()
+        return len(records)
+
+    def __len__(self) -> int:
+        return self.seq
+
+    def flush(self):
+        for shelf in self.partitions.values():
+            shelf.sync()
+        super().flush()
+
+    def close_partitions(self):
+        for shelf in self.partitions.values():
+            shelf.close()
+        self.partitions = {}
+
+    def close(self):
+        self.close_partitions()
+        super().close()
+
+    def get_state(self) -> Any:
+        return self.date, self.seq
+
+    def set_state(self, state: Any):
+        """ При возобновлении пишем в загрузку того дня, когда начали, и продолжаем нумерацию """
+        date, self.seq = state
+        if date != self.date:
+            self.close_partitions()
+            self.date = date
 
 
 class DumbHandler(AbstractHandler):
@@ -441,5 +895,11 @@ class CounterHandler(AbstractHandler):
         #     self.counters.not_found_organisations += 1
         return super().handle(item)
 
+    def get_state(self) -> Any:
+        return asdict(self.counters)
+
+    def set_state(self, state: Any):
+        self.counters = Counters(**state)
+
     def __str__(self):
         return str(self.counters)
@@ -0,0 +1,407 @@
+from __future__ import annotations
+
+import json
+import os
+from copy import deepcopy
+from datetime import datetime
+from itertools import chain, islice
+from queue import Queue, Empty, Full
+from threading import Thread, Event
+from time import sleep, perf_counter, time
+from typing import List, Optional, Callable, Any, Dict, Iterable, Tuple
+
+
+from src.handlers import AbstractHandler, Handler, PrefetchBuffer, chain_handlers
+from src.utils.checkpoint import Checkpoint
+from src.utils.progress import ProgressReporter
+
+# Конец потока записей
+END = None
+# Прогон прерван: стадия выходит без flush, писатель оставляет прогоны для --resume
+ABORTED = object()
+# Сколько первых записей источника идёт на замер фильтров
+PLAN_SAMPLE = 5000
+# Сколько секунд живёт сохранённый план фильтров, потом замер повторяется
+PLAN_TTL = 7 * 24 * 60 * 60
+
+
+class Barrier:
+    """
+    Отметка чекпоинта, идущая по очередям вместе с пачками. Каждая стадия,
+    дойдя до неё, добавляет снимок состояния своих обработчиков, поэтому
+    писатель получает согласованное состояние всей цепочки на момент `offset`.
+    """
+
+    def __init__(self, offset: int):
+        self.offset = offset
+        self.state = {}
+
+
+class StageOutput(AbstractHandler):
+    """ Хвост сегмента: собирает прошедшие записи в пачку для следующей стадии """
+
+    def __init__(self):
+        self.items = []
+
+    def handle(self, item: dict) -> Optional[str]:
+        self.items.append(item)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def take(self) -> List[dict]:
+        items, self.items = self.items, []
+        return items
+
+
+class Stage:
+    def __init__(self, handlers: List[Handler], indexes: dict):
+        self.handlers = handlers
+        self.indexes = indexes
+        self.output = StageOutput()
+
+        for handler, next_handler in zip(handlers, handlers[1:]):
+            handler.set_next(next_handler)
+        handlers[-1].set_next(self.output)
+
+    @property
+    def head(self) -> Handler:
+        return self.handlers[0]
+
+    def process(self, batch: List[dict]) -> List[dict]:
+        if self.head.io_bound:
+            self.head.prefetch(batch)
+        for item in batch:
+            self.head.handle(item)
+        return self.output.take()
+
+    def snapshot(self) -> dict:
+        indexed = ((self.indexes[id(handler)], handler) for handler in self.handlers)
+        return deepcopy(Checkpoint.handlers_state(indexed))
+
+
+class StagedRunner:
+    """
+    Конвейер из потоков: парсер кладёт пачки записей в ограниченную очередь,
+    CPU-фильтры и I/O-обогатители работают каждый в своей стадии (обогатитель
+    запрашивает всю пачку параллельно через `prefetch`), единственный писатель
+    коммитит в хранилище. Ограниченные очереди держат память постоянной, а
+    время прогона приближается к времени самой медленной стадии.
+
+    Цепочка режется перед каждым `io_bound` обработчиком и перед писателем,
+    PrefetchBuffer в этом режиме не нужны и выкидываются.
+    """
+
+    def __init__(self, head: Handler, batch_size: int = 500, queue_size: int = 8,
+                 checkpoint: Checkpoint = None):
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.checkpoint = checkpoint
+        self.abort = Event()
+        self.errors = []
+        self.parsed = 0
+
+        handlers = chain_handlers(head)
+        indexes = {id(handler): index for index, handler in enumerate(handlers)}
+        handlers = [handler for handler in handlers if not isinstance(handler, PrefetchBuffer)]
+        self.stages = [Stage(segment, indexes) for segment in self.split(handlers)]
+
+    @staticmethod
+    def split(handlers: List[Handler]) -> List[List[Handler]]:
+        segments = [[]]
+        writer_found = False
+        for handler in handlers:
+            is_boundary = handler.io_bound or (handler.is_writer and not writer_found)
+            writer_found = writer_found or handler.is_writer
+            if is_boundary and segments[-1]:
+                segments.append([])
+            segments[-1].append(handler)
+        return segments
+
+    def put(self, queue: Queue, message: Any):
+        while not self.abort.is_set():
+            try:
+                queue.put(message, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def get(self, queue: Queue) -> Any:
+        while not self.abort.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                continue
+        return ABORTED
+
+    def guarded(self, target: Callable, *args) -> Thread:
+        def run():
+            try:
+                target(*args)
+            except BaseException as e:
+                self.errors.append(e)
+                self.abort.set()
+
+        thread = Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def parse(self, items, offset: int, outbox: Queue):
+        batch = []
+        for offset, item in enumerate(items, start=offset + 1):
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self.put(outbox, batch)
+                batch = []
+            if self.checkpoint and offset % self.checkpoint.interval == 0:
+                if batch:
+                    self.put(outbox, batch)
+                    batch = []
+                self.put(outbox, Barrier(offset))
+            self.parsed = offset
+            if self.abort.is_set():
+                return
+
+        if batch:
+            self.put(outbox, batch)
+        self.put(outbox, END)
+
+    def run_stage(self, stage: Stage, inbox: Queue, outbox: Optional[Queue]):
+        while True:
+            message = self.get(inbox)
+            if message is ABORTED:
+                return
+
+            if message is END or isinstance(message, Barrier):
+                stage.head.flush()
+                items = stage.output.take()
+                if items and outbox:
+                    self.put(outbox, items)
+
+                if message is END:
+                    if outbox:
+                        self.put(outbox, END)
+                    return
+
+                message.state.update(stage.snapshot())
+                if outbox:
+                    self.put(outbox, message)
+                else:
+                    self.checkpoint.save_state(message.offset, message.state)
+                continue
+
+            items = stage.process(message)
+            if outbox and items:
+                self.put(outbox, items)
+
+    def run(self, items, offset: int, postfix: Callable[[], dict], name: str = 'staged'):
+        queues = [Queue(maxsize=self.queue_size) for _ in self.stages]
+        threads = [self.guarded(self.parse, items, offset, queues[0])]
+        for index, stage in enumerate(self.stages):
+            outbox = queues[index + 1] if index + 1 < len(queues) else None
+            threads.append(self.guarded(self.run_stage, stage, queues[index], outbox))
+
+        print(f'Staged run: {len(self.stages)} stages after parser')
+        try:
+            with ProgressReporter(name, postfix, initial=offset) as progress:
+                while any(thread.is_alive() for thread in threads):
+                    sleep(0.1)
+                    progress.count = self.parsed
+                progress.count = self.parsed
+        except BaseException:
+            self.abort.set()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+            for stage in self.stages:
+                stage.head.close()
+
+        if self.errors:
+            raise self.errors[0]
+
+
+class FilterPlanner:
+    """
+    Переставляет подряд идущие чистые фильтры (`is_filter`) так, чтобы на
+    запись в среднем уходило меньше времени. Остальные обработчики (и
+    преобразователи, и обогатители, и писатель) остаются на своих местах,
+    поэтому позиции обработчиков с состоянием, а с ними и чекпоинты, не меняются.
+
+    Первые `sample_size` записей источника прогоняются (копиями) через начало
+    цепочки из чистых фильтров и преобразователей. Каждый фильтр группы
+    проверяется на всех дошедших до неё записях: стоимость и доля пропущенных.
+    Фильтры сортируются по стоимость / доля отсеянных — при независимых
+    фильтрах такой порядок даёт минимум ожидаемой стоимости. Фильтры в начале
+    цепочки, проверяемые в источнике (`pushdown`), не двигаются: от них зависит
+    смещение чекпоинта. План пишется в лог и сохраняется по набору данных
+    на `ttl` секунд.
+    """
+    storage_path = 'cached_data/filter_plans.json'
+
+    def __init__(self, dataset: str, sample_size: int = PLAN_SAMPLE, ttl: float = PLAN_TTL):
+        self.dataset = dataset
+        self.sample_size = sample_size
+        self.ttl = ttl
+
+    @staticmethod
+    def filter_runs(handlers: List[Handler]) -> List[Tuple[int, int]]:
+        """ Группы фильтров, которые можно переставлять: [start, end) по индексам цепочки, от двух фильтров """
+        runs = []
+        index = 0
+        while index < len(handlers):
+            if not handlers[index].is_filter:
+                index += 1
+                continue
+            start = index
+            while index < len(handlers) and handlers[index].is_filter:
+                index += 1
+            if start == 0:
+                while start < index and handlers[start].pushdown() is not None:
+                    start += 1
+            if index - start >= 2:
+                runs.append((start, index))
+        return runs
+
+    def run_key(self, filters: List[Handler]) -> str:
+        return ' | '.join([self.dataset, *(handler.describe() for handler in filters)])
+
+    def load_plans(self) -> dict:
+        if not os.path.exists(self.storage_path):
+            return {}
+        with open(self.storage_path) as f:
+            return json.load(f)
+
+    def save_plans(self, plans: dict):
+        """ Устаревшие планы выбрасываются: ключ включает границы окна дат, иначе файл только растёт """
+        now = time()
+        plans = {key: plan for key, plan in plans.items() if now - plan.get('created', 0) < self.ttl}
+        tmp_path = f'{self.storage_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(plans, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.storage_path)
+
+    @staticmethod
+    def arrivals(handlers: List[Handler], runs: List[Tuple[int, int]], sample: List[dict]) -> Dict[int, List[dict]]:
+        """
+        Копии записей выборки в том виде, в каком они доходят до каждой группы.
+        Идём только по чистым обработчикам: после первого другого замерять нечем.
+        """
+        starts = {start: end for start, end in runs}
+        arrived = {start: [] for start in starts}
+        for item in sample:
+            item = dict(item)
+            index = 0
+            while index < len(handlers):
+                handler = handlers[index]
+                if index in starts:
+                    arrived[index].append(dict(item))
+                    end = starts[index]
+                    if not all(h.accepts(item) for h in handlers[index:end]):
+                        break
+                    index = end
+                    continue
+                if handler.is_filter:
+                    if not handler.accepts(item):
+                        break
+                elif handler.is_converter:
+                    try:
+                        handler.convert(item)
+                    except (ValueError, TypeError, KeyError):
+                        break
+                else:
+                    break
+                index += 1
+        return arrived
+
+    @staticmethod
+    def measure(filters: List[Handler], items: List[dict]) -> Dict[str, dict]:
+        stats = {}
+        for handler in filters:
+            start = perf_counter()
+            passed = sum(1 for item in items if handler.accepts(item))
+            stats[handler.describe()] = {
+                'cost_us': round(1e6 * (perf_counter() - start) / len(items), 3),
+                'pass_rate': round(passed / len(items), 4),
+            }
+        return stats
+
+    @staticmethod
+    def rank(stat: dict) -> float:
+        rejected = 1 - stat['pass_rate']
+        return stat['cost_us'] / rejected if rejected > 0 else float('inf')
+
+    @staticmethod
+    def expected_cost(order: List[str], stats: Dict[str, dict]) -> float:
+        """ Ожидаемая стоимость группы на запись: фильтр платится, только если до него дошли """
+        cost, reach = 0., 1.
+        for name in order:
+            cost += reach * stats[name]['cost_us']
+            reach *= stats[name]['pass_rate']
+        return cost
+
+    def plan(self, head: Handler, items: Iterable[dict]) -> Tuple[Handler, Iterable[dict]]:
+        """ Переставляет фильтры в цепочке `head`; возвращает её (возможно новую) голову и те же записи """
+        handlers = chain_handlers(head)
+        runs = self.filter_runs(handlers)
+        if not runs:
+            return head, items
+
+        plans = self.load_plans()
+        fresh = {}
+        for start, end in runs:
+            cached = plans.get(self.run_key(handlers[start:end]))
+            if cached and time() - cached['created'] < self.ttl:
+                fresh[start] = cached
+
+        if len(fresh) < len(runs):
+            sample = list(islice(items, self.sample_size))
+            items = chain(sample, items)
+            arrived = self.arrivals(handlers, runs, sample)
+        else:
+            arrived = {}
+
+        new_order = {}
+        for start, end in runs:
+            filters = handlers[start:end]
+            key = self.run_key(filters)
+            if len({handler.describe() for handler in filters}) < len(filters):
+                print(f'Filter plan {key}: filters are not distinguishable, order kept')
+                continue
+            plan = fresh.get(start)
+            source = 'cached'
+            if plan is None:
+                if not arrived.get(start):
+                    print(f'Filter plan {key}: no sample records reach it, order kept')
+                    continue
+                try:
+                    stats = self.measure(filters, arrived[start])
+                except Exception as e:
+                    # Фильтр, падающий на записях, которые до него раньше не доходили, — порядок не трогаем
+                    print(f'Filter plan {key}: measuring failed ({e!r}), order kept')
+                    continue
+                order = sorted(stats, key=lambda name: self.rank(stats[name]))
+                plan = plans[key] = {'order': order, 'stats': stats, 'sample': len(arrived[start]),
+                                     'created': time(), 'created_at': datetime.now().isoformat(timespec='seconds')}
+                source = f'measured on {len(arrived[start])} records'
+
+            by_name = {handler.describe(): handler for handler in filters}
+            new_order[start] = [by_name[name] for name in plan['order']]
+            original = [handler.describe() for handler in filters]
+            print(f'Filter plan {self.dataset} ({source}): {" -> ".join(plan["order"])}; '
+                  f'{self.expected_cost(original, plan["stats"]):.2f} -> '
+                  f'{self.expected_cost(plan["order"], plan["stats"]):.2f} us/record')
+
+        if len(fresh) < len(runs):
+            self.save_plans(plans)
+
+        for start, end in runs:
+            if start not in new_order:
+                continue
+            handlers[start:end] = new_order[start]
+        for handler, next_handler in zip(handlers, handlers[1:]):
+            handler.set_next(next_handler)
+        return handlers[0], items
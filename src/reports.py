@@ -1,11 +1,16 @@
+import json
 import os
 import re
+import sys
+from datetime import datetime
 from pathlib import Path
 from pprint import pprint
+from time import perf_counter
+from typing import Any, Callable
 
 from tqdm import tqdm
 
-from src.handlers import PutToStore
+from src.handlers import PutToStore, PartitionedStore
 from src.utils.pipedrive_client import push_deal, COMISSIONING_STAGE_ID, RESOLUTIONS_STAGE_ID, PROLONGATION_STAGE_ID
 from src.utils.utils import get_earlier_date, set_processor, set_stringer, head
 
@@ -33,53 +38,152 @@ def humanized_header(header: str) -> str:
     return HUMANIZED_FIELDS.get(header, header)
 
 
-def csv_generator(store_name: str):
-    Path('reports/').mkdir(parents=True, exist_ok=True)
+def csv_value(val: Any) -> str:
+    """ Значение поля в ячейке TSV-отчёта: множества через '; ', bool — да/нет, None — пусто """
+    if isinstance(val, set):
+        val = {str(x) for x in val}
+
+    if isinstance(val, (list, set, tuple)):
+        val = list(val)
+        val.sort()
+
+        val = '; '.join(val)
+
+    if val is None or val == 'NULL':
+        val = ''
 
-    store_ = PutToStore(store_name)
-    store = store_.store
+    if isinstance(val, bool):
+        val = 'да' if val else 'нет'
 
-    file = os.path.join('reports/', f'{store_.filename}.csv')
-    with open(file, mode='w') as f:
-        first_rec_key = [x for x in store.keys()][0]
-        headers = store[first_rec_key].keys()
-        humanized_headers = [humanized_header(header) for header in headers]
-        headers_line = '\t'.join(humanized_headers)
-        f.write(headers_line + '\n')
+    val = str(val)
+    return re.sub('\n', ' ', val, re.MULTILINE)
 
-        data = sorted(
-            store.values(),
-            key=lambda _: set_processor(get_earlier_date, _['date_end'])
-        )
-        for rec in tqdm(data):
-            # Sorting values by headers
-            rec_list = [rec.get(k) for k in headers]
-            for index, val in enumerate(rec_list):
-                if isinstance(val, set):
-                    val = {str(x) for x in val}
 
-                if isinstance(val, (list, set, tuple)):
-                    val = list(val)
-                    val.sort()
+def report_fields(store) -> list:
+    """ Поля отчёта по первой записи хранилища """
+    return list(store[next(iter(store.keys()))].keys())
 
-                    val = '; '.join(val)
 
-                if val is None or val == 'NULL':
-                    val = ''
+def header_line(fields: list) -> str:
+    return '\t'.join(humanized_header(field) for field in fields) + '\n'
 
-                if isinstance(val, bool):
-                    val = 'да' if val else 'нет'
 
-                val = str(val)
-                val = re.sub('\n', ' ', val, re.MULTILINE)
+def report_line(rec: dict, fields: list) -> str:
+    # Sorting values by headers
+    return '\t'.join(csv_value(rec.get(k)) for k in fields) + '\n'
 
-                rec_list[index] = val
-            rec_line = '\t'.join(rec_list)
-            f.write(rec_line + '\n')
+
+def sorted_records(store, sort_field: str) -> list:
+    return sorted(
+        store.values(),
+        key=lambda _: set_processor(get_earlier_date, _[sort_field])
+    )
+
+
+def csv_generator(store_name: str, sort_field: str = 'date_end'):
+    Path('reports/').mkdir(parents=True, exist_ok=True)
+
+    with PutToStore(store_name) as store_:
+        store = store_.store
+
+        file = os.path.join('reports/', f'{store_.filename}.csv')
+        with open(file, mode='w') as f:
+            fields = report_fields(store)
+            f.write(header_line(fields))
+
+            for rec in tqdm(sorted_records(store, sort_field)):
+                f.write(report_line(rec, fields))
+
+
+def export_store(store_name: str, date: str = None, output_dir: str = 'reports/', compression: str = 'gzip',
+                 level: int = None, split_rows: int = None) -> dict:
+    """
+    Отчёт по хранилищу последнего fetch (или за `date`) в сжатый файл или
+    части (ReportWriter), строки как у csv_generator. Выполняется в процессе пула export_reports.
+    """
+    import shelve
+    from src.utils.report_writer import ReportWriter
+    from src.utils.store_index import StoreIndex, EXPIRY_FIELDS
+
+    start = perf_counter()
+    date = date or StoreIndex.latest_date(store_name)
+    with shelve.open(os.path.join(PutToStore.storage_dir, f'{store_name}_{date}'), flag='r') as store:
+        fields = report_fields(store) if len(store) else []
+        # Порядок как у *_csv: по самой ранней дате окончания, у разрешений РИЧ это valid_to
+        sort_field = next((field for field in EXPIRY_FIELDS if field in fields), None)
+        records = sorted_records(store, sort_field) if sort_field else list(store.values())
+
+    with ReportWriter(os.path.join(output_dir, store_name), header_line(fields) if fields else '',
+                      compression, level, split_rows) as writer:
+        for rec in records:
+            writer.write(report_line(rec, fields))
+    return {'store': store_name, 'date': date, 'rows': writer.rows, 'parts': writer.parts,
+            'seconds': round(perf_counter() - start, 2)}
+
+
+def export_reports(store_names: list, date: str = None, output_dir: str = 'reports/', compression: str = 'gzip',
+                   level: int = None, split_rows: int = None, workers: int = None) -> list:
+    """
+    Отчёты по нескольким хранилищам разом, по процессу на хранилище (чтение
+    shelve, сортировка и сжатие упираются в CPU). Рядом пишется манифест
+    `export_<дата>.json` с частями, числом строк и размерами. Ошибка одного
+    хранилища не останавливает остальные, она попадает в его результат.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from src.utils.report_writer import check_compression
+
+    check_compression(compression)
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    start = perf_counter()
+    results = {name: {'store': name} for name in store_names}
+    with ProcessPoolExecutor(workers or min(len(store_names), os.cpu_count() or 1)) as pool:
+        futures = {pool.submit(export_store, name, date, output_dir, compression, level, split_rows): name
+                   for name in store_names}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                results[name]['error'] = repr(e)
+                print(f'{name}: {e!r}', file=sys.stderr)
+                continue
+            result = results[name]
+            size = sum(part['bytes'] for part in result['parts'])
+            print(f'{name}: {result["rows"]} rows, {len(result["parts"])} files, {size / 2 ** 20:.1f} MB, '
+                  f'{result["seconds"]}s', file=sys.stderr)
+
+    results = list(results.values())
+    manifest = os.path.join(output_dir, f'export_{datetime.now():%Y-%m-%d}.json')
+    with open(manifest, 'w') as f:
+        json.dump({'compression': compression, 'reports': results}, f, ensure_ascii=False, indent=1)
+    print(f'Exported {len(store_names)} stores in {perf_counter() - start:.1f}s -> {manifest}', file=sys.stderr)
+    return results
+
+
+def materialize_window(partitioned_name: str, date_field: str, store_name: str, start, end):
+    """
+    Собирает окно [start, end] из помесячных партиций последнего `fetch --partitioned`
+    в обычное хранилище `store_name`, которое дальше читают generate_csv и push
+    """
+    with PutToStore(store_name) as store_:
+        store_.store.clear()
+        PartitionedStore.latest(partitioned_name, date_field).materialize(start, end, store_)
+        store_.write_groups()
+        print(f'Store {store_name}: {len(store_)} records')
+
+
+def prolongation_licenses_window(start, end, ours):
+    materialize_window(f'prolongation_licenses_partitioned_{ours}', 'date_end',
+                       f'prolongation_licenses_{start}-{end}_{ours}', start, end)
+
+
+def commissioning_licenses_window(start, end, ours: bool = True):
+    materialize_window(f'commissioning_licenses_partitioned_{ours}', 'date_service_start',
+                       f'commissioning_licenses_{start}-{end}_{ours}', start, end)
 
 
 def prolongation_resolutions_csv(start, end):
-    csv_generator('prolongation_resolutions')
+    csv_generator('prolongation_resolutions', sort_field='valid_to')
 
 
 def prolongation_licenses_csv(start, end, ours):
@@ -94,15 +198,35 @@ def special_licenses_csv():
     csv_generator('special_licenses')
 
 
-def prolongation_resolutions_push(start, end):
+def push_deals(store_name: str, make_deal: Callable[[dict], dict], queued: bool = False) -> list:
+    """
+    Сделка в Pipedrive на каждую запись хранилища, возвращает id сделок.
+    При `queued` сделки отправляют воркеры общей очереди, уже отправленные повторно не уходят.
+    """
+    with PutToStore(store_name) as store_:
+        store = store_.store
+        if queued:
+            run = f'push:{store_name}_{store_.date}'
+            deals = [(f'{run}:{key}', make_deal(rec)) for key, rec in store.items()]
+        else:
+            deal_ids = []
+            for rec in tqdm(store.values()):
+                data = make_deal(rec)
+                # pprint(data)
+                res_data = push_deal(data)
+                deal_ids.append(res_data['data']['id'])
+            return deal_ids
+
+    from src.workers import push_queued
+    return push_queued(run, deals)
+
+
+def prolongation_resolutions_push(start, end, queued: bool = False) -> list:
     """ TODO: Длина полей ограничена, не все номера влазят из `reason_num` """
-    store_ = PutToStore('prolongation_resolutions')
-    store = store_.store
-
-    for rec in tqdm(store.values()):
+    def make_deal(rec: dict) -> dict:
         priority_field = rec['reason_num']
         priority = len(priority_field) if isinstance(priority_field, set) else 1
-        data = {
+        return {
             "title": 'РИЧ ' + rec['owner_name'],
             "org_id": '' if rec['pipedrive_org_id'] is None else rec['pipedrive_org_id'],
             "stage_id": RESOLUTIONS_STAGE_ID,
@@ -113,18 +237,15 @@ def prolongation_resolutions_push(start, end):
             "9f717de3f3f6516b604dac85f84a2d3b3143dd5e": set_processor(set_stringer, rec['reason_num']),
             "754eb6f2cc6c441f9def7920ff3525f4254b71b9": priority
         }
-        # pprint(data)
-        push_deal(data)
 
+    return push_deals('prolongation_resolutions', make_deal, queued)
 
-def commissioning_licenses_push(start, end, ours: bool = True):
-    store_ = PutToStore(f'commissioning_licenses_{start}-{end}_{ours}')
-    store = store_.store
 
-    for rec in tqdm(store.values()):
-        priority_field = rec['licence_numbers']
+def commissioning_licenses_push(start, end, ours: bool = True, queued: bool = False) -> list:
+    def make_deal(rec: dict) -> dict:
+        priority_field = rec['licence_num']
         priority = len(priority_field) if isinstance(priority_field, set) else 1
-        data = {
+        return {
             "title": 'Ввод ' + rec['name'],
             "org_id": '' if rec['pipedrive_org_id'] is None else rec['pipedrive_org_id'],
             "stage_id": COMISSIONING_STAGE_ID,
@@ -132,21 +253,18 @@ def commissioning_licenses_push(start, end, ours: bool = True):
             "aa70bec98d1f7191a451b82b0d3ca4a41197d958": rec['inn'],
             "0839c880bbc29931ae1bc343832bff5c45286114": str(rec['service_name']),
             "b9b8918e32d97ef42975dc1655bd13500b83f0e4": str(rec['territory']),
-            "9f717de3f3f6516b604dac85f84a2d3b3143dd5e": set_processor(set_stringer, rec['licence_numbers']),
+            "9f717de3f3f6516b604dac85f84a2d3b3143dd5e": set_processor(set_stringer, rec['licence_num']),
             "754eb6f2cc6c441f9def7920ff3525f4254b71b9": priority
         }
-        # pprint(data)
-        push_deal(data)
 
+    return push_deals(f'commissioning_licenses_{start}-{end}_{ours}', make_deal, queued)
 
-def prolongation_licenses_push(start, end, ours: bool = True):
-    store_ = PutToStore(f'prolongation_licenses_{start}-{end}_{ours}')
-    store = store_.store
 
-    for rec in tqdm(store.values()):
+def prolongation_licenses_push(start, end, ours: bool = True, queued: bool = False) -> list:
+    def make_deal(rec: dict) -> dict:
         priority_field = rec['licence_num']
         priority = len(priority_field) if isinstance(priority_field, set) else 1
-        data = {
+        return {
             "title": 'Продление ' + set_processor(head, rec['name']),
             "org_id": '' if rec['pipedrive_org_id'] is None else rec['pipedrive_org_id'],
             "stage_id": PROLONGATION_STAGE_ID,
@@ -157,5 +275,133 @@ def prolongation_licenses_push(start, end, ours: bool = True):
             "9f717de3f3f6516b604dac85f84a2d3b3143dd5e": set_processor(set_stringer, rec['licence_num']),
             "754eb6f2cc6c441f9def7920ff3525f4254b71b9": priority
         }
-        # pprint(data)
-        push_deal(data)
+
+    return push_deals(f'prolongation_licenses_{start}-{end}_{ours}', make_deal, queued)
+
+
+def json_value(value: Any) -> Any:
+    if isinstance(value, set):
+        return sorted(json_value(v) for v in value)
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    return value
+
+
+def query_store(store_name: str, date: str = None, limit: int = 50, offset: int = 0, **filters):
+    """ Страница записей хранилища по индексам (StoreIndex) в JSON Lines, итог — в stderr """
+    from src.utils.store_index import StoreIndex
+
+    with StoreIndex(store_name, date) as index:
+        start = perf_counter()
+        total = index.count(**filters)
+        records = index.query(limit, offset, **filters)
+        elapsed_ms = 1000 * (perf_counter() - start)
+
+    for rec in records:
+        print(json.dumps({k: json_value(v) for k, v in rec.items()}, ensure_ascii=False))
+    print(f'{offset + 1}-{offset + len(records)} of {total} ({elapsed_ms:.1f} ms)', file=sys.stderr)
+
+
+def store_label(store_name: str) -> str:
+    """ Короткое имя хранилища для заголовков: без дат и признака «наши» """
+    return re.sub(r'_\d{4}-\d{2}-\d{2}.*$', '', store_name)
+
+
+def join_stores(store_names: list, on: str = 'inn', date: str = None, output: str = None):
+    """
+    Отчёт по организациям, которые есть во всех хранилищах: hash join по ИНН
+    или `pipedrive_org_id` (см. hash_join). Берутся хранилища последнего fetch
+    (или за `date`). Строка — значение ключа и поля каждого хранилища.
+    """
+    import shelve
+    from src.utils.join import hash_join
+    from src.utils.store_index import StoreIndex
+
+    stores = []
+    for store_name in store_names:
+        path = os.path.join(PutToStore.storage_dir, f'{store_name}_{date or StoreIndex.latest_date(store_name)}')
+        stores.append(shelve.open(path, flag='r'))
+
+    try:
+        sizes = [len(store) for store in stores]
+        labels = [store_label(store_name) for store_name in store_names]
+        if len(set(labels)) < len(labels):
+            labels = list(store_names)
+        # Поля каждого хранилища по первой записи, как в csv_generator; ключ соединения — один столбец
+        headers = [[field for field in store[next(iter(store.keys()))].keys() if field != on] if len(store) else []
+                   for store in stores]
+
+        Path('reports/').mkdir(parents=True, exist_ok=True)
+        output = output or os.path.join('reports/', f'join_{on}_{"+".join(labels)}.csv')
+        start, rows = perf_counter(), 0
+        with open(output, mode='w') as f:
+            columns = [humanized_header(on)]
+            for label, fields in zip(labels, headers):
+                columns.extend(f'{label}: {humanized_header(field)}' for field in fields)
+            f.write('\t'.join(columns) + '\n')
+
+            for value, records in hash_join(stores, on):
+                cells = [csv_value(value)]
+                for record, fields in zip(records, headers):
+                    cells.extend(csv_value(record.get(field)) for field in fields)
+                f.write('\t'.join(cells) + '\n')
+                rows += 1
+    finally:
+        for store in stores:
+            store.close()
+
+    sizes = ', '.join(f'{label} {size}' for label, size in zip(labels, sizes))
+    print(f'Join on {on} ({sizes}): {rows} rows in {perf_counter() - start:.1f}s -> {output}', file=sys.stderr)
+
+
+def archive_as_of(date: str, keys=()):
+    """ Состояние реестра лицензий на дату из DumpArchive в JSON Lines """
+    from src.utils.archive import DumpArchive
+
+    start = perf_counter()
+    state = DumpArchive('licenses').as_of(date, keys or None)
+    for key in sorted(state):
+        print(json.dumps(state[key], ensure_ascii=False, default=json_value))
+    print(f'{len(state)} records as of {date} ({1000 * (perf_counter() - start):.0f} ms)', file=sys.stderr)
+
+
+def archive_changes(date_from: str, date_to: str, keys=()):
+    """ Изменения реестра лицензий между датами: added/removed/changed с изменившимися полями """
+    from src.utils.archive import DumpArchive
+
+    start = perf_counter()
+    changes = DumpArchive('licenses').changes(date_from, date_to)
+    for key in sorted(changes):
+        if keys and key not in keys:
+            continue
+        old, new = changes[key]
+        if old is None:
+            line = {'key': key, 'change': 'added', 'record': new}
+        elif new is None:
+            line = {'key': key, 'change': 'removed', 'record': old}
+        else:
+            fields = {field: [old.get(field), new.get(field)] for field in old.keys() | new.keys()
+                      if old.get(field) != new.get(field)}
+            line = {'key': key, 'change': 'changed', 'fields': fields}
+        print(json.dumps(line, ensure_ascii=False, default=json_value))
+    print(f'{len(changes)} changes {date_from} -> {date_to} ({1000 * (perf_counter() - start):.0f} ms)',
+          file=sys.stderr)
+
+
+def archive_info():
+    from src.utils.archive import DumpArchive
+
+    archive = DumpArchive('licenses')
+    for entry in archive.entries:
+        base_mb, delta_mb = entry.get('base_size', 0) / 2 ** 20, entry.get('delta_size', 0) / 2 ** 20
+        print(f'{entry["date"]}  records {entry["records"]:>8}  changes {entry["changes"]:>8}'
+              f'  base {base_mb:7.2f} MB  delta {delta_mb:7.2f} MB')
+    print(f'Total {archive.disk_usage / 2 ** 20:.1f} MB')
+
+
+def schedule_follow_up_tasks(store_name: str, deal_ids: list, start, end):
+    """ Follow-up задачи по запушенным сделкам, разнесённые по интервалу [start, end] """
+    from src.utils.activity_scheduler import ActivityScheduler
+
+    scheduler = ActivityScheduler(store_name, start, end)
+    scheduler.schedule(deal_ids)
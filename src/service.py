@@ -0,0 +1,178 @@
+"""
+Долгоживущий сервис поиска по реестру: снимок хранилища (по умолчанию
+`registry`, см. registry_fetch) один раз загружается в память и отдаётся по
+HTTP/JSON. Когда fetch записывает новый снимок, сервис подгружает его в
+фоне и подменяет целиком, запросы при этом не останавливаются.
+
+    GET  /v1/licensees/<inn>
+    POST /v1/licensees          {"inns": ["7700000014", ...]}
+    GET  /v1/status
+"""
+import json
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Event
+from time import time, perf_counter
+from typing import Dict, List, Optional
+
+from src.reports import json_value
+from src.utils.store_index import StoreIndex
+
+# Больше ИНН в одном пакетном запросе не принимаем
+MAX_BATCH = 10000
+
+
+class RegistrySnapshot:
+    """ Неизменяемый снимок хранилища: ИНН -> запись, готовая к JSON """
+
+    def __init__(self, store_name: str, date: str, signature: str, records: Dict[str, dict]):
+        self.store_name = store_name
+        self.date = date
+        self.signature = signature
+        self.records = records
+        self.loaded_at = time()
+
+    @classmethod
+    def load(cls, store_name: str) -> 'RegistrySnapshot':
+        start = perf_counter()
+        date, signature = cls.current_version(store_name)
+        with StoreIndex(store_name, date) as index:
+            # Отметка старая, а файлы уже другие: хранилище того же дня переписывают
+            if index.signature() != signature:
+                raise RuntimeError(f'Store {store_name}_{date} is being written')
+            records = {inn: {k: json_value(v) for k, v in rec.items()} for inn, rec in index.items()}
+            snapshot = cls(store_name, date, signature, records)
+        print(f'Snapshot {store_name}_{snapshot.date}: {len(records)} INNs in {perf_counter() - start:.1f}s',
+              file=sys.stderr)
+        return snapshot
+
+    @staticmethod
+    def current_version(store_name: str) -> tuple:
+        """ (дата, подпись файлов) последнего законченного хранилища без загрузки записей """
+        return StoreIndex.completed_version(store_name)
+
+    def lookup(self, inn: str) -> dict:
+        inn = str(inn).strip()
+        record = self.records.get(inn)
+        if record is None:
+            return {'inn': inn, 'licensee': False}
+        return {'inn': inn, 'licensee': True, 'our': record.get('our'), 'record': record}
+
+    @property
+    def status(self) -> dict:
+        return {
+            'store': self.store_name,
+            'date': self.date,
+            'inns': len(self.records),
+            'loaded_at': self.loaded_at,
+        }
+
+
+class RegistryService:
+    """
+    :param reload_interval: раз во сколько секунд проверять, не появился ли новый снимок
+    """
+
+    def __init__(self, store_name: str = 'registry', host: str = '127.0.0.1', port: int = 8080,
+                 reload_interval: float = 60.):
+        self.store_name = store_name
+        self.reload_interval = reload_interval
+        self.snapshot = RegistrySnapshot.load(store_name)
+        self.pending_version = None
+        self.stopped = Event()
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        self.reloader = Thread(target=self.watch, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def reload(self) -> bool:
+        """
+        Загружает новый снимок, если он есть; ссылка подменяется одним присваиванием.
+        Версии — только законченные хранилища (см. StoreIndex.completed_version).
+        Хранилища без отметок меняются, пока fetch их пишет, поэтому новую
+        версию берём, только когда она не изменилась за reload_interval.
+        """
+        version = RegistrySnapshot.current_version(self.store_name)
+        if version == (self.snapshot.date, self.snapshot.signature):
+            self.pending_version = None
+            return False
+        if version != self.pending_version:
+            self.pending_version = version
+            return False
+
+        self.snapshot = RegistrySnapshot.load(self.store_name)
+        self.pending_version = None
+        return True
+
+    def watch(self):
+        while not self.stopped.wait(self.reload_interval):
+            try:
+                self.reload()
+            except Exception as e:
+                # Хранилище могут как раз переписывать: оставляем старый снимок до следующей проверки
+                print(f'Reload {self.store_name} failed: {e!r}', file=sys.stderr)
+
+    def serve_forever(self):
+        self.reloader.start()
+        print(f'Serving {self.store_name} on {self.url}', file=sys.stderr)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.stopped.set()
+        self.server.server_close()
+
+    def make_handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, data: dict, status: int = 200):
+                body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def read_inns(self) -> Optional[List[str]]:
+                try:
+                    data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                except ValueError:
+                    return None
+                inns = data.get('inns') if isinstance(data, dict) else None
+                return inns if isinstance(inns, list) else None
+
+            def do_GET(self):
+                # Снимок берём один раз на запрос: подмена посреди ответа его не затронет
+                snapshot = service.snapshot
+                if self.path == '/v1/status':
+                    return self.send_json(snapshot.status)
+                if self.path.startswith('/v1/licensees/'):
+                    return self.send_json(snapshot.lookup(self.path[len('/v1/licensees/'):]))
+                self.send_json({'error': 'not found'}, 404)
+
+            def do_POST(self):
+                snapshot = service.snapshot
+                if self.path != '/v1/licensees':
+                    return self.send_json({'error': 'not found'}, 404)
+
+                inns = self.read_inns()
+                if inns is None:
+                    return self.send_json({'error': 'expected {"inns": [...]}'}, 400)
+                if len(inns) > MAX_BATCH:
+                    return self.send_json({'error': f'at most {MAX_BATCH} inns per request'}, 413)
+                self.send_json({'date': snapshot.date, 'results': [snapshot.lookup(inn) for inn in inns]})
+
+        return Handler
@@ -0,0 +1,164 @@
+import os
+from collections import deque
+from concurrent.futures import wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+from pathlib import Path
+from time import time, sleep
+from typing import Iterable, List, Dict, Optional
+
+from requests_futures.sessions import FuturesSession
+from tqdm import tqdm
+
+from src.utils.pipedrive_client import pipedrive_client, TASK_USER_ID
+
+
+def business_days(start: datetime, end: datetime) -> List[datetime]:
+    """ Рабочие дни (пн-пт) в интервале [start, end] """
+    days = []
+    day = start
+    while day <= end:
+        if day.weekday() < 5:
+            days.append(day)
+        day += timedelta(days=1)
+    return days or [start]
+
+
+class RateLimiter:
+    """
+    Общая для всех запросов пауза по ответам Pipedrive: 429 c `Retry-After`
+    или исчерпанный `X-RateLimit-Remaining`.
+    """
+    default_delay = 2
+
+    def __init__(self):
+        self.resume_at = 0.
+
+    @property
+    def delay(self) -> float:
+        return max(0., self.resume_at - time())
+
+    def update(self, response):
+        headers = response.headers
+        remaining = headers.get('x-ratelimit-remaining')
+        if response.status_code != 429 and remaining != '0':
+            return
+
+        retry_after = headers.get('retry-after') or headers.get('x-ratelimit-reset')
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = self.default_delay
+        self.resume_at = max(self.resume_at, time() + delay)
+
+
+class ActivityScheduler:
+    """
+    Массово создаёт follow-up активности по сделкам для `TASK_USER_ID`,
+    равномерно распределяя их по рабочим дням интервала.
+
+    Запросы идут параллельно (не больше `concurrency` одновременно), с учётом
+    rate limit. Каждая созданная активность пишется в журнал, поэтому
+    повторный запуск продолжает с того места, где остановился прошлый.
+    """
+    storage_dir = 'cached_data/'
+    max_retries = 5
+
+    def __init__(self, journal_name: str, start: datetime, end: datetime, subject: str = 'Связаться с клиентом',
+                 user_id: int = TASK_USER_ID, activity_type: str = 'task', concurrency: int = 8):
+        self.journal_name = journal_name
+        self.start = start
+        self.end = end
+        self.subject = subject
+        self.user_id = user_id
+        self.activity_type = activity_type
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter()
+        self.session = FuturesSession(max_workers=concurrency)
+        self.journal_path = self.create_journal_path()
+
+    def create_journal_path(self) -> str:
+        Path(self.storage_dir).mkdir(parents=True, exist_ok=True)
+        return os.path.join(self.storage_dir, f'activities_{self.journal_name}.journal')
+
+    def load_journal(self) -> Dict[int, Optional[int]]:
+        """ deal_id -> activity_id уже созданных активностей """
+        done = {}
+        if not os.path.exists(self.journal_path):
+            return done
+
+        with open(self.journal_path, 'r') as f:
+            for line in f:
+                deal_id, _, activity_id = line.rstrip('\n').partition('\t')
+                if deal_id:
+                    done[int(deal_id)] = int(activity_id) if activity_id else None
+        return done
+
+    def due_dates(self, deal_ids: Iterable[int]) -> Dict[int, datetime]:
+        """ Детерминированное распределение: при возобновлении даты не съезжают """
+        deal_ids = sorted(set(deal_ids))
+        days = business_days(self.start, self.end)
+        return {
+            deal_id: days[index * len(days) // len(deal_ids)]
+            for index, deal_id in enumerate(deal_ids)
+        }
+
+    def make_task(self, deal_id: int, due_date: datetime) -> dict:
+        return {
+            'subject': self.subject,
+            'type': self.activity_type,
+            'due_date': due_date.strftime('%Y-%m-%d'),
+            'deal_id': deal_id,
+            'user_id': self.user_id,
+        }
+
+    def schedule(self, deal_ids: Iterable[int]) -> Dict[int, Optional[int]]:
+        deal_ids = [deal_id for deal_id in deal_ids if deal_id is not None]
+        done = self.load_journal()
+        if not deal_ids:
+            return done
+
+        due_dates = self.due_dates(deal_ids)
+        pending = deque(
+            (deal_id, due_date, 0)
+            for deal_id, due_date in due_dates.items()
+            if deal_id not in done
+        )
+        print(f'Schedule {len(pending)} activities, {len(done)} already in journal {self.journal_path}')
+
+        in_flight = {}
+        with open(self.journal_path, 'a') as journal, tqdm(total=len(pending)) as t:
+            while pending or in_flight:
+                while pending and len(in_flight) < self.concurrency and not self.rate_limiter.delay:
+                    deal_id, due_date, attempt = pending.popleft()
+                    future = pipedrive_client(
+                        'activities', data=self.make_task(deal_id, due_date), client_session=self.session
+                    )
+                    in_flight[future] = (deal_id, due_date, attempt)
+
+                if not in_flight:
+                    sleep(self.rate_limiter.delay)
+                    continue
+
+                completed, _ = wait(in_flight, timeout=self.rate_limiter.delay or None, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    deal_id, due_date, attempt = in_flight.pop(future)
+                    res = future.result()
+                    self.rate_limiter.update(res)
+
+                    retryable = res.status_code == 429 or res.status_code >= 500
+                    if retryable and attempt < self.max_retries:
+                        pending.append((deal_id, due_date, attempt + 1))
+                        continue
+                    res.raise_for_status()
+
+                    res_data = res.json()
+                    if not res_data['success']:
+                        raise ValueError(res_data)
+
+                    activity_id = (res_data.get('data') or {}).get('id')
+                    journal.write(f'{deal_id}\t{activity_id or ""}\n')
+                    journal.flush()
+                    done[deal_id] = activity_id
+                    t.update()
+
+        return done
@@ -0,0 +1,180 @@
+import gzip
+import json
+import os
+import pickle
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# (запись до, запись после); None — записи не было / не стало
+Change = Tuple[Optional[dict], Optional[dict]]
+
+
+class DumpArchive:
+    """
+    История выгрузок РКН: сжатая база плюс дневные дельты по ключу записи
+    (`licence_num`). Место растёт с числом изменений, а не с днями × размер
+    реестра.
+
+    Каждая загрузка — строка манифеста с дельтой к предыдущей загрузке
+    ({ключ: (было, стало)}). Полная база пишется при первой загрузке и
+    периодически (`rebase_every` дельт или изменения больше `rebase_ratio`
+    базы), чтобы состояние на дату не требовало проигрывать всю историю.
+    Дельта пишется и в дни новой базы, поэтому `changes` читает только дельты.
+    """
+    storage_dir = 'cached_data/archive/'
+
+    def __init__(self, name: str, key_field: str = 'licence_num', rebase_every: int = 30,
+                 rebase_ratio: float = 0.5):
+        self.name = name
+        self.key_field = key_field
+        self.rebase_every = rebase_every
+        self.rebase_ratio = rebase_ratio
+        self.path = Path(self.storage_dir) / name
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.entries: List[dict] = self.load_manifest()
+
+    # --- файлы ---
+
+    def load_manifest(self) -> List[dict]:
+        path = self.path / 'manifest.json'
+        if not path.exists():
+            return []
+        return json.loads(path.read_text())['entries']
+
+    def save_manifest(self):
+        self.replace_file('manifest.json', json.dumps({'entries': self.entries}, indent=1).encode())
+
+    def replace_file(self, filename: str, data: bytes):
+        # Временный файл и подмена: падение посреди записи не портит архив
+        tmp_path = self.path / f'{filename}.tmp'
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, self.path / filename)
+
+    def write(self, filename: str, data) -> int:
+        self.replace_file(filename, gzip.compress(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL), 6))
+        return (self.path / filename).stat().st_size
+
+    def read(self, filename: str):
+        with gzip.open(self.path / filename, 'rb') as f:
+            return pickle.load(f)
+
+    # --- загрузка ---
+
+    @staticmethod
+    def diff(old: Dict[str, dict], new: Dict[str, dict]) -> Dict[str, Change]:
+        delta = {key: (old.get(key), record) for key, record in new.items() if old.get(key) != record}
+        delta.update((key, (record, None)) for key, record in old.items() if key not in new)
+        return delta
+
+    def should_rebase(self, changes: int) -> bool:
+        base_index = self.base_index(len(self.entries) - 1)
+        since_base = self.entries[base_index + 1:]
+        changed = changes + sum(entry['changes'] for entry in since_base)
+        return (len(since_base) + 1 >= self.rebase_every
+                or changed >= self.rebase_ratio * self.entries[base_index]['records'])
+
+    def ingest(self, records: Iterable[dict], date: str) -> dict:
+        """
+        Добавляет выгрузку на дату `date` (YYYY-MM-DD). Повторная загрузка за
+        последнюю дату заменяет её, загрузка задним числом — ошибка.
+        """
+        if self.entries and date < self.entries[-1]['date']:
+            raise ValueError(f'Archive {self.name} already has {self.entries[-1]["date"]}, can not ingest {date}')
+        if self.entries and date == self.entries[-1]['date']:
+            self.drop_last()
+
+        state = {}
+        for record in records:
+            if record.get(self.key_field):
+                state[record[self.key_field]] = record
+
+        entry = {'date': date, 'records': len(state), 'changes': len(state), 'base': None, 'delta': None}
+        if self.entries:
+            delta = self.diff(self.as_of(self.entries[-1]['date']), state)
+            entry['changes'] = len(delta)
+            entry['delta'] = f'delta_{date}.pickle.gz'
+            entry['delta_size'] = self.write(entry['delta'], delta)
+            rebase = self.should_rebase(len(delta))
+        else:
+            rebase = True
+
+        if rebase:
+            entry['base'] = f'base_{date}.pickle.gz'
+            entry['base_size'] = self.write(entry['base'], state)
+
+        self.entries.append(entry)
+        self.save_manifest()
+        return entry
+
+    def drop_last(self):
+        entry = self.entries.pop()
+        for filename in (entry['base'], entry['delta']):
+            if filename:
+                (self.path / filename).unlink(missing_ok=True)
+        self.save_manifest()
+
+    # --- запросы ---
+
+    def last_index(self, date: str) -> int:
+        """ Последняя загрузка не позже `date`, -1 — таких нет """
+        index = -1
+        for i, entry in enumerate(self.entries):
+            if entry['date'] <= date:
+                index = i
+        return index
+
+    def base_index(self, index: int) -> int:
+        while self.entries[index]['base'] is None:
+            index -= 1
+        return index
+
+    def as_of(self, date: str, keys: Iterable[str] = None) -> Dict[str, dict]:
+        """ Состояние реестра на дату (по последней загрузке не позже неё), можно только по `keys` """
+        index = self.last_index(date)
+        if index < 0:
+            return {}
+        if keys is not None:
+            return self.lookup(index, set(keys))
+
+        base_index = self.base_index(index)
+        state = self.read(self.entries[base_index]['base'])
+        for entry in self.entries[base_index + 1:index + 1]:
+            for key, (_, record) in self.read(entry['delta']).items():
+                if record is None:
+                    state.pop(key, None)
+                else:
+                    state[key] = record
+        return state
+
+    def lookup(self, index: int, keys: set) -> Dict[str, dict]:
+        """ Идём по дельтам от даты назад, базу читаем, только если какие-то ключи в них не менялись """
+        found = {}
+        base_index = self.base_index(index)
+        for entry in reversed(self.entries[base_index + 1:index + 1]):
+            delta = self.read(entry['delta'])
+            for key in keys & delta.keys():
+                found[key] = delta[key][1]
+            keys -= delta.keys()
+            if not keys:
+                break
+        if keys:
+            base = self.read(self.entries[base_index]['base'])
+            found.update((key, base[key]) for key in keys if key in base)
+        return {key: record for key, record in found.items() if record is not None}
+
+    def changes(self, date_from: str, date_to: str) -> Dict[str, Change]:
+        """ Чистые изменения между состояниями на `date_from` и `date_to` — только по дельтам """
+        start, end = self.last_index(date_from), self.last_index(date_to)
+        composed = {}
+        for entry in self.entries[start + 1:end + 1]:
+            # У первой загрузки дельты нет: вся её база — добавленные записи
+            delta = self.read(entry['delta']) if entry['delta'] else {
+                key: (None, record) for key, record in self.read(entry['base']).items()
+            }
+            for key, (old, new) in delta.items():
+                composed[key] = (composed[key][0] if key in composed else old, new)
+        return {key: change for key, change in composed.items() if change[0] != change[1]}
+
+    @property
+    def disk_usage(self) -> int:
+        return sum(path.stat().st_size for path in self.path.iterdir())
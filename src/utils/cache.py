@@ -0,0 +1,190 @@
+import os
+import pickle
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from time import time, perf_counter
+from typing import Any, Hashable, Iterable, List, Optional
+
+# Признак отсутствия значения: None — нормальный закешированный ответ
+MISSING = object()
+
+
+class EnrichmentCache:
+    """
+    Кеш обогатителей с ограничением размера, временем жизни записей и единой
+    статистикой.
+
+    Промахом считается обращение к источнику (БД, API) — `timed()` — поэтому
+    статистика одинакова и при поштучных запросах, и при `prefetch`.
+    По умолчанию вытесняет давно не использованные записи (LRU), политику
+    меняют наследованием, см. FIFOCache.
+
+    При `persist` содержимое читается из файла при создании и пишется в
+    `save()`. Если передана `version` (например, версия данных CRM) и она
+    не совпала с сохранённой, старое содержимое выбрасывается.
+    """
+    storage_dir = 'cached_data/'
+
+    def __init__(self, name: str, maxsize: Optional[int] = None, ttl: Optional[float] = None,
+                 persist: bool = False, version: Any = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.persist = persist
+        self.version = version
+        self.entries = OrderedDict()
+        self.requests = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_time = 0.
+
+        if persist:
+            self.load()
+
+    # --- вытеснение ---
+
+    def on_hit(self, key: Hashable):
+        self.entries.move_to_end(key)
+
+    def evict(self):
+        while self.maxsize is not None and len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    # --- доступ ---
+
+    def _lookup(self, key: Hashable) -> Any:
+        entry = self.entries.get(key)
+        if entry is None:
+            return MISSING
+
+        value, stored_at = entry
+        if self.ttl is not None and time() - stored_at > self.ttl:
+            del self.entries[key]
+            return MISSING
+        return value
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        self.requests += 1
+        value = self._lookup(key)
+        if value is MISSING:
+            return default
+
+        self.on_hit(key)
+        return value
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self._lookup(key) is not MISSING
+
+    def __setitem__(self, key: Hashable, value: Any):
+        self.entries[key] = (value, time())
+        self.entries.move_to_end(key)
+        self.evict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def update(self, pairs: Iterable):
+        for key, value in pairs:
+            self[key] = value
+
+    def missing(self, keys: Iterable[Hashable]) -> List[Hashable]:
+        """ Уникальные ключи, которых нет в кеше (без учёта в статистике) """
+        return [key for key in dict.fromkeys(keys) if key not in self]
+
+    @contextmanager
+    def timed(self, loads: int = 1):
+        """ Обращение к источнику за `loads` ключами: промахи и задержка """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.misses += loads
+            self.load_time += perf_counter() - start
+
+    # --- статистика ---
+
+    @property
+    def miss_percent(self) -> float:
+        if not self.requests:
+            return 0
+        return 100 * self.misses / self.requests
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'size': len(self.entries),
+            'requests': self.requests,
+            'hits': max(0, self.requests - self.misses),
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'miss_percent': round(self.miss_percent, 2),
+            'avg_load_ms': round(1000 * self.load_time / self.misses, 3) if self.misses else 0,
+        }
+
+    def __str__(self):
+        return f'{self.name}: {self.stats}'
+
+    # --- состояние и хранение ---
+
+    def get_state(self) -> dict:
+        return {
+            'version': self.version,
+            'entries': self.entries,
+            'requests': self.requests,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'load_time': self.load_time,
+        }
+
+    def set_state(self, state: dict, with_stats: bool = True):
+        if state['version'] != self.version:
+            print(f'Cache {self.name}: version changed {state["version"]} -> {self.version}, invalidate')
+            return
+
+        self.entries = state['entries']
+        self.evict()
+        if with_stats:
+            self.requests = state['requests']
+            self.misses = state['misses']
+            self.evictions = state['evictions']
+            self.load_time = state['load_time']
+
+    def invalidate(self, version: Any = None):
+        self.entries.clear()
+        self.version = version
+
+    def create_cache_path(self) -> str:
+        Path(self.storage_dir).mkdir(parents=True, exist_ok=True)
+        return os.path.join(self.storage_dir, f'cache_{self.name}.pickle')
+
+    def load(self):
+        path = self.create_cache_path()
+        if not os.path.exists(path):
+            return
+
+        with open(path, 'rb') as f:
+            self.set_state(pickle.load(f), with_stats=False)
+        print(f'Cache {self.name}: loaded {len(self.entries)} entries')
+
+    def save(self):
+        if not self.persist:
+            return
+
+        path = self.create_cache_path()
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self.get_state(), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def close(self):
+        print(f'Cache {self}')
+        self.save()
+
+
+class FIFOCache(EnrichmentCache):
+    """ Вытесняет самые старые записи независимо от обращений к ним """
+
+    def on_hit(self, key: Hashable):
+        pass
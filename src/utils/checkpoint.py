@@ -0,0 +1,76 @@
+import os
+import pickle
+from pathlib import Path
+from typing import Iterable, Tuple
+
+from src.handlers import Handler, chain_handlers
+
+
+class Checkpoint:
+    """
+    Периодический снимок прогона цепочки: сколько записей источника уже
+    обработано и состояние обработчиков (кеши обогатителей, счётчики, дата
+    хранилища). Перед снимком буферы цепочки сбрасываются, а хранилище
+    синхронизируется, поэтому после падения достаточно продолжить с `offset`.
+    """
+    storage_dir = 'cached_data/'
+
+    def __init__(self, name: str, interval: int = 20000):
+        self.name = name
+        self.interval = interval
+        self.path = self.create_checkpoint_path()
+
+    def create_checkpoint_path(self) -> str:
+        Path(self.storage_dir).mkdir(parents=True, exist_ok=True)
+        return os.path.join(self.storage_dir, f'{self.name}.checkpoint')
+
+    @staticmethod
+    def state_key(index: int, handler: Handler) -> str:
+        return f'{index}:{type(handler).__name__}'
+
+    @classmethod
+    def handlers_state(cls, indexed_handlers: Iterable[Tuple[int, Handler]]) -> dict:
+        """ Состояние обработчиков по их позиции в исходной цепочке """
+        state = {}
+        for index, handler in indexed_handlers:
+            handler_state = handler.get_state()
+            if handler_state is not None:
+                state[cls.state_key(index, handler)] = handler_state
+        return state
+
+    def save(self, head: Handler, offset: int):
+        head.flush()
+        self.save_state(offset, self.handlers_state(enumerate(chain_handlers(head))))
+
+    def save_state(self, offset: int, state: dict):
+        data = {
+            'offset': offset,
+            'state': state,
+        }
+        # Пишем во временный файл и подменяем, чтобы падение не оставило битый снимок
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    def restore(self, head: Handler) -> int:
+        """ Восстанавливает состояние обработчиков, возвращает offset источника """
+        if not os.path.exists(self.path):
+            print(f'Checkpoint {self.path} not found, start from scratch')
+            return 0
+
+        with open(self.path, 'rb') as f:
+            data = pickle.load(f)
+
+        for index, handler in enumerate(chain_handlers(head)):
+            key = self.state_key(index, handler)
+            if key in data['state']:
+                handler.set_state(data['state'][key])
+
+        print(f'Resume from checkpoint {self.path}: {data["offset"]} records done')
+        return data['offset']
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
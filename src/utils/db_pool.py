@@ -0,0 +1,155 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from queue import LifoQueue, Empty
+from threading import Lock
+from time import time
+from typing import Callable, Iterable, List, Any
+
+import pymysql
+
+CRM_DB = {
+    'host': os.environ.get('CRM_DB_HOST', 'crm-db'),
+    'port': int(os.environ.get('CRM_DB_PORT', 3306)),
+    'user': 'root',
+    'password': 'root',
+    'database': 'crm',
+}
+
+
+# Как часто ждущий свободного соединения проверяет, не освободилось ли место под новое, секунды
+CHECKOUT_POLL = 0.1
+
+
+class ConnectionPool:
+    """
+    Пул соединений с БД CRM.
+
+    Соединения создаются лениво (не больше `size`), перед выдачей проверяются
+    `ping`, если простаивали дольше `health_check_interval`, и закрываются
+    явно в `close()`, а не в `__del__`.
+    """
+    health_check_interval = 30
+
+    def __init__(self, size: int = 1, connect: Callable = pymysql.connect, **connect_kwargs):
+        self.size = size
+        self._connect = connect
+        self._connect_kwargs = connect_kwargs or CRM_DB
+        self._idle = LifoQueue()
+        self._created = 0
+        self._lock = Lock()
+        self._executor = None
+        self.closed = False
+
+    def _checkout(self):
+        while True:
+            if self.closed:
+                raise RuntimeError('Connection pool is closed')
+            try:
+                con, last_used = self._idle.get_nowait()
+            except Empty:
+                with self._lock:
+                    can_create = self._created < self.size
+                    if can_create:
+                        self._created += 1
+                if can_create:
+                    try:
+                        return self._connect(**self._connect_kwargs)
+                    except Exception:
+                        with self._lock:
+                            self._created -= 1
+                        raise
+                # Пул занят. Ждём с таймаутом: _discard освобождает место под новое
+                # соединение, но в очередь ничего не кладёт и ждущих не будит
+                try:
+                    con, last_used = self._idle.get(timeout=CHECKOUT_POLL)
+                except Empty:
+                    continue
+
+            if time() - last_used > self.health_check_interval:
+                try:
+                    con.ping(reconnect=True)
+                except pymysql.Error:
+                    self._discard(con)
+                    continue
+            return con
+
+    def _discard(self, con):
+        with self._lock:
+            self._created -= 1
+        try:
+            con.close()
+        except pymysql.Error:
+            pass
+
+    @contextmanager
+    def connection(self):
+        if self.closed:
+            raise RuntimeError('Connection pool is closed')
+
+        con = self._checkout()
+        healthy = True
+        try:
+            yield con
+        except pymysql.OperationalError:
+            # Соединение могло умереть — в пул не возвращаем
+            healthy = False
+            raise
+        finally:
+            if healthy:
+                self._idle.put((con, time()))
+            else:
+                self._discard(con)
+
+    def map(self, fn: Callable[[Any, Any], Any], args: Iterable) -> List[Any]:
+        """
+        Выполняет `fn(connection, arg)` для каждого аргумента параллельно на
+        соединениях пула. Результаты возвращаются в порядке аргументов.
+        """
+        args = list(args)
+        if self.size == 1 or len(args) < 2:
+            return [self._call(fn, arg) for arg in args]
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.size)
+        return list(self._executor.map(lambda arg: self._call(fn, arg), args))
+
+    def _call(self, fn: Callable, arg: Any) -> Any:
+        with self.connection() as con:
+            return fn(con, arg)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._executor is not None:
+            self._executor.shutdown()
+
+        print(f'Close {self._created} mysql connection(s)')
+        while True:
+            try:
+                con, _ = self._idle.get_nowait()
+            except Empty:
+                break
+            con.close()
+        self._created = 0
+
+    def __enter__(self) -> 'ConnectionPool':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def crm_version(pool: ConnectionPool, field: str = 'inn') -> tuple:
+    """
+    Версия данных CRM для кеша поля `field`: число и max id организаций и
+    контрольная сумма пар (ИНН, значение поля). Меняется и при добавлении или
+    удалении организаций, и при правке поля у существующей. Стоит одного
+    прохода по таблице за прогон.
+    """
+    with pool.connection() as con:
+        with con.cursor() as cur:
+            cur.execute(f"SELECT COUNT(*), MAX(id), BIT_XOR(CRC32(CONCAT_WS('|', inn, {field}))) FROM Organisation")
+            return tuple(cur.fetchone())
@@ -0,0 +1,186 @@
+import heapq
+import os
+import pickle
+import shutil
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+class Combiner:
+    """ Свёртка значений одного поля по всем записям с одним ключом """
+
+    def first(self, value: Any) -> Any:
+        """ Значение из первой записи группы """
+        return value
+
+    def merge(self, stored: Any, value: Any) -> Any:
+        """ Добавляет к свёртке значение из очередной записи """
+        raise NotImplementedError
+
+    def combine(self, stored: Any, other: Any) -> Any:
+        """ Сливает две свёртки: `other` собрана по более поздним записям """
+        return self.merge(stored, other)
+
+
+class SetUnion(Combiner):
+    """ Как PutToStore.merge_values: одинаковые значения остаются скаляром, разные собираются в множество """
+
+    def merge(self, stored: Any, value: Any) -> Any:
+        if stored != value and value is not None:
+            if not isinstance(stored, set):
+                stored = {stored}
+            stored.add(value)
+        return stored
+
+    def combine(self, stored: Any, other: Any) -> Any:
+        for value in (other if isinstance(other, set) else (other,)):
+            stored = self.merge(stored, value)
+        return stored
+
+
+class Earliest(Combiner):
+    """ Самое раннее значение (например, дата окончания), None не учитывается """
+
+    def merge(self, stored: Any, value: Any) -> Any:
+        if stored is None or (value is not None and value < stored):
+            return value
+        return stored
+
+
+class Count(Combiner):
+    """
+    Число разных записей в группе, различаемых по полю `id_field` (например,
+    licence_num); поля `Count` в записях нет. Свёртка — множество id, а не
+    счётчик: запись, пришедшая повторно (после чекпоинта или при повторном
+    fetch в хранилище того же дня), второй раз не считается. Число — len().
+    Записи без id считаются вместе как одна.
+    """
+
+    def __init__(self, id_field: str):
+        self.id_field = id_field
+
+    def first(self, value: Any) -> set:
+        return {value}
+
+    def merge(self, stored: set, value: Any) -> set:
+        stored.add(value)
+        return stored
+
+    def combine(self, stored: set, other: set) -> set:
+        stored |= other
+        return stored
+
+
+class GroupByAccumulator:
+    """
+    Группировка записей по ключу в памяти: на каждую группу одна запись, поля
+    которой свёрнуты комбинаторами (по умолчанию SetUnion). Поля берутся из
+    первой записи группы, поле `Count` добавляется всегда.
+
+    Когда групп в памяти больше `max_groups`, они сортируются по ключу и
+    сбрасываются на диск отдельным прогоном (`spill`). `groups()` сливает
+    прогоны и память слиянием отсортированных потоков, так что каждая группа
+    выходит один раз и целиком, а памяти нужно не больше `max_groups` групп.
+    """
+
+    def __init__(self, spill_dir: str, combiners: Dict[str, Combiner] = None, max_groups: int = 200000):
+        self.spill_dir = Path(spill_dir)
+        self.combiners = combiners or {}
+        self.max_groups = max_groups
+        self.default = SetUnion()
+        self.memory: Dict[str, dict] = {}
+        # Прогоны на диске: (файл, число групп), в порядке записи
+        self.runs: List[Tuple[str, int]] = []
+
+    def __len__(self) -> int:
+        """ Число групп сверху: одна группа может быть и в памяти, и в нескольких прогонах """
+        return len(self.memory) + sum(size for _, size in self.runs)
+
+    def combiner(self, field: str) -> Combiner:
+        return self.combiners.get(field, self.default)
+
+    def new_group(self, item: dict) -> dict:
+        group = {field: self.combiner(field).first(value) for field, value in item.items()}
+        for field, combiner in self.combiners.items():
+            if isinstance(combiner, Count):
+                group[field] = combiner.first(item.get(combiner.id_field))
+        return group
+
+    def add(self, key: str, item: dict):
+        group = self.memory.get(key)
+        if group is None:
+            self.memory[key] = self.new_group(item)
+            if len(self.memory) >= self.max_groups:
+                self.spill()
+            return
+
+        for field in group.keys():
+            combiner = self.combiner(field)
+            if isinstance(combiner, Count):
+                group[field] = combiner.merge(group[field], item.get(combiner.id_field))
+            elif field in item:
+                group[field] = combiner.merge(group[field], item[field])
+
+    def combine(self, group: dict, other: dict) -> dict:
+        """ Сливает группу из более позднего прогона в более раннюю """
+        for field in group.keys():
+            if field in other:
+                group[field] = self.combiner(field).combine(group[field], other[field])
+        return group
+
+    def spill(self):
+        """ Сбрасывает группы из памяти на диск отсортированным прогоном """
+        if not self.memory:
+            return
+        self.spill_dir.mkdir(parents=True, exist_ok=True)
+        path = self.spill_dir / f'run_{len(self.runs):05}.pickle'
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            for key in sorted(self.memory):
+                pickle.dump((key, self.memory[key]), f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self.runs.append((str(path), len(self.memory)))
+        self.memory = {}
+
+    @staticmethod
+    def read_run(path: str) -> Iterator[Tuple[str, dict]]:
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    def groups(self) -> Iterator[Tuple[str, dict]]:
+        """ Группы по возрастанию ключа, каждая ровно один раз """
+        streams = [self.read_run(path) for path, _ in self.runs]
+        streams.append((key, self.memory[key]) for key in sorted(self.memory))
+        # heapq.merge устойчив: при равных ключах раньше идут более ранние прогоны
+        current_key, current = None, None
+        for key, group in heapq.merge(*streams, key=lambda pair: pair[0]):
+            if key == current_key:
+                current = self.combine(current, group)
+                continue
+            if current_key is not None:
+                yield current_key, current
+            current_key, current = key, group
+        if current_key is not None:
+            yield current_key, current
+
+    def clear(self):
+        self.memory = {}
+        self.runs = []
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def get_state(self) -> List[Tuple[str, int]]:
+        return list(self.runs)
+
+    def set_state(self, runs: Optional[List[Tuple[str, int]]]):
+        """
+        Прогоны на момент чекпоинта. Записанные после него лишние прогоны
+        забываются (их группы придут снова), а пропавшие уже слиты в хранилище.
+        """
+        self.memory = {}
+        self.runs = [(path, size) for path, size in runs or () if os.path.exists(path)]
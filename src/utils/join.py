@@ -0,0 +1,48 @@
+from itertools import product
+from typing import Any, Dict, Iterator, List, Mapping, Tuple
+
+from tqdm import tqdm
+
+from src.utils.store_index import as_values
+
+
+def build_table(store: Mapping[str, dict], on: str) -> Dict[Any, List[dict]]:
+    """ Значение поля `on` -> записи с ним; множество значений после слияния даёт по строке на каждое """
+    table = {}
+    for record in store.values():
+        for value in as_values(record.get(on)):
+            table.setdefault(value, []).append(record)
+    return table
+
+
+def hash_join(stores: List[Mapping[str, dict]], on: str = 'inn') -> Iterator[Tuple[Any, Tuple[dict, ...]]]:
+    """
+    Внутреннее соединение хранилищ по полю `on`: (значение, записи в порядке `stores`).
+
+    Все хранилища, кроме самого большого, загружаются в хеш-таблицы, а самое
+    большое читается с диска один раз. Таблицы проверяются от меньшей к
+    большей, так что запись без пары отсеивается на первой же из них.
+    """
+    probe_index = max(range(len(stores)), key=lambda i: len(stores[i]))
+    tables = {i: build_table(store, on) for i, store in enumerate(stores) if i != probe_index}
+    order = sorted(tables, key=lambda i: len(tables[i]))
+
+    for record in tqdm(stores[probe_index].values(), total=len(stores[probe_index])):
+        values = as_values(record.get(on))
+        # Одна и та же пара может найтись по нескольким значениям из множества
+        seen = set() if len(values) > 1 else None
+        for value in values:
+            matches = {}
+            for i in order:
+                matches[i] = tables[i].get(value)
+                if matches[i] is None:
+                    break
+            else:
+                matches[probe_index] = [record]
+                for row in product(*(matches[i] for i in range(len(stores)))):
+                    if seen is not None:
+                        row_id = tuple(map(id, row))
+                        if row_id in seen:
+                            continue
+                        seen.add(row_id)
+                    yield value, row
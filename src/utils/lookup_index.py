@@ -0,0 +1,184 @@
+"""
+Неизменяемые справочники для обогатителей в файлах, которые читаются через
+mmap без разбора и распаковки: процессы и прогоны на одной машине делят одни
+и те же страницы файла в page cache, а открытие не зависит от размера.
+
+* SortedKeySet — отсортированный массив uint64 из ИНН выгрузки CRM,
+  проверка вхождения двоичным поиском;
+* HashTable — строка -> строка (наименование -> ИНН), открытая адресация
+  с линейным пробированием по crc32, таблица заполнена не больше чем наполовину.
+
+Файл собирается один раз на версию источника (`open_or_build`), пишется во
+временный и подменяется, так что читатели видят либо старый файл, либо новый.
+"""
+import mmap
+import os
+import struct
+import zlib
+from bisect import bisect_left
+from pathlib import Path
+from typing import Callable, Iterable, Optional, Tuple
+
+INDEX_DIR = 'cached_data/indexes/'
+
+KEYS_HEADER = struct.Struct('<8sQ')
+KEYS_MAGIC = b'RKNKEYS2'
+# Ключ SortedKeySet короче стольких цифр: с ведущей единицей он помещается в uint64
+DIGIT_KEY_MAX = 19
+HASH_HEADER = struct.Struct('<8sQQ')
+HASH_MAGIC = b'RKNHASH1'
+# Длина ключа и значения перед их байтами в области данных HashTable
+ENTRY = struct.Struct('<II')
+
+
+def write_atomic(path: str, chunks: Iterable[bytes]):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(tmp_path, path)
+
+
+class MappedFile:
+    suffix = ''
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self.mm.close()
+
+    @classmethod
+    def open_or_build(cls, name: str, stamp: str, items: Callable[[], Iterable]):
+        """
+        Справочник `name` для версии источника `stamp` (например, mtime файла
+        или дата выгрузки): готовый файл открывается, иначе собирается из
+        `items()`. Файлы прошлых версий удаляются.
+        """
+        Path(INDEX_DIR).mkdir(parents=True, exist_ok=True)
+        path = os.path.join(INDEX_DIR, f'{name}_{stamp}{cls.suffix}')
+        if not os.path.exists(path):
+            cls.build(path, items())
+            # Удалённый файл остаётся доступен процессам, которые его уже открыли
+            for old in Path(INDEX_DIR).glob(f'{name}_*{cls.suffix}'):
+                if str(old) != path:
+                    old.unlink(missing_ok=True)
+        return cls(path)
+
+    @classmethod
+    def build(cls, path: str, items: Iterable):
+        raise NotImplementedError
+
+
+def digit_key(key) -> Optional[int]:
+    """ Строка цифр как число; ведущая единица сохраняет ведущие нули и пустую строку """
+    if isinstance(key, str) and len(key) < DIGIT_KEY_MAX and key.isascii() and (not key or key.isdigit()):
+        return int('1' + key)
+
+
+class SortedKeySet(MappedFile):
+    """ Множество строк из цифр (ИНН) — отсортированный массив uint64, bisect идёт прямо по mmap """
+    suffix = '.keys'
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        magic, count = KEYS_HEADER.unpack_from(self.mm)
+        if magic != KEYS_MAGIC:
+            raise ValueError(f'{path} is not a key set')
+        self.keys = memoryview(self.mm)[KEYS_HEADER.size:KEYS_HEADER.size + 8 * count].cast('Q')
+
+    @classmethod
+    def build(cls, path: str, keys: Iterable[str]):
+        """
+        Ключи, которые не помещаются в uint64 (грязные строки выгрузки, например
+        два ИНН подряд), пропускаются: настоящим ИНН они не совпадут
+        """
+        encoded = set()
+        skipped = 0
+        for key in keys:
+            value = digit_key(key)
+            if value is None:
+                skipped += 1
+                continue
+            encoded.add(value)
+        if skipped:
+            print(f'Key set {path}: skipped {skipped} keys that are not strings of up to {DIGIT_KEY_MAX - 1} digits')
+        write_atomic(path, [KEYS_HEADER.pack(KEYS_MAGIC, len(encoded)),
+                            struct.pack(f'<{len(encoded)}Q', *sorted(encoded))])
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key) -> bool:
+        value = digit_key(key)
+        if value is None:
+            return False
+        index = bisect_left(self.keys, value)
+        return index < len(self.keys) and self.keys[index] == value
+
+    def close(self):
+        self.keys.release()
+        super().close()
+
+
+class HashTable(MappedFile):
+    """ Строка -> строка; слоты — смещения записей в области данных (+1, ноль — пустой слот) """
+    suffix = '.hash'
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        magic, self.count, size = HASH_HEADER.unpack_from(self.mm)
+        if magic != HASH_MAGIC:
+            raise ValueError(f'{path} is not a hash table')
+        self.mask = size - 1
+        slots_end = HASH_HEADER.size + 8 * size
+        self.slots = memoryview(self.mm)[HASH_HEADER.size:slots_end].cast('Q')
+        self.data_start = slots_end
+
+    @classmethod
+    def build(cls, path: str, pairs: Iterable[Tuple[str, str]]):
+        entries = {key.encode(): value.encode() for key, value in pairs
+                   if isinstance(key, str) and isinstance(value, str)}
+        size = 1
+        while size < 2 * len(entries):
+            size *= 2
+        mask = size - 1
+
+        slots = [0] * size
+        data = []
+        offset = 0
+        for key, value in entries.items():
+            slot = zlib.crc32(key) & mask
+            while slots[slot]:
+                slot = (slot + 1) & mask
+            slots[slot] = offset + 1
+            entry = ENTRY.pack(len(key), len(value)) + key + value
+            data.append(entry)
+            offset += len(entry)
+        write_atomic(path, [HASH_HEADER.pack(HASH_MAGIC, len(entries), size),
+                            struct.pack(f'<{size}Q', *slots), *data])
+
+    def __len__(self) -> int:
+        return self.count
+
+    def get(self, key, default: Optional[str] = None) -> Optional[str]:
+        if not isinstance(key, str):
+            return default
+        raw = key.encode()
+        slot = zlib.crc32(raw) & self.mask
+        while True:
+            offset = self.slots[slot]
+            if not offset:
+                return default
+            offset += self.data_start - 1
+            key_len, value_len = ENTRY.unpack_from(self.mm, offset)
+            start = offset + ENTRY.size
+            if key_len == len(raw) and self.mm[start:start + key_len] == raw:
+                return self.mm[start + key_len:start + key_len + value_len].decode()
+            slot = (slot + 1) & self.mask
+
+    def close(self):
+        self.slots.release()
+        super().close()
@@ -1,8 +1,18 @@
-from requests_futures.sessions import FuturesSession
+from __future__ import annotations
+
+import os
+from datetime import datetime, timezone
+from threading import Lock
+from typing import TYPE_CHECKING
+
 from tqdm import tqdm
 
-PIPDERIVE_URL="https://api.pipedrive.com"
-API_KEY = None
+if TYPE_CHECKING:
+    from requests_futures.sessions import FuturesSession
+
+# Можно переопределить, например, для запуска против локального fake-сервера
+PIPDERIVE_URL = os.environ.get('PIPEDRIVE_URL', "https://api.pipedrive.com")
+API_KEY = os.environ.get('PIPEDRIVE_API_KEY')
 
 TEST_PIPELINE_ID = 32
 TEST_STAGE_ID = 187
@@ -16,22 +26,37 @@ RESOLUTIONS_STAGE_ID = 198
 PROLONGATION_PIPELINE_ID = 36
 PROLONGATION_STAGE_ID = 208
 
+# Допуск на расхождение часов воркера и Pipedrive при сравнении с add_time, секунды
+DEAL_CLOCK_SKEW = 60
+
 TASK_USER_ID = 0
 TEST_USER_ID = 0
 
-session = FuturesSession()
+_session = None
+_session_lock = Lock()
+
+
+def get_session() -> FuturesSession:
+    """ Общая сессия создаётся при первом запросе: requests не грузится там, где сеть не нужна """
+    global _session
+    with _session_lock:
+        if _session is None:
+            from requests_futures.sessions import FuturesSession
+            _session = FuturesSession()
+        return _session
 
 
-def pipedrive_client(suffix, parameters=None, data=None, delete: bool = False):
+def pipedrive_client(suffix, parameters=None, data=None, delete: bool = False, client_session: FuturesSession = None):
+    client_session = client_session or get_session()
     parameters = parameters or []
     url = "{}/v1/{}".format(PIPDERIVE_URL, suffix)
     params = [('api_token', API_KEY)]
     params = params + parameters
     if data:
-        return session.post(url, params=params, data=data)
+        return client_session.post(url, params=params, data=data)
     if delete:
-        return session.delete(url, params=params)
-    return session.get(url, params=params)
+        return client_session.delete(url, params=params)
+    return client_session.get(url, params=params)
 
 
 def push_deal(deal: dict) -> dict:
@@ -46,6 +71,41 @@ def push_deal(deal: dict) -> dict:
     return res_data
 
 
+def search_deals(title: str, org_id=None):
+    parameters = [('term', title), ('fields', 'title'), ('exact_match', 'true')]
+    if org_id:
+        parameters.append(('organization_id', org_id))
+    return pipedrive_client("deals/search", parameters)
+
+
+def get_deal(deal_id):
+    return pipedrive_client(f"deals/{deal_id}")
+
+
+def deal_added(deal_id) -> float:
+    """ Время создания сделки (add_time в UTC) как timestamp """
+    res = get_deal(deal_id).result()
+    res.raise_for_status()
+    add_time = datetime.fromisoformat(res.json()['data']['add_time'])
+    return add_time.replace(tzinfo=timezone.utc).timestamp()
+
+
+def find_deal(deal: dict, since: float):
+    """
+    id сделки с тем же названием, организацией и этапом, что у `deal`,
+    созданной не раньше `since` (первой попытки её отправить); None — такой
+    нет. Сделки прошлых push той же организации старше и не подходят.
+    """
+    res = search_deals(deal['title'], deal.get('org_id')).result()
+    res.raise_for_status()
+    for found in (res.json().get('data') or {}).get('items') or []:
+        item = found['item']
+        if (item.get('stage') or {}).get('id') != deal['stage_id']:
+            continue
+        if deal_added(item['id']) >= since - DEAL_CLOCK_SKEW:
+            return item['id']
+
+
 def push_task(task: dict) -> dict:
     res = pipedrive_client("activities", data=task)
     res = res.result()
@@ -63,7 +123,7 @@ def get_deals(stage_id):
     return pipedrive_client("deals", parameters)
 
 
-def get_pipedrive_orgs_for_inn(inn):
+def search_pipedrive_orgs_for_inn(inn):
     parameters = [
         ('term', inn),
         ('field_type', 'organizationField'),
@@ -72,8 +132,10 @@ def get_pipedrive_orgs_for_inn(inn):
         ('return_item_ids', '1'), ('start', '0')
     ]
     # print("Resolving inn: {}".format(inn))
-    future = pipedrive_client("itemSearch/field", parameters)
-    res = future.result()
+    return pipedrive_client("itemSearch/field", parameters)
+
+
+def org_id_from_search(res):
     # print("Status: {}".format(res.status_code))
     res.raise_for_status()
     if res.status_code == 200:
@@ -85,6 +147,26 @@ def get_pipedrive_orgs_for_inn(inn):
     # print("Couldn't find organization for inn {}, status_code: {}".format(inn, res.status_code))
 
 
+def get_pipedrive_orgs_for_inn(inn):
+    future = search_pipedrive_orgs_for_inn(inn)
+    return org_id_from_search(future.result())
+
+
+def request_pipedrive_org(id):
+    # print("Resolving inn: {}".format(inn))
+    return pipedrive_client(f"organizations/{id}")
+
+
+def org_from_response(res):
+    # print("Status: {}".format(res.status_code))
+    res.raise_for_status()
+    if res.status_code == 200:
+        data = res.json()['data']
+        # print("Data: {}".format(data))
+        if data:
+            return data
+
+
 def get_pipedrive_org(id):
     """
         {'id': 4008, 'key': 'ba2d5c3d14926f9581c70f23bf4245c925752026', 'name': 'тел. контактн.',
@@ -97,16 +179,8 @@ def get_pipedrive_org(id):
         :param inn:
         :return:
     """
-    # print("Resolving inn: {}".format(inn))
-    future = pipedrive_client(f"organizations/{id}")
-    res = future.result()
-    # print("Status: {}".format(res.status_code))
-    res.raise_for_status()
-    if res.status_code == 200:
-        data = res.json()['data']
-        # print("Data: {}".format(data))
-        if data:
-            return data
+    future = request_pipedrive_org(id)
+    return org_from_response(future.result())
 
 
 def get_deals_for_stage_id_and_delete(stage_id):
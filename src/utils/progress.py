@@ -0,0 +1,109 @@
+"""
+Прогресс прогона без работы на каждую запись: цикл только присваивает
+`progress.count`, а фоновый поток раз в `interval` секунд снимает счётчики
+(`metrics()`) и выводит их в stderr.
+
+Режимы (`--progress` у cli или переменная RKN_PROGRESS):
+    tty   — полоса tqdm, как раньше;
+    plain — строка раз в interval, для cron и логов без терминала;
+    json  — JSON на строку, для планировщика задач;
+    auto  — tty, если stderr — терминал, иначе plain.
+"""
+import json
+import os
+import sys
+from dataclasses import asdict, is_dataclass
+from threading import Thread, Event
+from time import time, perf_counter
+from typing import Callable, Optional
+
+MODES = ('auto', 'tty', 'plain', 'json')
+# Интервал по умолчанию: полосе нужно часто, логам — редко
+INTERVALS = {'tty': 0.5, 'plain': 10., 'json': 10.}
+
+
+def metric_value(value):
+    """ Значение метрики для JSON: датаклассы счётчиков раскрываются в словари """
+    if is_dataclass(value):
+        return asdict(value)
+    if isinstance(value, (int, float, str, bool)) or value is None:
+        return value
+    return str(value)
+
+
+class ProgressReporter:
+    mode = os.environ.get('RKN_PROGRESS', 'auto')
+    interval: Optional[float] = None
+
+    def __init__(self, name: str, metrics: Callable[[], dict] = None, initial: int = 0, mode: str = None,
+                 interval: float = None):
+        self.name = name
+        self.metrics = metrics or dict
+        self.initial = self.count = initial
+        self.mode = self.resolve_mode(mode or self.mode)
+        self.interval = interval or self.interval or INTERVALS[self.mode]
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.bar = None
+        self.started = perf_counter()
+
+    @staticmethod
+    def resolve_mode(mode: str) -> str:
+        if mode not in MODES:
+            raise ValueError(f'Unknown progress mode {mode!r}, expected one of {", ".join(MODES)}')
+        if mode == 'auto':
+            return 'tty' if sys.stderr.isatty() else 'plain'
+        return mode
+
+    def start(self) -> 'ProgressReporter':
+        if self.mode == 'tty':
+            from tqdm import tqdm
+            self.bar = tqdm(initial=self.initial, desc=self.name)
+        self.started = perf_counter()
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self, final: bool = False):
+        count = self.count
+        try:
+            metrics = self.metrics()
+        except Exception as e:
+            # Счётчики читаются из другого потока: неудачный снимок пропускаем, прогон не трогаем
+            metrics = {'metrics_error': repr(e)}
+
+        if self.mode == 'tty':
+            self.bar.set_postfix(metrics, refresh=False)
+            self.bar.update(count - self.bar.n)
+            return
+
+        elapsed = perf_counter() - self.started
+        rate = (count - self.initial) / elapsed if elapsed > 0 else 0.
+        if self.mode == 'json':
+            line = {'name': self.name, 'time': round(time(), 3), 'records': count, 'rate': round(rate, 1),
+                    'elapsed': round(elapsed, 1), 'final': final}
+            line.update((key, metric_value(value)) for key, value in metrics.items())
+            print(json.dumps(line, ensure_ascii=False), file=sys.stderr, flush=True)
+        else:
+            values = ' '.join(f'{key}={value}' for key, value in metrics.items())
+            print(f'{self.name}: {count} records, {rate:.0f}/s, {elapsed:.0f}s {values}'.rstrip(),
+                  file=sys.stderr, flush=True)
+
+    def stop(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.report(final=True)
+        if self.bar is not None:
+            self.bar.close()
+
+    def __enter__(self) -> 'ProgressReporter':
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,225 @@
+import glob
+import os
+import pickle
+import re
+import shelve
+import sqlite3
+import sys
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from src.utils.utils import set_processor, get_earlier_date
+
+# Поля с несколькими значениями (после слияния записей по ИНН — множества)
+INDEXED_FIELDS = ('territory', 'service_name')
+# Поле срока: у лицензий date_end, у разрешений РИЧ valid_to
+EXPIRY_FIELDS = ('date_end', 'valid_to')
+
+# Меняется вместе со схемой, старые индексы тогда перестраиваются
+INDEX_VERSION = 1
+SCHEMA = '''
+DROP TABLE IF EXISTS records;
+DROP TABLE IF EXISTS field_values;
+DROP TABLE IF EXISTS meta;
+CREATE TABLE records (inn TEXT PRIMARY KEY, expires TEXT, our INTEGER, data BLOB);
+CREATE TABLE field_values (field TEXT, value TEXT, inn TEXT);
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+'''
+INDEXES = '''
+CREATE INDEX records_expires ON records (expires, inn);
+CREATE INDEX records_our ON records (our, expires);
+CREATE INDEX field_values_value ON field_values (field, value, inn);
+'''
+
+
+def as_values(value) -> list:
+    if value is None:
+        return []
+    if isinstance(value, (set, list, tuple)):
+        return [v for v in value if v is not None]
+    return [value]
+
+
+class StoreIndex:
+    """
+    Вторичные индексы над хранилищем PutToStore в SQLite-файле рядом с ним
+    (`<хранилище>.index.sqlite`): ИНН, территория, вид услуг, признак «наш»
+    и самая ранняя дата окончания (`date_end`/`valid_to`).
+
+    Индекс строится одним проходом по хранилищу и перестраивается, только если
+    файлы хранилища изменились. Рядом с ключами лежит и сама запись: открытие
+    shelve (особенно dbm.dumb) читает весь его каталог ключей и стоит дороже
+    самого запроса, поэтому страница результатов целиком отдаётся из SQLite.
+
+        StoreIndex('special_licenses').query(territory=['г. Москва'], expires_to=datetime(2021, 3, 31))
+    """
+    storage_dir = 'cached_data/'
+
+    def __init__(self, filename: str, date: str = None):
+        self.filename = filename
+        self.date = date or self.latest_date(filename)
+        self.store_path = os.path.join(self.storage_dir, f'{filename}_{self.date}')
+        self.index_path = f'{self.store_path}.index.sqlite'
+        if not self.store_files():
+            raise FileNotFoundError(f'Store {self.store_path} not found')
+
+        self.db = sqlite3.connect(self.index_path)
+        if self.is_stale():
+            self.build()
+
+    @classmethod
+    def latest_date(cls, filename: str) -> str:
+        """ Дата последнего fetch, у которого есть хранилище """
+        prefix = os.path.join(cls.storage_dir, f'{filename}_')
+        dates = set()
+        for path in filter(os.path.isfile, glob.glob(f'{glob.escape(prefix)}*')):
+            match = re.fullmatch(r'(\d{4}-\d{2}-\d{2})(\.\w+)?', path[len(prefix):])
+            if match:
+                dates.add(match.group(1))
+        if not dates:
+            raise FileNotFoundError(f'No store for {filename} in {cls.storage_dir}')
+        return max(dates)
+
+    @staticmethod
+    def find_store_files(store_path: str) -> List[str]:
+        # У dbm одно хранилище — один или несколько файлов в зависимости от модуля
+        return [path for path in filter(os.path.isfile, glob.glob(f'{glob.escape(store_path)}*'))
+                if re.fullmatch(r'(\.\w+)?', path[len(store_path):])]
+
+    @classmethod
+    def store_signature(cls, filename: str, date: str) -> str:
+        """ Подпись файлов хранилища: меняется при любой записи в него """
+        return cls.path_signature(os.path.join(cls.storage_dir, f'{filename}_{date}'))
+
+    @classmethod
+    def path_signature(cls, store_path: str) -> str:
+        stats = [os.stat(path) for path in cls.find_store_files(store_path)]
+        return f'{INDEX_VERSION}:{max(s.st_mtime_ns for s in stats)}:{sum(s.st_size for s in stats)}'
+
+    @staticmethod
+    def done_path(store_path: str) -> str:
+        # Два суффикса: ни find_store_files, ни latest_date отметку за файл хранилища не примут
+        return f'{store_path}.done.sig'
+
+    @classmethod
+    def mark_done(cls, store_path: str):
+        """ Отметка законченной записи хранилища (PutToStore.close) с подписью его файлов """
+        tmp_path = f'{cls.done_path(store_path)}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(cls.path_signature(store_path))
+        os.replace(tmp_path, cls.done_path(store_path))
+
+    @classmethod
+    def completed_version(cls, filename: str) -> Tuple[str, str]:
+        """
+        (дата, подпись) последнего хранилища, запись которого закончена, по
+        отметкам mark_done. Хранилище нового дня, которое fetch ещё пишет,
+        отметки не имеет, а переписываемое хранилище того же дня до новой
+        отметки остаётся старой версией. Если отметок нет совсем (хранилища
+        записаны до их появления) — последнее хранилище с его текущей подписью.
+        """
+        prefix = os.path.join(cls.storage_dir, f'{filename}_')
+        dates = []
+        for path in glob.glob(f'{glob.escape(prefix)}*.done.sig'):
+            match = re.fullmatch(r'(\d{4}-\d{2}-\d{2})\.done\.sig', path[len(prefix):])
+            if match:
+                dates.append(match.group(1))
+        if not dates:
+            date = cls.latest_date(filename)
+            return date, cls.store_signature(filename, date)
+        date = max(dates)
+        with open(cls.done_path(f'{prefix}{date}')) as f:
+            return date, f.read()
+
+    def store_files(self) -> List[str]:
+        return self.find_store_files(self.store_path)
+
+    def signature(self) -> str:
+        return self.store_signature(self.filename, self.date)
+
+    def is_stale(self) -> bool:
+        try:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'signature'").fetchone()
+        except sqlite3.OperationalError:
+            return True
+        return row is None or row[0] != self.signature()
+
+    @staticmethod
+    def index_rows(key: str, record: dict) -> Tuple[tuple, List[tuple]]:
+        expires = None
+        for field in EXPIRY_FIELDS:
+            if record.get(field) is not None:
+                expires = set_processor(get_earlier_date, record[field])
+                break
+        our = record.get('our')
+        row = (key, expires.isoformat() if isinstance(expires, datetime) else None,
+               int(our) if isinstance(our, bool) else None, pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL))
+        values = [(field, str(value).casefold(), key)
+                  for field in INDEXED_FIELDS for value in as_values(record.get(field))]
+        return row, values
+
+    def build(self):
+        print(f'Build index {self.index_path}', file=sys.stderr)
+        signature = self.signature()
+        with self.db:
+            self.db.executescript(SCHEMA)
+            with shelve.open(self.store_path, flag='r') as store:
+                for key in store.keys():
+                    row, values = self.index_rows(key, store[key])
+                    self.db.execute('INSERT INTO records VALUES (?, ?, ?, ?)', row)
+                    self.db.executemany('INSERT INTO field_values VALUES (?, ?, ?)', values)
+            self.db.executescript(INDEXES)
+            self.db.execute("INSERT INTO meta VALUES ('signature', ?)", (signature,))
+
+    @staticmethod
+    def where(inn: str = None, territory: Iterable[str] = (), service_name: Iterable[str] = (),
+              our: Optional[bool] = None, expires_from: datetime = None, expires_to: datetime = None) -> tuple:
+        conditions, params = [], []
+        if inn:
+            conditions.append('inn = ?')
+            params.append(inn)
+        for field, values in (('territory', territory), ('service_name', service_name)):
+            values = [value.casefold() for value in values]
+            if values:
+                placeholders = ', '.join('?' * len(values))
+                conditions.append(
+                    f'inn IN (SELECT inn FROM field_values WHERE field = ? AND value IN ({placeholders}))'
+                )
+                params.extend([field, *values])
+        if our is not None:
+            conditions.append('our = ?')
+            params.append(int(our))
+        if expires_from:
+            conditions.append('expires >= ?')
+            params.append(expires_from.isoformat())
+        if expires_to:
+            conditions.append('expires <= ?')
+            params.append(expires_to.isoformat())
+        return ' AND '.join(conditions) or '1', params
+
+    def count(self, **filters) -> int:
+        where, params = self.where(**filters)
+        return self.db.execute(f'SELECT COUNT(*) FROM records WHERE {where}', params).fetchone()[0]
+
+    def query(self, limit: int = 50, offset: int = 0, **filters) -> List[dict]:
+        """ Записи, отсортированные по ранней дате окончания; без даты — в конце """
+        where, params = self.where(**filters)
+        rows = self.db.execute(
+            f'SELECT data FROM records WHERE {where} ORDER BY expires IS NULL, expires, inn LIMIT ? OFFSET ?',
+            [*params, limit, offset],
+        )
+        return [pickle.loads(row[0]) for row in rows]
+
+    def items(self) -> Iterator[Tuple[str, dict]]:
+        """ Все записи хранилища из индекса, без открытия shelve """
+        for inn, data in self.db.execute('SELECT inn, data FROM records'):
+            yield inn, pickle.loads(data)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self) -> 'StoreIndex':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
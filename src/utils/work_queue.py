@@ -0,0 +1,270 @@
+"""
+Очередь заданий в файле SQLite без отдельного брокера: сколько угодно
+процессов (см. ниже про несколько машин) берут задания пачками под аренду
+(`claim`), выполняют и пишут результат обратно (`complete`).
+
+Ключ задания — ключ идемпотентности: повторная постановка с тем же ключом
+ничего не меняет, а выполненное задание не выполняется снова. Аренда,
+не продлённая до `lease_until` (упавший или зависший воркер), истекает,
+и задание забирает другой воркер с увеличенным `attempts`.
+
+SQLite полагается на блокировки файлов. WAL держит индекс в общей памяти
+(`-shm`), которую видят только процессы одной машины, поэтому он включается,
+только если файл на локальном диске; на сетевом томе очередь работает с
+обычным журналом отката (RKN_QUEUE_JOURNAL задаёт режим явно). Но и тогда
+корректность зависит от блокировок fcntl сетевой файловой системы, а SQLite
+их на NFS и SMB не гарантирует: воркеры на нескольких машинах с общим томом
+могут взять одно задание дважды или испортить файл. Надёжно — воркеры на той
+машине, где файл лежит на локальном диске.
+"""
+import os
+import pickle
+import socket
+import sqlite3
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Lock
+from time import time
+from typing import Any, Dict, Iterable, List, Tuple
+
+QUEUE_PATH = os.environ.get('RKN_QUEUE', 'cached_data/work_queue.sqlite3')
+# wal или delete; по умолчанию wal только на локальном диске
+QUEUE_JOURNAL = os.environ.get('RKN_QUEUE_JOURNAL')
+# Файловые системы, на которых общая память WAL не работает между машинами
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', '9p', 'fuse.sshfs', 'ceph', 'glusterfs', 'virtiofs')
+# Неудачное задание возвращается в очередь не раньше чем через RETRY_DELAY * attempts секунд
+RETRY_DELAY = 5.
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    run TEXT NOT NULL,
+    payload BLOB,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_until REAL,
+    first_claimed REAL,
+    result BLOB,
+    error TEXT,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, kind, lease_until);
+CREATE INDEX IF NOT EXISTS jobs_run ON jobs (run, status);
+"""
+
+
+@dataclass
+class Job:
+    key: str
+    kind: str
+    run: str
+    payload: Any
+    attempts: int
+    # Время первой выдачи: всё, что задание сделало во внешних системах, случилось не раньше
+    first_claimed: float
+
+    @property
+    def retried(self) -> bool:
+        """ Прошлая попытка могла выполниться, но не успела записать результат """
+        return self.attempts > 1
+
+
+def is_local_disk(path: str) -> bool:
+    """ Файл не на сетевой файловой системе; без /proc/mounts (не Linux) считаем, что на сетевой """
+    path = os.path.realpath(path)
+    try:
+        with open('/proc/mounts') as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return False
+    fs_type = 'unknown'
+    best = ''
+    for mount_point, mount_type in mounts:
+        mount_point = mount_point.replace('\\040', ' ')
+        if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) >= len(best):
+            best, fs_type = mount_point, mount_type
+    return fs_type not in NETWORK_FILESYSTEMS
+
+
+def worker_id() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class WorkQueue:
+    """
+    :param path: файл очереди, общий для всех воркеров (RKN_QUEUE)
+    :param max_attempts: после стольких неудачных попыток задание помечается failed
+    """
+
+    def __init__(self, path: str = None, max_attempts: int = 5):
+        self.path = path or QUEUE_PATH
+        self.max_attempts = max_attempts
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        # Соединение одно на объект, потоки воркера (продление аренды) делят его под блокировкой
+        self.lock = Lock()
+        self.con = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        journal = (QUEUE_JOURNAL or ('wal' if is_local_disk(self.path) else 'delete')).lower()
+        self.con.execute(f'PRAGMA journal_mode={"WAL" if journal == "wal" else "DELETE"}')
+        # С журналом отката NORMAL не защищает от порчи файла при сбое машины
+        self.con.execute(f'PRAGMA synchronous={"NORMAL" if journal == "wal" else "FULL"}')
+        self.con.executescript(SCHEMA)
+        # Очереди, созданные до появления first_claimed
+        columns = {row[1] for row in self.con.execute('PRAGMA table_info(jobs)')}
+        if 'first_claimed' not in columns:
+            self.con.execute('ALTER TABLE jobs ADD COLUMN first_claimed REAL')
+
+    @contextmanager
+    def transaction(self):
+        """ BEGIN IMMEDIATE: запись блокируется сразу, два воркера не возьмут одно задание """
+        self.con.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.con
+        except BaseException:
+            self.con.execute('ROLLBACK')
+            raise
+        self.con.execute('COMMIT')
+
+    def enqueue(self, kind: str, run: str, jobs: Iterable[Tuple[str, Any]]) -> int:
+        """ Ставит задания (ключ, данные); уже известные ключи пропускаются. Возвращает число новых """
+        now = time()
+        rows = [(key, kind, run, pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL), PENDING, now)
+                for key, payload in jobs]
+        with self.lock, self.transaction() as con:
+            before = con.total_changes
+            con.executemany('INSERT OR IGNORE INTO jobs (key, kind, run, payload, status, updated) '
+                            'VALUES (?, ?, ?, ?, ?, ?)', rows)
+            return con.total_changes - before
+
+    def claim(self, owner: str, kinds: Iterable[str] = (), limit: int = 50, lease: float = 300.,
+              run: str = None) -> List[Job]:
+        """
+        Берёт до `limit` свободных заданий (или с истёкшей арендой) под аренду
+        на `lease` секунд; `kinds` и `run` ограничивают выбор
+        """
+        now = time()
+        kinds = list(kinds)
+        filters = f'AND kind IN ({", ".join("?" * len(kinds))})' if kinds else ''
+        if run is not None:
+            filters += ' AND run = ?'
+        with self.lock, self.transaction() as con:
+            rows = con.execute(
+                f'SELECT key, kind, run, payload, attempts, first_claimed FROM jobs '
+                f'WHERE status IN (?, ?) AND COALESCE(lease_until, 0) < ? {filters} LIMIT ?',
+                (PENDING, LEASED, now, *kinds, *([run] if run is not None else []), limit),
+            ).fetchall()
+            con.executemany(
+                'UPDATE jobs SET status = ?, lease_owner = ?, lease_until = ?, attempts = attempts + 1, '
+                'first_claimed = COALESCE(first_claimed, ?), updated = ? WHERE key = ?',
+                [(LEASED, owner, now + lease, now, now, row[0]) for row in rows],
+            )
+        return [Job(key, kind, run, pickle.loads(payload), attempts + 1,
+                    now if first_claimed is None else first_claimed)
+                for key, kind, run, payload, attempts, first_claimed in rows]
+
+    def kinds(self) -> List[str]:
+        """ Виды заданий, которые ждут или выполняются """
+        with self.lock:
+            return [kind for kind, in self.con.execute('SELECT DISTINCT kind FROM jobs WHERE status IN (?, ?)',
+                                                        (PENDING, LEASED))]
+
+    def extend(self, owner: str, keys: Iterable[str], lease: float = 300.) -> int:
+        """ Продлевает аренду своих заданий; возвращает, сколько ещё за этим воркером """
+        until = time() + lease
+        with self.lock, self.transaction() as con:
+            before = con.total_changes
+            con.executemany('UPDATE jobs SET lease_until = ? WHERE key = ? AND status = ? AND lease_owner = ?',
+                            [(until, key, LEASED, owner) for key in keys])
+            return con.total_changes - before
+
+    def complete(self, owner: str, results: Iterable[Tuple[str, Any]]) -> int:
+        """
+        Записывает результаты заданий. Задание, аренду которого уже перехватил
+        другой воркер, не трогается. Возвращает число записанных.
+        """
+        now = time()
+        with self.lock, self.transaction() as con:
+            before = con.total_changes
+            con.executemany(
+                'UPDATE jobs SET status = ?, result = ?, error = NULL, lease_owner = NULL, lease_until = NULL, '
+                'updated = ? WHERE key = ? AND status = ? AND lease_owner = ?',
+                [(DONE, pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL), now, key, LEASED, owner)
+                 for key, result in results],
+            )
+            return con.total_changes - before
+
+    def fail(self, owner: str, keys: Iterable[str], error: str):
+        """ Возвращает задания в очередь с паузой, после max_attempts попыток — в failed """
+        now = time()
+        with self.lock, self.transaction() as con:
+            # Для ждущего задания lease_until — время, раньше которого его не берут
+            con.executemany(
+                'UPDATE jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, error = ?, '
+                'lease_owner = NULL, lease_until = ? + ? * attempts, updated = ? '
+                'WHERE key = ? AND status = ? AND lease_owner = ?',
+                [(self.max_attempts, FAILED, PENDING, error, now, RETRY_DELAY, now, key, LEASED, owner)
+                 for key in keys],
+            )
+
+    def retry_failed(self, run: str = None) -> int:
+        """ Возвращает failed-задания в очередь с обнулёнными попытками """
+        with self.lock, self.transaction() as con:
+            before = con.total_changes
+            con.execute('UPDATE jobs SET status = ?, attempts = 0, lease_until = NULL, updated = ? WHERE status = ? '
+                        + ('AND run = ?' if run else ''),
+                        (PENDING, time(), FAILED, *([run] if run else [])))
+            return con.total_changes - before
+
+    def results(self, run: str, kind: str = None) -> Dict[str, Any]:
+        """ Ключ -> результат выполненных заданий прогона `run` """
+        query = 'SELECT key, result FROM jobs WHERE run = ? AND status = ?'
+        params = [run, DONE]
+        if kind is not None:
+            query += ' AND kind = ?'
+            params.append(kind)
+        with self.lock:
+            return {key: pickle.loads(result) for key, result in self.con.execute(query, params)}
+
+    def counts(self, run: str = None) -> Dict[Tuple[str, str], int]:
+        """ (вид, статус) -> число заданий """
+        query = 'SELECT kind, status, COUNT(*) FROM jobs'
+        params = []
+        if run is not None:
+            query += ' WHERE run = ?'
+            params.append(run)
+        with self.lock:
+            return {(kind, status): count
+                    for kind, status, count in self.con.execute(query + ' GROUP BY kind, status', params)}
+
+    def unfinished(self, run: str) -> int:
+        """ Сколько заданий прогона ещё ждут или выполняются """
+        with self.lock:
+            return self.con.execute('SELECT COUNT(*) FROM jobs WHERE run = ? AND status IN (?, ?)',
+                                    (run, PENDING, LEASED)).fetchone()[0]
+
+    def errors(self, run: str, limit: int = 5) -> List[Tuple[str, str]]:
+        with self.lock:
+            return self.con.execute('SELECT key, error FROM jobs WHERE run = ? AND status = ? LIMIT ?',
+                                    (run, FAILED, limit)).fetchall()
+
+    def purge(self, run: str) -> int:
+        with self.lock, self.transaction() as con:
+            before = con.total_changes
+            con.execute('DELETE FROM jobs WHERE run = ?', (run,))
+            return con.total_changes - before
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self) -> 'WorkQueue':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
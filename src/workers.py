@@ -0,0 +1,265 @@
+"""
+Обогащение и push в Pipedrive через общую очередь (WorkQueue), чтобы их
+можно было раздать нескольким процессам и машинам с общим томом.
+
+fetch с `--queue` проходит источник до каждого обогатителя с `queue_key`,
+ставит в очередь ИНН, которых нет в его кеше, и вместе с воркерами
+(`cli worker`) ждёт, пока их разберут. Ответы ложатся в кеш обогатителя,
+и обычный прогон цепочки идёт уже без обращений к CRM и Pipedrive.
+
+push с `--queue` ставит готовые сделки с ключом `push:<хранилище>:<ИНН>`.
+Сделка с выполненным ключом не отправляется второй раз, а повторная попытка
+после упавшего воркера сначала ищет в Pipedrive сделку, созданную после
+первой выдачи задания (`find_deal`).
+"""
+import sys
+from itertools import groupby
+from time import sleep, perf_counter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from src.handlers import AbstractHandler, Handler, PrefetchBuffer, chain_handlers
+from src.utils.cache import EnrichmentCache
+from src.utils.work_queue import WorkQueue, Job, worker_id
+
+PUSH_KIND = 'push_deal'
+# Заданий за один claim: ИНН обогащения уходят одной пачкой в lookup
+WORKER_BATCH = 200
+# Сделки отправляются по одной, крупная пачка оставила бы остальных воркеров без работы
+PUSH_BATCH = 5
+# Аренда задания, секунды; push продлевает её перед каждой сделкой
+WORKER_LEASE = 300.
+# Пауза пустого воркера перед новой попыткой
+WORKER_POLL = 2.
+# Соединений с CRM у одного воркера
+WORKER_CRM_POOL_SIZE = 4
+
+
+def queue_enricher(kind: str, pool) -> AbstractHandler:
+    """ Обогатитель, который отвечает на задания вида `kind` (имя кеша обогатителя в цепочке) """
+    from src.handlers import OursEnricher, OursFieldEnricher, PipedriveOrganisationsEnricher
+
+    if kind == 'pipedrive_orgs':
+        return PipedriveOrganisationsEnricher(EnrichmentCache(kind))
+    if kind == 'crm_ours':
+        return OursEnricher(pool(), EnrichmentCache(kind))
+    if kind.startswith('crm_'):
+        return OursFieldEnricher(kind[len('crm_'):], kind, pool(), EnrichmentCache(kind))
+    raise ValueError(f'Unknown job kind {kind!r}')
+
+
+class Worker:
+    """
+    Берёт задания из очереди пачками и выполняет их, пока не кончатся
+    (`until_empty`) или без конца.
+
+    :param kinds: только эти виды заданий, например только `pipedrive_orgs` на машине без доступа к CRM
+    :param run: только задания этого прогона
+    """
+
+    def __init__(self, queue: WorkQueue, kinds: Iterable[str] = (), run: str = None, batch: int = WORKER_BATCH,
+                 lease: float = WORKER_LEASE, poll: float = WORKER_POLL):
+        self.queue = queue
+        self.kinds = list(kinds)
+        self.run_name = run
+        self.batch = batch
+        self.lease = lease
+        self.poll = poll
+        self.owner = worker_id()
+        self.enrichers: Dict[str, AbstractHandler] = {}
+        self.crm_pool = None
+        self.done = 0
+        self.failed = 0
+
+    def pool(self):
+        if self.crm_pool is None:
+            from src.utils.db_pool import ConnectionPool
+            self.crm_pool = ConnectionPool(WORKER_CRM_POOL_SIZE)
+        return self.crm_pool
+
+    def enricher(self, kind: str) -> AbstractHandler:
+        if kind not in self.enrichers:
+            self.enrichers[kind] = queue_enricher(kind, self.pool)
+        return self.enrichers[kind]
+
+    def enrich(self, kind: str, jobs: List[Job]):
+        results = self.enricher(kind).lookup([job.payload for job in jobs])
+        self.done += self.queue.complete(self.owner, zip((job.key for job in jobs), results))
+
+    def push(self, jobs: List[Job]):
+        """ По сделке за раз: после каждой результат сразу в очереди, упавший воркер повторит не больше одной """
+        from src.utils.pipedrive_client import push_deal, find_deal
+
+        for job in jobs:
+            # Аренду перехватили (воркер завис дольше lease) — сделкой занимается другой
+            if not self.queue.extend(self.owner, [job.key], self.lease):
+                continue
+            try:
+                deal_id = find_deal(job.payload, job.first_claimed) if job.retried else None
+                if deal_id is None:
+                    deal_id = push_deal(job.payload)['data']['id']
+            except Exception as e:
+                self.fail([job], e)
+                continue
+            self.done += self.queue.complete(self.owner, [(job.key, deal_id)])
+
+    def fail(self, jobs: List[Job], error: Exception):
+        print(f'Worker {self.owner}: {len(jobs)} {jobs[0].kind} jobs failed: {error!r}', file=sys.stderr)
+        self.queue.fail(self.owner, [job.key for job in jobs], repr(error))
+        self.failed += len(jobs)
+
+    def claim(self) -> List[Job]:
+        kinds = self.kinds or self.queue.kinds()
+        lookups = [kind for kind in kinds if kind != PUSH_KIND]
+        if lookups:
+            jobs = self.queue.claim(self.owner, lookups, self.batch, self.lease, run=self.run_name)
+            if jobs:
+                return jobs
+        if PUSH_KIND in kinds:
+            return self.queue.claim(self.owner, [PUSH_KIND], PUSH_BATCH, self.lease, run=self.run_name)
+        return []
+
+    def run(self, until_empty: bool = False) -> int:
+        """ Возвращает число выполненных заданий """
+        while True:
+            jobs = self.claim()
+            if not jobs:
+                if until_empty:
+                    return self.done
+                sleep(self.poll)
+                continue
+
+            for kind, kind_jobs in groupby(sorted(jobs, key=lambda job: job.kind), key=lambda job: job.kind):
+                kind_jobs = list(kind_jobs)
+                if kind == PUSH_KIND:
+                    self.push(kind_jobs)
+                    continue
+                try:
+                    self.enrich(kind, kind_jobs)
+                except Exception as e:
+                    self.fail(kind_jobs, e)
+
+    def close(self):
+        if self.crm_pool is not None:
+            self.crm_pool.close()
+
+
+def work(queue: WorkQueue, run: str, kinds: Iterable[str] = ()):
+    """
+    Сам выполняет задания прогона `run` наравне с другими воркерами, потом
+    ждёт, пока они доделают взятые. Падает, если часть заданий не выполнилась.
+    """
+    worker = Worker(queue, kinds, run=run)
+    start = perf_counter()
+    try:
+        worker.run(until_empty=True)
+        # Остальное у других воркеров; аренда упавшего истечёт, и его задания достанутся этому
+        while queue.unfinished(run):
+            sleep(WORKER_POLL)
+            worker.run(until_empty=True)
+    finally:
+        worker.close()
+
+    counts = queue.counts(run)
+    print(f'Queue {run}: {worker.done} jobs done here, {perf_counter() - start:.1f}s, '
+          f'{sum(counts.values())} in run: {counts}', file=sys.stderr)
+
+    errors = queue.errors(run)
+    if errors:
+        raise RuntimeError(f'Queue {run}: jobs failed, retry with `worker --retry-failed`: {errors}')
+
+
+def cut_before(head: Handler, enricher: Handler) -> Optional[Handler]:
+    """ Обработчик, после которого цепочку надо оборвать, чтобы `enricher` и его PrefetchBuffer не сработали """
+    previous = None
+    for handler in chain_handlers(head):
+        if handler is enricher or (isinstance(handler, PrefetchBuffer) and handler.enricher is enricher):
+            return previous
+        previous = handler
+    raise ValueError(f'{enricher.describe()} is not in the chain')
+
+
+class KeyCollector(AbstractHandler):
+    """ Конец укороченной цепочки: собирает ключи записей, дальше ничего не передаёт """
+
+    def __init__(self, field: str):
+        self.field = field
+        self.keys = {}
+
+    def handle(self, item: dict) -> Optional[str]:
+        self.keys[item[self.field]] = None
+
+
+def missing_keys(items: Iterable[dict], head: Handler, enricher: Handler) -> List[Any]:
+    """
+    Прогоняет записи через часть цепочки до `enricher` и возвращает ключи,
+    которых нет в его кеше. Состояние обработчиков до обрыва (счётчики,
+    статистика кешей) после прохода возвращается как было.
+    """
+    collector = KeyCollector(enricher.queue_key)
+    previous = cut_before(head, enricher)
+    if previous is None:
+        for item in items:
+            collector.handle(item)
+        return enricher.cache.missing(collector.keys)
+
+    handlers = chain_handlers(head)
+    handlers = handlers[:handlers.index(previous) + 1]
+    # Записи кешей — те же объекты, так что найденное до обрыва остаётся в кешах
+    states = [(handler, handler.get_state()) for handler in handlers]
+    next_handler = previous._next_handler
+    previous.set_next(collector)
+    try:
+        for item in items:
+            head.handle(item)
+        head.flush()
+    finally:
+        previous.set_next(next_handler)
+        for handler, state in states:
+            if state is not None:
+                handler.set_state(state)
+    return enricher.cache.missing(collector.keys)
+
+
+def resolve_enrichment(items: Callable[[], Iterable[dict]], head: Handler, run: str, queue: WorkQueue = None):
+    """
+    Заполняет кеши обогатителей цепочки через очередь, по обогатителю за
+    проход `items()`: следующему нужны записи, прошедшие фильтры после
+    предыдущего (например, BoolFilter по `our`).
+    """
+    queue = queue or WorkQueue()
+    for enricher in chain_handlers(head):
+        if getattr(enricher, 'queue_key', None) is None:
+            continue
+
+        kind = enricher.cache.name
+        keys = missing_keys(items(), head, enricher)
+        prefix = f'{run}:{kind}:'
+        added = queue.enqueue(kind, run, ((f'{prefix}{key}', key) for key in keys))
+        print(f'Queue {run}: {kind} {len(keys)} keys not in cache, {added} new jobs', file=sys.stderr)
+
+        work(queue, run, [kind])
+        results = queue.results(run, kind)
+        enricher.cache.update((key[len(prefix):], value) for key, value in results.items())
+    queue.purge(run)
+
+
+def push_queued(run: str, deals: List[Tuple[str, dict]], queue: WorkQueue = None) -> List[int]:
+    """ Ставит сделки (ключ, данные) в очередь, отправляет вместе с воркерами, возвращает id сделок """
+    queue = queue or WorkQueue()
+    added = queue.enqueue(PUSH_KIND, run, deals)
+    print(f'Queue {run}: {len(deals)} deals, {added} new jobs, {len(deals) - added} already queued or pushed',
+          file=sys.stderr)
+    work(queue, run, [PUSH_KIND])
+    results = queue.results(run, PUSH_KIND)
+    return [results[key] for key, _ in deals if key in results]
+
+
+def queue_status(queue: WorkQueue = None):
+    queue = queue or WorkQueue()
+    counts = {}
+    for (kind, status), count in sorted(queue.counts().items()):
+        counts.setdefault(kind, {})[status] = count
+    for kind, statuses in counts.items():
+        print(f'{kind:20} ' + '  '.join(f'{status} {count}' for status, count in statuses.items()))
+    if not counts:
+        print(f'Queue {queue.path} is empty')